@@ -1,5 +1,6 @@
 import os
 import time
+import asyncio
 import re
 import json
 from google import genai
@@ -7,13 +8,27 @@ from google.genai import types
 from . import parser
 from .parser import FilePartBuffer
 from .repl import create_prompt_session
-from .tmux_utils import get_tmux_logs
+from .tmux_utils import get_tmux_logs, get_tmux_fingerprint
+from .watcher import ProjectWatcher
+from .planner import plan_file_blocks, SKIPPED_FILES_NOTE
+from .estimator import joined_text_features, load_estimator, record_token_sample
+from .context_cache import get_context_cache
+from .delta_context import take_snapshot, file_changes
+from .template import render_template, read_cached_file, file_fingerprint
+from .request_memo import RequestMemo, files_fingerprint, tree_fingerprint
+from .prefetch import ContextPrefetcher
+from .stream_pipeline import run_pipeline
+from .renderer import StreamRenderer
+from .file_writer import FileWriter
+from .journal import ResponseJournal, interrupted_responses, clear_interrupted_response
+from .compactor import compact_chat_history, reset_chat_history, load_summarizer
 from .logger import (
     console,
     is_verbose,
     is_debug,
     debug,
     error,
+    warning,
     print_markdown
 )
 from .config import (
@@ -22,57 +37,119 @@ from .config import (
     GEMINI_TEMPERATURE,
     SYSTEM_PROMPT_FILE,
     CONTEXT_PROMPT_FILE,
+    TERMINAL_LOGS_PROMPT_FILE,
+    FILE_CHANGES_PROMPT_FILE,
+    PROJECT_GUIDE_FILE_NAME,
+    GLOBAL_GUIDE_FILE,
+    REQUEST_LAYOUT,
+    USE_CONTEXT_CACHE,
+    USE_DELTA_CONTEXT,
+    USE_PREFETCH,
+    USE_ASYNC_STREAM,
+    AUTO_COMPACT_TOKENS,
+    COMPACT_SUMMARIZER,
     PROJECT_ROOT,
+    CONTEXT_TOKEN_BUDGET,
+    PROMPT_WARNING_TOKENS,
     USER_NAME,
     PARTNER_NAME
 )
 from .file_utils import (
+    ProjectScan,
     generate_project_structure,
-    generate_project_file_contents,
+    generate_project_file_blocks,
     generate_diff,
     human_format_number
 )
 from .database import initialize_database, User, Chat, db_proxy
 
 def llm_system_prompt(cwd=os.getcwd()):
-    with open(SYSTEM_PROMPT_FILE, 'r', encoding='utf-8') as f:
-        prompt = f.read()
-
-    # Handle project-specific guide
-    project_guide_path = os.path.join(cwd, '.lin.md')
-    if os.path.exists(project_guide_path):
-        with open(project_guide_path, 'r', encoding='utf-8') as f:
-            project_guide_content = f.read()
-    else:
-        project_guide_content = "* Empty, no project-specific user guide is defined."
-    prompt = prompt.replace(parser.PROJECT_SPECIFIC_GUIDE, project_guide_content)
+    project_guide_content = read_cached_file(os.path.join(cwd, PROJECT_GUIDE_FILE_NAME))
+    global_guide_content = read_cached_file(GLOBAL_GUIDE_FILE)
+
+    return render_template(SYSTEM_PROMPT_FILE, {
+        parser.PROJECT_SPECIFIC_GUIDE: project_guide_content or "* Empty, no project-specific user guide is defined.",
+        parser.GLOBAL_USER_GUIDE: global_guide_content or "* Empty, no global user guide is defined.",
+    })
+
+def system_prompt_fingerprint(cwd=os.getcwd()):
+    return tuple(file_fingerprint(path) for path in [
+        SYSTEM_PROMPT_FILE, os.path.join(cwd, PROJECT_GUIDE_FILE_NAME), GLOBAL_GUIDE_FILE])
+
+def project_snapshot(ignore_patterns=None, include_patterns=None, cwd=os.getcwd(), watcher=None, memo=None):
+    """Returns the project (scan, file blocks)."""
+    # Use the watcher's warm snapshot if it is current, otherwise walk the project once and share it
+    snapshot = watcher.snapshot() if watcher else None
+    if snapshot:
+        debug("Using project snapshot from watcher")
+        return snapshot
+
+    scan = ProjectScan(ignore_patterns, include_patterns, cwd)
+    if memo is None:
+        return scan, generate_project_file_blocks(scan)
+
+    # The walk gives us the file stats, so the blocks are only loaded again if a file changed
+    return scan, memo.get('file_blocks', files_fingerprint(scan), lambda: generate_project_file_blocks(scan))
+
+def planned_file_blocks(scan, file_blocks, token_budget=None, message=None):
+    """Returns the file blocks to send (within the token budget, if any) and the files they are for."""
+    if not token_budget:
+        return file_blocks, scan.files
+
+    file_blocks, skipped_files = plan_file_blocks(scan, file_blocks, token_budget, message)
+    if skipped_files:
+        file_blocks = file_blocks + [SKIPPED_FILES_NOTE]
+
+    skipped = set(skipped_files)
+    return file_blocks, [file_path for file_path in scan.files if file_path not in skipped]
+
+def render_context_prompt(scan=None, file_blocks=()):
+    if scan is None:
+        # No files included, return prompt without file tree and file contents.
+        return render_template(CONTEXT_PROMPT_FILE, {parser.FILE_TREE_PLACEHOLDER: '[]'})
 
-    # Handle global guide (statically for now)
-    global_guide_content = "* Empty, no global user guide is defined."
-    prompt = prompt.replace(parser.GLOBAL_USER_GUIDE, global_guide_content)
+    project_structure_json = generate_project_structure(scan=scan)
 
-    return prompt
+    project_structure = json.dumps(
+        project_structure_json, indent=2) if is_debug() else json.dumps(project_structure_json, separators=(',', ':'))
 
-def llm_context_prompt(ignore_patterns=None, include_patterns=None, cwd=os.getcwd()):
-    # TODO: if prompt is larger than 500K characters, show a warning and confirmation (in debug?)
-    with open(CONTEXT_PROMPT_FILE, 'r', encoding='utf-8') as f:
-        prompt = f.read()
+    return render_template(CONTEXT_PROMPT_FILE, {
+        parser.FILE_TREE_PLACEHOLDER: project_structure,
+        parser.FILES_PLACEHOLDER: "".join(file_blocks),
+    })
 
+def llm_context_prompt(ignore_patterns=None, include_patterns=None, cwd=os.getcwd(), watcher=None, token_budget=None, message=None):
     if include_patterns is None or not include_patterns:
-        # No files included, return prompt without file tree and file contents.
-        return prompt.replace(parser.FILE_TREE_PLACEHOLDER, '[]').replace(parser.FILES_PLACEHOLDER, '')
+        return render_context_prompt()
 
-    project_structure_json = generate_project_structure(ignore_patterns, include_patterns, cwd)
-    project_files = generate_project_file_contents(ignore_patterns, include_patterns, cwd)
+    scan, file_blocks = project_snapshot(ignore_patterns, include_patterns, cwd, watcher)
+    file_blocks, _ = planned_file_blocks(scan, file_blocks, token_budget, message)
 
-    project_structure = json.dumps(
-        project_structure_json, indent=2) if is_debug() else json.dumps(project_structure_json, separators=(',', ':'))
+    return render_context_prompt(scan, file_blocks)
 
-    prompt = prompt.replace(parser.FILE_TREE_PLACEHOLDER, f'{project_structure}')
-    prompt = prompt.replace(parser.FILES_PLACEHOLDER, f'{project_files}')
-    prompt = prompt.replace(parser.TERMINAL_LOGS_PLACEHOLDER, get_tmux_logs())
+def render_file_changes_prompt(changes):
+    return render_template(FILE_CHANGES_PROMPT_FILE, {parser.FILE_CHANGES_PLACEHOLDER: "\n".join(changes)})
 
-    return prompt
+def delta_context_prompts(state, scan, file_blocks, planned_blocks, included_files):
+    """Returns the project context and file changes prompts. The first turn sends the full project context and
+       keeps a snapshot of it. Later turns send that same context again (so it stays cached) with only
+       the changes since, until they grow large enough to be worth a new snapshot. Files planned for this
+       turn (see planned_file_blocks) that were left out of the snapshot are sent in full with the changes.
+    """
+    snapshot = state['context_snapshot']
+    if snapshot:
+        changes = file_changes(snapshot, scan, file_blocks, included_files)
+        if changes is not None:
+            return snapshot['context_prompt'], render_file_changes_prompt(changes) if changes else ""
+
+    context_prompt = render_context_prompt(scan, planned_blocks)
+    state['context_snapshot'] = take_snapshot(scan, file_blocks, included_files, context_prompt)
+    debug(f"Sending a full project context snapshot ({len(included_files)} files)")
+
+    return context_prompt, ""
+
+def llm_terminal_logs_prompt():
+    return render_template(TERMINAL_LOGS_PROMPT_FILE, {parser.TERMINAL_LOGS_PLACEHOLDER: get_tmux_logs()})
 
 def process_response_metadata(response, state):
     # Initialize counters
@@ -92,11 +169,19 @@ def process_response_metadata(response, state):
         tool_use_prompt_token_count = response.usage_metadata.tool_use_prompt_token_count or 0
 
     state['session_total_tokens'] += total_token_count
+    state['last_prompt_tokens'] = prompt_token_count
+
+    # Calibrate the offline token estimator against what the request really cost
+    if state.get('prompt_features'):
+        record_token_sample(state['prompt_features'], prompt_token_count)
 
     if is_verbose():
         end_time = time.time()
         start_time = state.get('start_time', end_time)
         duration = end_time - start_time
+        memo = state['request_memo']
+        saved_ms = state['prefetch_saved_ms']
+        prefetched = f"{saved_ms:.0f}ms prefetched" if saved_ms is not None else "not prefetched"
         console.print()
 
         if is_debug():
@@ -124,10 +209,15 @@ def process_response_metadata(response, state):
             console.print(
                 f"{human_format_number(state['session_total_tokens'])} (session), "
                 f"{human_format_number(prompt_token_count)} (request), "
+                f"{human_format_number(state.get('estimated_prompt_tokens', 0))} (estimated), "
                 f"{human_format_number(candidates_token_count)} (response), "
                 f"{human_format_number(thoughts_token_count)} (thoughts), "
                 f"{human_format_number(tool_use_prompt_token_count)} (tool), "
                 f"{human_format_number(cached_content_token_count)} (cached), "
+                f"{memo.request_hits}/{memo.request_hits + memo.request_misses} (reused), "
+                f"{memo.hits}/{memo.hits + memo.misses} (session reused), "
+                f"{prefetched}, "
+                f"{state['render_cpu_seconds'] * 1000:.0f}ms (render cpu), "
                 f"{duration:.2f}s ({GEMINI_MODEL})"
             )
         else:
@@ -135,196 +225,194 @@ def process_response_metadata(response, state):
                 f"{human_format_number(state['session_total_tokens'])} tokens, "
                 f"{human_format_number(prompt_token_count)} prompt, "
                 f"{human_format_number(cached_content_token_count)} cached, "
+                f"{memo.request_hits}/{memo.request_hits + memo.request_misses} reused, "
+                f"{prefetched}, "
+                f"{state['render_cpu_seconds'] * 1000:.0f}ms rendering, "
                 f"{duration:.2f}s"
             )
 
-def process_request_stream(stream, state):
-    """Processes the streamed response from the AI."""
-    full_response_text = ""
-    queued_response_text = ""
+def print_assembled_file(file_path, version, file_content, cwd, renderer):
+    code = generate_diff(file_path, file_content)
+    is_diff = os.path.exists(os.path.join(cwd, file_path)) and code != file_content # Use os.path.join
+    language = "diff" if is_diff else parser.get_language_from_extension(file_path)
 
-    cwd = state['cwd']
-    assembled_files = {}
-    file_part_buffer = state['file_part_buffer']
-
-    with console.status(f"{PARTNER_NAME} is thinking...", spinner="point") as status:
-        for chunk in stream:
-            if not chunk.text:
-                continue
-
-            queued_response_text += chunk.text
-            full_response_text += chunk.text
+    suffix = " (EMPTY)" if not file_content else ""
+    renderer.markdown(f"#### {file_path} v{version}{suffix}", end="")
+    renderer.markdown(f"```{language}\n{code}\n```")
 
-            # Check for the *start* of a file block
-            in_progress_file = parser.find_in_progress_file(queued_response_text)
-
-            if in_progress_file:
-                in_progress_file_path = in_progress_file
-                status.update(f"{PARTNER_NAME} is writing {in_progress_file_path}...")
-
-                # Split into before_file and rest
-                before_file_start, rest = queued_response_text.split(parser.FILE_METADATA_START, 1)
-                queued_response_text = parser.FILE_METADATA_START + rest
-
-                if before_file_start:
-                    print_markdown(before_file_start)
-            else:
-                status.update(f"{PARTNER_NAME} is typing...")
-
-            queued_has_complete_code_block = re.search(parser.match_code_block(), queued_response_text, flags=re.DOTALL)
+def handle_stream_event(event_type, data, stream_state, state, renderer):
+    """Handles a single event from the streaming parser (see parser.StreamParser)."""
+    file_part_buffer = state['file_part_buffer']
 
-            if not queued_has_complete_code_block:
-                continue
+    if event_type == "text":
+        renderer.text(data)
+    elif event_type == "file_metadata":
+        renderer.flush(end="\n")
+        renderer.status(f"{PARTNER_NAME} is writing {data.get('Path')}...")
+    elif event_type == "snippet":
+        renderer.flush()
+        language, code = data
+        renderer.markdown(f"```{language}\n{code}\n```")
+    elif event_type in ("part_end", "part_incomplete"):
+        metadata, file_content = data
+        file_path = metadata.get('Path')
+        if not file_path:
+            error("Expected a file path in response file metadata but none was found.")
+            error(str(metadata))
+            return
+
+        version = metadata.get('Version')
+        no_more_parts = metadata.get('NoMoreParts', False)
+        stream_state['seen_files'].add((file_path, version))
+        if event_type == "part_incomplete":
+            # Where a cut off part stopped is lost with the file blocks stripped from the chat history,
+            # so it is not kept, and the continuation asks for the whole part again
+            file_part_buffer.start(file_path, version)
+            no_more_parts = False
+        else:
+            file_part_buffer.add(file_path, file_content, metadata.get('Part'), no_more_parts, version)
 
-            sections = re.split(parser.match_code_block(), queued_response_text, flags=re.DOTALL)
+        if no_more_parts:
+            stream_state['finished_files'].add((file_path, version))
 
-            queued_response_text = "" # Reset the queue and process the split sections
+        if file_part_buffer.is_complete(file_path, version):
+            missing_parts = file_part_buffer.missing_parts(file_path, version)
+            if missing_parts:
+                warning(f"{file_path} (v{version}) is missing part(s) {', '.join(map(str, missing_parts))}")
 
-            for index, section in enumerate(sections):
-                if not section:
-                    continue
+            # Kept as a BufferedFile (in memory, or on disk if large) until it is written
+            assembled_file = file_part_buffer.pop(file_path, version)
+            stream_state['assembled_files'][(file_path, version)] = assembled_file
+            print_assembled_file(file_path, version, assembled_file.read(), state['cwd'], renderer)
+            if state['file_writer'] and stream_state['write_files']:
+                # Written in the background right away, so the editor and test watchers see it mid stream
+                state['file_writer'].submit(file_path, assembled_file)
 
-                is_code_block = re.match(parser.match_code_block(), section, flags=re.DOTALL)
-                is_last_section = index == len(sections) - 1
+    if event_type != "file_metadata":
+        renderer.status(f"{PARTNER_NAME} is typing...")
 
-                if not is_code_block and is_last_section:
-                    # Continue on, because another file could be right after
-                    queued_response_text += section
-                    continue
+def new_stream_state():
+    return {
+        'assembled_files': {},
+        'seen_files': set(),
+        'finished_files': set(),
+        'write_files': True,
+    }
 
-                if not is_code_block:
-                    print_markdown(section, end="")
-                    continue
+def finish_request_stream(stream_parser, full_response_text, stream_state, state, renderer):
+    """Handles the end of the stream (the last section of text, or being cut off), returns the full response text."""
+    state['force_continue'] = False # Important, stops potential infinite loops
+
+    for event_type, data in stream_parser.finish():
+        if event_type == "block_incomplete":
+            # TODO: be more robust and handle if we are cut off mid file metadata
+            error("Expected incomplete file in queued response section but none were found.")
+            error("")
+            error(data)
+            error("")
+            return full_response_text
+
+        handle_stream_event(event_type, data, stream_state, state, renderer)
+
+        # We have cut off mid file part
+        if event_type == "part_incomplete":
+            debug("Stopped mid file part, force continue required...")
+            _, file_content = data
+            # Close off the incomplete file part, so it is stripped from the database record like any other
+            full_response_text = (
+                full_response_text[:stream_parser.block_start] +
+                f"{parser.FILE_METADATA_START}{stream_parser.metadata_raw}{parser.FILE_METADATA_END}\n"
+                f"{file_content}{parser.END_OF_FILE}")
+            state['force_continue'] = True
+
+    renderer.flush()
+
+    # We have cut off mid normal text (i.e. have not seen nomoreparts for a file)
+    if stream_state['seen_files'] - stream_state['finished_files']:
+        debug("Stopped with unfinished files, force continue required...")
+        state['force_continue'] = True
+
+    return full_response_text
+
+def record_render_time(renderer, state):
+    state['render_cpu_seconds'] = renderer.cpu_seconds
+    debug(f"Rendering took {renderer.cpu_seconds * 1000:.1f}ms of CPU time in {renderer.frames} frames")
 
-                is_file = parser.is_file(section)
+def process_request_stream(stream, state):
+    """Processes the streamed response from the AI, parsing it incrementally as chunks arrive."""
+    response_chunks = []
+    stream_parser = parser.StreamParser()
+    stream_state = new_stream_state()
+    last_chunk = None
 
-                if is_file:
-                    # Now we get a boolean for no_more_parts
-                    files = parser.find_files(section)
+    with StreamRenderer(f"{PARTNER_NAME} is thinking...") as renderer:
+        for chunk in stream:
+            # Keep the last chunk for metadata processing
+            last_chunk = chunk
 
-                    if not files:
-                        error("Expected files in response section but none were found.")
-                        error("")
-                        error(section)
-                        error("")
-                        continue
+            if not chunk.text:
+                continue
 
-                    should_continue = False
+            response_chunks.append(chunk.text)
+            if state['journal']:
+                state['journal'].append(chunk.text)
 
-                    for file in files:
-                        file_path, version, file_content, language, part_id, no_more_parts = file
+            for event_type, data in stream_parser.feed(chunk.text):
+                handle_stream_event(event_type, data, stream_state, state, renderer)
 
-                        file_part_buffer.add(file_path, file_content, part_id, no_more_parts, version)
+        full_response_text = finish_request_stream(stream_parser, "".join(response_chunks), stream_state, state, renderer)
 
-                        if file_part_buffer.is_complete(file_path, version):
-                            file_content = (file_part_buffer.assemble(file_path, version) or "")
-                            assembled_files[(file_path, version)] = file_content  # Store assembled file
-                            code = generate_diff(file_path, file_content)
-                            is_diff = os.path.exists(os.path.join(cwd, file_path)) and code != file_content # Use os.path.join
-                            language = "diff" if is_diff else parser.get_language_from_extension(file_path)
+    renderer.stop()
+    record_render_time(renderer, state)
 
-                            suffix = " (EMPTY)" if not file_content else ""
-                            print_markdown(f"#### {file_path} v{version}{suffix}", end="")
+    return full_response_text, last_chunk, stream_state['assembled_files']
 
-                            section = f"```{language}\n{code}\n```"
-                            print_markdown(section)
-                            status.update(f"{PARTNER_NAME} is typing...")
-                        else:
-                            should_continue = True
+async def journaled(stream, journal):
+    """Journals the chunks of an async stream as they are received, committing each batch in a worker thread
+       so the database writes don't block the event loop.
+    """
+    async for chunk in stream:
+        if chunk.text and journal.add(chunk.text):
+            await asyncio.to_thread(journal.flush)
+        yield chunk
 
-                    if should_continue:
-                        continue
+async def process_request_stream_async(stream, state):
+    """Like process_request_stream, for the async client's stream. Receiving, parsing and rendering run as
+       separate stages (see stream_pipeline), so slow rendering doesn't hold up reading the stream.
+    """
+    response_chunks = []
+    stream_parser = parser.StreamParser()
+    stream_state = new_stream_state()
+    last_chunk = None
 
-                else:
-                    status.update(f"{PARTNER_NAME} is typing...")
-                    file_path = None
-                    snippets = parser.find_snippets(section)
-                    if snippets:
-                        for language, code in snippets:
-                            section = f"```{language}\n{code}\n```"
-                            print_markdown(section)
+    def parse(chunk):
+        nonlocal last_chunk
+        # Keep the last chunk for metadata processing
+        last_chunk = chunk
+        if not chunk.text:
+            return []
+        response_chunks.append(chunk.text)
+        return stream_parser.feed(chunk.text)
 
-        # Keep the last chunk for metadata processing (*it is still in scope here unless we got zero chunks but that's another issue*)
-        try:
-            last_chunk = chunk
-        except NameError:
-            last_chunk = None
-
-        # Handle any remaining text in the queue (non-code block parts)
-        if queued_response_text:
-            in_progress_file = parser.find_in_progress_file(queued_response_text)
-
-            # We have cut off mid file part
-            if in_progress_file:
-                debug("Stopped mid file part, force continue required...")
-                # Split into before_file and the incomplete file block
-                before_file, after_file = queued_response_text.split(parser.FILE_METADATA_START, 1)
-
-                # Queued text *starts* with a file metadata start block
-                if not before_file:
-                    incomplete_file_block = queued_response_text
-                # Queued text has a file metadata start block in the middle
-                else:
-                    incomplete_file_block = f"{parser.FILE_METADATA_START}\n{after_file}"
-
-                # Remove the last line from the incomplete file content, in case its cut off
-                content_lines = incomplete_file_block.splitlines()
-                if len(content_lines) > 1:
-                    content_lines.pop() # Remove last line
-                incomplete_file_block = "\n".join(content_lines)
-
-                # Now we *need* to add the end of file
-                files = parser.find_files(incomplete_file_block, incomplete=True)
-
-                # TODO: be more robust and handle if we are cut off mid file metadata, or there is
-                # less than 2 lines in the mid content block
-                if not files:
-                    error("Expected incomplete file in queued response section but none were found.")
-                    error("")
-                    error(incomplete_file_block)
-                    error("")
-                    state['force_continue'] = False
-                    return full_response_text, last_chunk, assembled_files
+    with StreamRenderer(f"{PARTNER_NAME} is thinking...") as renderer:
+        def render(events):
+            for event_type, data in events:
+                handle_stream_event(event_type, data, stream_state, state, renderer)
 
-                for file in files:
-                    file_path, version, file_content, language, part_id, no_more_parts = file
+        stream = await stream
+        if state['journal']:
+            stream = journaled(stream, state['journal'])
 
-                    file_part_buffer.add(file_path, file_content, part_id, no_more_parts, version)
+        state['stream_timings'] = await run_pipeline(stream, parse, render)
+        debug(f"Stream: first render after {state['stream_timings']['first_render'] or 0:.3f}s, "
+              f"done after {state['stream_timings']['total']:.3f}s")
 
-                    # HACK: we need need to cut off this incomplete file part manually
-                    full_response_text = re.sub(
-                        parser.match_file(file_path, incomplete=True),
-                        f"{file_content}\n{parser.END_OF_FILE}",
-                        full_response_text)
+        full_response_text = finish_request_stream(stream_parser, "".join(response_chunks), stream_state, state, renderer)
 
-                if before_file:
-                    print_markdown(before_file, end="")
+    renderer.stop()
+    record_render_time(renderer, state)
 
-                queued_response_text = ""
-                state['force_continue'] = True # Force continue to handle the incomplete file
-            else:
-                files = parser.find_files(full_response_text)
-                unfinished_files = []
-                for file in files:
-                    no_more_parts = file[5]  # Get the no_more_parts boolean
-                    if not no_more_parts:
-                        unfinished_files.append(file)
-
-                # We have cut off mid normal text (i.e. have not seen nomoreparts for a file)
-                if unfinished_files:
-                    debug("Stopped with unfinished files, force continue required...")
-                    print_markdown(queued_response_text, end="")
-                    queued_response_text = "" # Clear the queue
-                    state['force_continue'] = True
-                # We just have normal text left, print it
-                else:
-                    print_markdown(queued_response_text, end="")
-                    queued_response_text = "" # Clear the queue
-                    state['force_continue'] = False # Important, stops potential infinite loops
-
-    status.stop()
-
-    return full_response_text, last_chunk, assembled_files
+    return full_response_text, last_chunk, stream_state['assembled_files']
 
 def process_response(full_response_text, assembled_files, state):
     llm_user, _ = User.get_or_create(name=PARTNER_NAME.lower())
@@ -342,65 +430,146 @@ def process_response(full_response_text, assembled_files, state):
             last_chat.message += f"\n\n{message_for_db}\n"
             last_chat.message = last_chat.message.strip()
             last_chat.save()
-        return
-
-    cwd = state['cwd']
-
     # Only create a new chat entry if there's actual text content to save.
-    if message_for_db:
+    elif message_for_db:
         Chat.create(user=llm_user, message=message_for_db)
 
-    if state['writeable']:
-        if assembled_files:
-            console.print("\nFiles Changed\n", style="bold yellow")
-        for (file_path, _), file_content in assembled_files.items():
+    if not state['file_writer']:
+        for assembled_file in assembled_files.values():
+            assembled_file.close()
+        return
+
+    # The files were written as they came in, wait for the last of them
+    written_files = state['file_writer'].wait()
+    if written_files:
+        console.print("\nFiles Changed\n", style="bold yellow")
+    for file_path, write_error in written_files:
+        if write_error:
+            console.print(f"  {file_path} ({write_error})", style="bold red")
+        else:
             console.print(f"  {file_path}", style="bold green")
-            full_path = os.path.join(cwd, file_path)  # Get full path for writing
-            directory_path = os.path.dirname(full_path) # Get directory part of the path
-            if directory_path and not os.path.exists(directory_path):
-                os.makedirs(directory_path)
-            with open(full_path, 'w', encoding='utf-8') as f: # Use full path
-                f.write(file_content)
-
-        if len(assembled_files) > 0:
-            print()
+
+    if written_files:
+        print()
+
+def replay_response(full_response_text, state):
+    """Runs a whole response through the stream handling, as if it streamed in and stopped there."""
+    stream_parser = parser.StreamParser()
+    stream_state = new_stream_state()
+    # The files it finished were written as it streamed in, and may have been edited since
+    stream_state['write_files'] = False
+
+    with StreamRenderer(f"{PARTNER_NAME} is recovering...") as renderer:
+        for event_type, data in stream_parser.feed(full_response_text):
+            handle_stream_event(event_type, data, stream_state, state, renderer)
+
+        full_response_text = finish_request_stream(stream_parser, full_response_text, stream_state, state, renderer)
+
+    renderer.stop()
+
+    for assembled_file in stream_state['assembled_files'].values():
+        assembled_file.close()
+
+    return full_response_text, {}
+
+def recover_interrupted_responses(state):
+    """Saves responses that were cut off by a crash (see journal.py) like any other cut off response. The parts of
+       unfinished files go in the file part buffer, so the force continue picks up from the part that was cut off.
+       Finished files are not written again.
+    """
+    llm_user, _ = User.get_or_create(name=PARTNER_NAME.lower())
+
+    for stream_id, full_response_text in interrupted_responses():
+        console.print("Recovering an interrupted response...\n", style="bold yellow")
+        # It was a continuation if the llm has the last word, otherwise it answers the user's (saved) message
+        last_chat = Chat.select().order_by(Chat.id.desc()).get_or_none()
+        continuation = bool(last_chat) and last_chat.user_id == llm_user.id
+
+        full_response_text, assembled_files = replay_response(full_response_text, state)
+        cut_off = state['force_continue']
+        state['force_continue'] = continuation
+        process_response(full_response_text, assembled_files, state)
+        state['force_continue'] = cut_off
+        clear_interrupted_response(stream_id)
+
+def recap_file_contents(blocks):
+    """Joins the parts of each file found in the blocks, like find_files does.
+       Returns {(path, version): content} and the version each path first appears with.
+    """
+    file_parts = {}
+    first_versions = {}
+    for kind, _, _, metadata, content in blocks:
+        if kind != 'file':
+            continue
+        key = (metadata.get('Path'), metadata.get('Version', 1))
+        first_versions.setdefault(key[0], key[1])
+        file_parts.setdefault(key, []).append((metadata.get('Part'), re.sub(r'\n$', '', content)))
+
+    file_contents = {
+        key: ''.join(content for _, content in sorted(parts, key=lambda part: part[0])) + '\n'
+        for key, parts in file_parts.items()
+    }
+    return file_contents, first_versions
+
+def recap_message(message):
+    """Rebuilds a stored message for the recap from one scan of its blocks. Each file is shown once,
+       with all its parts, where it first appears, and snippets are shown as markdown code blocks.
+    """
+    blocks = [
+        (kind, start, end, parser.parse_metadata(metadata) if kind == 'file' else metadata, content)
+        for kind, start, end, metadata, content in parser.scan_blocks(message)
+    ]
+    file_contents, first_versions = recap_file_contents(blocks)
+
+    pieces = []
+    cursor = 0
+    shown_files = set()
+    for kind, start, end, metadata, content in blocks:
+        if kind == 'snippet':
+            language_match = re.search(r'\nLanguage: (.*?)\n', metadata)
+            if not language_match:
+                continue
+            language = language_match.group(1)
+            pieces.append(message[cursor:start])
+            pieces.append(f'#### {language}\n\n```{language}\n{content}\n```')
+            cursor = end
+        elif kind == 'file':
+            # A newline on either side of a file block goes with it
+            if start > cursor and message[start - 1] == '\n':
+                start -= 1
+            if message.startswith('\n', end):
+                end += 1
+            pieces.append(message[cursor:start])
+            cursor = end
+
+            file_path = metadata.get('Path')
+            if file_path in shown_files:
+                continue # Extra parts are already part of the file shown
+            shown_files.add(file_path)
+
+            version = first_versions[file_path]
+            file_content = file_contents[(file_path, version)]
+            language = parser.get_language_from_extension(file_path)
+            suffix = " (EMPTY)" if not file_content else ""
+            pieces.append(f'#### {file_path} (v{version}){suffix}\n\n```{language}\n{file_content}\n```')
+
+    pieces.append(message[cursor:])
+    return ''.join(pieces)
 
 def print_recap():
     # Show recap of previous chats
     # TODO: add flag to not show previous chats on resume
     with db_proxy:
-        chats = Chat.select().join(User).order_by(Chat.timestamp)
+        chats = Chat.select(Chat, User).join(User).order_by(Chat.timestamp)
         for chat in chats:
-            message = chat.message.strip()
-
-            files = parser.find_files(message)
-            for file_path, version, content, _, _, _ in files:
-                language = parser.get_language_from_extension(file_path)
-                # HACK: ideally we avoid doing this per file, but it's a quick fix for now
-                replaced_content = content.replace("\\", "\\\\")
-                suffix = " (EMPTY)" if not replaced_content else ""
-                message = re.sub(
-                    parser.match_file(file_path),
-                    rf'#### {file_path} (v{version}){suffix}\n\n```{language}\n{replaced_content}\n```',
-                    message,
-                    flags=re.DOTALL,
-                    count=1)
-                # HACK: extra parts are not removed just the first one
-                message = re.sub(parser.match_file(file_path), '', message, flags=re.DOTALL)
-
-            message = re.sub(
-                parser.match_snippet(),
-                r'#### \1\n\n```\1\n\2\n```',
-                message,
-                flags=re.DOTALL)
-
+            message = recap_message(chat.message.strip())
             print()
             print_markdown(f'**{chat.user.name.capitalize()}:**\n\n{message}')
 
 def chat_history_contents():
     contents = []
     with db_proxy:
-        chats = Chat.select().join(User).order_by(Chat.timestamp)
+        chats = Chat.select(Chat, User).join(User).order_by(Chat.timestamp)
         for chat in chats:
             if chat.user.name == PARTNER_NAME.lower():
                 contents.append(types.ModelContent(parts=[
@@ -417,42 +586,143 @@ def save_user_message(message):
     human_user, _ = User.get_or_create(name=USER_NAME.lower())
     Chat.create(user=human_user, message=message)
 
-def ai_request_contents(message, state):
-    contents = []
+def context_prompts(message, state):
+    """Returns the project context and file changes prompts, reusing the last ones if the project has not changed."""
+    if not state['include_patterns']:
+        return llm_context_prompt(), ""
+
+    memo = state['request_memo']
+    scan, file_blocks = project_snapshot(state['ignore_patterns'], state['include_patterns'], state['cwd'], state['watcher'], memo)
+    state['project_scan'] = scan
+    fingerprint = (tree_fingerprint(scan), files_fingerprint(scan), is_debug())
+
+    planned_blocks, included_files = planned_file_blocks(scan, file_blocks, state['token_budget'], message)
+    fingerprint += (tuple(included_files),)
+
+    if state['delta_context']:
+        # Reused as long as nothing changed, since the snapshot it diffs against is only replaced on changes
+        return memo.get('context', fingerprint, lambda: delta_context_prompts(state, scan, file_blocks, planned_blocks, included_files))
+
+    return memo.get('context', fingerprint, lambda: (render_context_prompt(scan, planned_blocks), ""))
+
+def request_context(state, message=None):
+    """Builds everything in a request but the latest message (which it only needs for planning the context budget)."""
+    memo = state['request_memo']
+    memo.start_request()
+    cwd = state['cwd']
+
+    system_prompt = memo.get('system_prompt', system_prompt_fingerprint(cwd), lambda: llm_system_prompt(cwd=cwd))
     chat_contents = chat_history_contents()
-    context_prompt = llm_context_prompt(
-        ignore_patterns=state['ignore_patterns'],
-        include_patterns=state['include_patterns'],
-        cwd=state['cwd']
-    )
+    context_prompt, file_changes_prompt = context_prompts(message, state)
+    # The same context prompt gets the same Part (and is not copied into a new one)
+    context_part = memo.get('context_part', context_prompt, lambda: types.Part.from_text(text=context_prompt))
+    terminal_logs_prompt = memo.get('terminal_logs', get_tmux_fingerprint(), llm_terminal_logs_prompt)
+
+    return {
+        'system_prompt': system_prompt,
+        'chat_contents': chat_contents,
+        'context_prompt': context_prompt,
+        'context_part': context_part,
+        # What changes from one request to the next
+        'volatile_prompt': file_changes_prompt + terminal_logs_prompt,
+    }
 
-    user_content_parts = [types.Part.from_text(text=context_prompt)]
+def latest_project_scan(state):
+    """The session's newest project scan (the watcher's, or the last request's), for @ completions."""
+    scan = state['watcher'].latest_scan() if state['watcher'] else None
+    return scan or state['project_scan']
+
+def prefetch_fingerprint(state):
+    """What a prefetched context was built from: the guides, the watcher's snapshot and the terminal logs."""
+    scan = None
+    if state['watcher']:
+        snapshot = state['watcher'].snapshot()
+        # The watcher publishes a new scan on every change, without a current one the files can't be checked
+        scan = snapshot[0] if snapshot else object()
+    return system_prompt_fingerprint(state['cwd']), scan, get_tmux_fingerprint()
+
+def prefetched_context(message, state):
+    """Stops the prefetcher and returns its latest context, if it can be used for this message."""
+    prefetcher = state['prefetcher']
+    if not prefetcher:
+        return None
+
+    context, build_seconds, waited = prefetcher.take()
+    if context is None:
+        return None
+
+    # The context budget is planned without a message, so files @ referenced in it may be left out
+    if state['token_budget'] and message and parser.find_file_references(message):
+        debug("Prefetched context skipped, the message references files")
+        return None
+
+    state['prefetch_saved_ms'] = max(0, (build_seconds - waited) * 1000)
+    return context
+
+def continuation_note(state):
+    note = "(System Note: Your last response was incomplete. Please continue.)"
+    in_progress = state['file_part_buffer'].in_progress()
+    if not in_progress:
+        return note
+
+    # File parts are stripped from the chat history, so say where to pick up instead of starting the files over
+    received = "; ".join(
+        f"{file_path} (v{version}) part(s) {', '.join(map(str, parts)) or 'none'}, continue from part {max(parts, default=0) + 1}"
+        for file_path, version, parts in in_progress)
+    return (f"{note[:-1]} The file parts already received are saved: {received}. "
+            f"A part that was cut off is not saved, send it again in full.)")
+
+def ai_request_contents(message, state, context=None):
+    context = context or request_context(state, message)
+    chat_contents = context['chat_contents']
+    context_prompt = context['context_prompt']
+    volatile_prompt = context['volatile_prompt']
 
     # We have a new message to send
     if message:
         save_user_message(message)
-        user_content_parts.append(types.Part.from_text(text=f"# {USER_NAME}'s Latest Message\n\n{message}"))
+        latest_parts = [types.Part.from_text(text=f"# {USER_NAME}'s Latest Message\n\n{message}")]
     # We are continuing from last response
     elif chat_contents:
         if isinstance(chat_contents[-1], types.UserContent):
             last_content = chat_contents.pop()
             last_content_text = "\n".join([part.text or "" for part in last_content.parts])
-            user_content_parts.append(types.Part.from_text(text=f"# {USER_NAME}'s Latest Message\n\n{last_content_text}"))
+            latest_parts = [types.Part.from_text(text=f"# {USER_NAME}'s Latest Message\n\n{last_content_text}")]
         else:
-            user_content_parts.append(
-                types.Part.from_text(text="(System Note: Your last response was incomplete. Please continue.)"))
+            latest_parts = [types.Part.from_text(text=continuation_note(state))]
     else:
         raise SystemError("No previous chat history found for continuation.")
 
-    contents += chat_contents
-    contents.append(types.UserContent(parts=user_content_parts))
+    if state['request_layout'] == "stable":
+        # The project context only changes when files do, and the history only grows, so consecutive
+        # requests share everything up to the terminal logs and latest message (for implicit caching)
+        contents = [types.UserContent(parts=[context['context_part']])]
+        contents += chat_contents
+        contents.append(types.UserContent(parts=[types.Part.from_text(text=volatile_prompt)] + latest_parts))
+    else:
+        contents = chat_contents
+        contents.append(types.UserContent(parts=[types.Part.from_text(text=context_prompt + volatile_prompt)] + latest_parts))
 
     return contents
 
-def send_request_to_ai(message, state, client):
-    """Sends a request to the AI and processes the streamed response."""
-    system_prompt = llm_system_prompt(cwd=state['cwd'])
-    contents = ai_request_contents(message, state)
+def check_prompt_size(system_prompt, contents, state):
+    """Estimates the request's prompt tokens offline, and warns if it is larger than we'd like."""
+    # Most parts (the system prompt, project context and chat history) are the same as last time, so only new ones are counted
+    texts = [system_prompt] + [part.text or "" for content in contents for part in content.parts]
+    state['prompt_features'], state['prompt_features_cache'] = joined_text_features(texts, state['prompt_features_cache'])
+    state['estimated_prompt_tokens'] = load_estimator().predict(state['prompt_features'], overhead=True)
+
+    if state['estimated_prompt_tokens'] > PROMPT_WARNING_TOKENS:
+        warning(f"This request is ~{human_format_number(state['estimated_prompt_tokens'])} tokens, "
+                f"consider a smaller -f or a token budget (-b).")
+
+def send_request_to_ai(message, state, client, context=None):
+    """Sends a request to the AI and processes the streamed response (context is from the prefetcher, if any)."""
+    if context is None:
+        state['prefetch_saved_ms'] = None
+        context = request_context(state, message)
+    system_prompt = context['system_prompt']
+    contents = ai_request_contents(message, state, context)
 
     # TODO: own method
     if is_debug():
@@ -471,28 +741,97 @@ def send_request_to_ai(message, state, client):
             f.write(tmp_text)
         debug(f"Current request saved to {tmp_file}")
 
+    check_prompt_size(system_prompt, contents, state)
+
     state['start_time'] = time.time()
 
-    config = types.GenerateContentConfig(
-        system_instruction=system_prompt,
-        temperature=GEMINI_TEMPERATURE,
-        response_modalities=["TEXT"],
-        tools=[
-            types.Tool(google_search=types.GoogleSearch()),
-            types.Tool(url_context=types.UrlContext())
-        ]
-    )
+    tools = [
+        types.Tool(google_search=types.GoogleSearch()),
+        types.Tool(url_context=types.UrlContext())
+    ]
+
+    cached_content = None
+    if state['context_cache']:
+        # The stable layout puts the project context first, so it can go in the cache along with the system prompt
+        cached_content = get_context_cache(client, GEMINI_MODEL, system_prompt, contents[0], tools)
+
+    if cached_content:
+        # The system prompt and tools are part of the cache, and can't be sent again
+        contents = contents[1:]
+        config = types.GenerateContentConfig(
+            cached_content=cached_content,
+            temperature=GEMINI_TEMPERATURE,
+            response_modalities=["TEXT"]
+        )
+    else:
+        config = types.GenerateContentConfig(
+            system_instruction=system_prompt,
+            temperature=GEMINI_TEMPERATURE,
+            response_modalities=["TEXT"],
+            tools=tools
+        )
+
+    # Every chunk is journaled until the response is saved, in case we crash mid stream
+    state['journal'] = ResponseJournal()
+
+    try:
+        if state['async_stream']:
+            # The runner keeps one event loop for the session, so the async client can reuse its connections
+            stream = client.aio.models.generate_content_stream(model=GEMINI_MODEL, contents=contents, config=config)
+            full_response_text, last_chunk, assembled_files = state['stream_runner'].run(process_request_stream_async(stream, state))
+        else:
+            stream = client.models.generate_content_stream(model=GEMINI_MODEL, contents=contents, config=config)
+            full_response_text, last_chunk, assembled_files = process_request_stream(stream, state)
+    except BaseException:
+        # Keep what was received (i.e. the connection dropped, or Ctrl-C), it is recovered after the error
+        state['journal'].flush()
+        raise
+
+    state['journal'].flush()
+    process_response(full_response_text, assembled_files, state)
+    state['journal'].clear()
+    state['journal'] = None
 
-    stream = client.models.generate_content_stream(model=GEMINI_MODEL, contents=contents, config=config)
+    process_response_metadata(last_chunk, state) # HACK: 'chunk' is still in scope from the loop
 
-    full_response_text, last_chunk, assembled_files = process_request_stream(stream, state)
+    # Not while continuing, the cut off response is still being finished
+    if state['auto_compact_tokens'] and state['last_prompt_tokens'] > state['auto_compact_tokens'] and not state['force_continue']:
+        debug(f"Prompt was {state['last_prompt_tokens']} tokens (over {state['auto_compact_tokens']}), auto compacting...")
+        compact_history(state, client, automatic=True)
+
+def compact_history(state, client, automatic=False):
+    """Compacts the chat history (see compactor.py) and shows how many tokens it saved. Auto compaction is quiet
+       when there is nothing left to compact (i.e. the project context alone is over the limit).
+    """
+    summarize = load_summarizer(state['compact_summarizer'], client)
+    with console.status(f"{PARTNER_NAME} is compacting the chat history...", spinner="point"):
+        compacted, tokens_before, tokens_after = compact_chat_history(summarize)
+
+    if not compacted:
+        if not automatic:
+            console.print("Nothing to compact.\n", style="bold yellow")
+        return
 
-    process_response(full_response_text, assembled_files, state)
+    console.print(
+        f"Compacted {compacted} message(s), saved ~{human_format_number(tokens_before - tokens_after)} tokens "
+        f"(chat history ~{human_format_number(tokens_before)} -> ~{human_format_number(tokens_after)} tokens)\n",
+        style="bold yellow"
+    )
 
-    process_response_metadata(last_chunk, state) # HACK: 'chunk' is still in scope from the loop
+def reset_history(state):
+    """Archives the whole chat history, and drops anything left of a cut off response."""
+    archived, tokens = reset_chat_history()
+
+    for buffered_file in state['file_part_buffer'].buffer.values():
+        buffered_file.close()
+    state['file_part_buffer'] = FilePartBuffer()
+    state['force_continue'] = False
+    state['force_continue_counter'] = 0
+
+    console.print(f"Chat history reset, archived {archived} message(s) (~{human_format_number(tokens)} tokens)\n", style="bold yellow")
 
 # TODO: make into a class or better structure?
-def create_session_state(cwd, resume=False, writeable=False, ignore_patterns=None, include_patterns=None):
+def create_session_state(cwd, resume=False, writeable=False, ignore_patterns=None, include_patterns=None, watch=False, token_budget=None, request_layout=None, context_cache=None, delta_context=None, prefetch=None, async_stream=None, auto_compact=None):
     # Split the comma-separated ignore patterns into a list
     ignore_patterns = ignore_patterns.split(',') if ignore_patterns else None
 
@@ -500,18 +839,57 @@ def create_session_state(cwd, resume=False, writeable=False, ignore_patterns=Non
     if include_patterns is not None and "." in include_patterns:
         include_patterns = ["."]  # Treat "." as a special case, including all files.
 
-    return {
+    # Only worth watching if there are files to include in the context
+    watcher = ProjectWatcher(ignore_patterns, include_patterns, cwd) if watch and include_patterns else None
+
+    context_cache = USE_CONTEXT_CACHE if context_cache is None else context_cache
+    delta_context = USE_DELTA_CONTEXT if delta_context is None else delta_context
+    prefetch = USE_PREFETCH if prefetch is None else prefetch
+    async_stream = USE_ASYNC_STREAM if async_stream is None else async_stream
+    auto_compact = AUTO_COMPACT_TOKENS if auto_compact is None else auto_compact
+
+    state = {
         'session_total_tokens': 0,
         'file_part_buffer': FilePartBuffer(),
         'force_continue': False,
         'force_continue_counter': 0,
         'writeable': writeable,
+        'file_writer': FileWriter(cwd) if writeable else None,
         'resume': resume,
         'ignore_patterns': ignore_patterns,
         'include_patterns': include_patterns,
+        'watcher': watcher,
+        'token_budget': token_budget or CONTEXT_TOKEN_BUDGET,
+        # Context caching and file changes need the project context at the start of the request
+        'request_layout': "stable" if context_cache or delta_context else (request_layout or REQUEST_LAYOUT),
+        'context_cache': context_cache,
+        'delta_context': delta_context,
+        'context_snapshot': None,
+        'project_scan': None,
+        'request_memo': RequestMemo(),
+        'prompt_features_cache': None,
+        'prefetcher': None,
+        'prefetch_saved_ms': None,
+        'async_stream': async_stream,
+        'stream_runner': asyncio.Runner() if async_stream else None,
+        'stream_timings': None,
+        'render_cpu_seconds': 0.0,
+        'journal': None,
+        'last_prompt_tokens': 0,
+        'auto_compact_tokens': auto_compact,
+        'compact_summarizer': COMPACT_SUMMARIZER,
         'cwd': cwd,
     }
 
+    # Without the watcher, checking the prefetched files are current means scanning the project anyway
+    if prefetch and (watcher or not include_patterns):
+        state['prefetcher'] = ContextPrefetcher(lambda: request_context(state), fingerprint=lambda: prefetch_fingerprint(state))
+        if watcher:
+            # Rebuild as soon as the watcher has the changes, instead of on the next interval
+            watcher.on_refresh = state['prefetcher'].refresh
+
+    return state
+
 def repl_loop(session, client, state):
     while True:
         try:
@@ -529,46 +907,69 @@ def repl_loop(session, client, state):
             if not state['force_continue']:
                 state['force_continue_counter'] = 0
 
+            if state['prefetcher']:
+                state['prefetcher'].start()
+
             prompt_text = session.prompt("> ")
+            context = prefetched_context(prompt_text, state)
 
             if prompt_text.startswith('$exit'):
                 break
 
-            # TODO: essentially strip all chat history of file references (so all files are v1 (open files), same as if the autocompact was run)
             if prompt_text.startswith('$compact'):
-                debug("(TODO) Compacting database...")
-                break
+                compact_history(state, client)
+                continue
 
             if prompt_text.startswith('$reset'):
-                debug("(TODO) Resetting chat history...")
-                break
+                reset_history(state)
+                continue
 
             if prompt_text.startswith('$continue'):
                 send_request_to_ai(None, state, client)
                 continue
 
             state['force_continue'] = False  # Reset force continue state
-            send_request_to_ai(prompt_text, state, client)
+            send_request_to_ai(prompt_text, state, client, context)
 
         except KeyboardInterrupt:
             if input("\nReally quit? (y/n) ").lower() == 'y':
                 break
+            # Stopped on purpose, so don't recover what was journaled of it on the next start (after newer chats)
+            if state['journal']:
+                state['journal'].clear()
+                state['journal'] = None
         except EOFError:
             if input("\nReally quit? (y/n) ").lower() == 'y':
                 break
         except Exception:
             print(f"{PARTNER_NAME} has glitched!\n")
             console.print_exception(show_locals=True)
+            recover_interrupted_responses(state)
 
-def coding_repl(resume=False, writeable=False, ignore_patterns=None, include_patterns=None, cwd=os.getcwd()):
+def coding_repl(resume=False, writeable=False, ignore_patterns=None, include_patterns=None, cwd=os.getcwd(), watch=False, token_budget=None, request_layout=None, context_cache=None, delta_context=None, prefetch=None, auto_compact=None):
     initialize_database(cwd)
 
     client = genai.Client(api_key=GOOGLE_API_KEY)
 
-    session = create_prompt_session(cwd)
+    state = create_session_state(cwd, resume, writeable, ignore_patterns, include_patterns, watch, token_budget, request_layout, context_cache, delta_context, prefetch, auto_compact=auto_compact)
+
+    session = create_prompt_session(cwd, lambda: latest_project_scan(state))
 
-    state = create_session_state(cwd, resume, writeable, ignore_patterns, include_patterns)
+    if state['watcher']:
+        state['watcher'].start()
 
     print_recap()
 
-    repl_loop(session, client, state)
+    recover_interrupted_responses(state)
+
+    try:
+        repl_loop(session, client, state)
+    finally:
+        if state['prefetcher']:
+            state['prefetcher'].stop()
+        if state['stream_runner']:
+            state['stream_runner'].close()
+        if state['file_writer']:
+            state['file_writer'].close()
+        if state['watcher']:
+            state['watcher'].stop()
@@ -4,9 +4,12 @@ import sys
 from rich.traceback import install
 from google import genai
 from .__version__ import __version__
-from .config import GOOGLE_API_KEY, GEMINI_MODEL
+from .config import GOOGLE_API_KEY, GEMINI_MODEL, REQUEST_LAYOUTS
 from .file_utils import generate_project_file_list, human_format_number
 from .chat import coding_repl
+from .database import initialize_database
+from .token_counter import count_file_tokens, estimate_file_tokens, directory_totals
+from .estimator import load_estimator
 from .logger import console, error, debug_logging, verbose_logging, quiet_logging
 
 install(show_locals=True)
@@ -46,6 +49,13 @@ def add_repl_args(parser):
     group.add_argument("-i", "--ignore", type=str, help="Comma-separated list of additional ignore patterns.")
     group.add_argument("-w", "--writeable", action="store_true", help="Enable auto-writing to files from AI responses.")
     group.add_argument("-n", "--no-resume", action="store_true", help="Do not resume previous conversation. Start a new chat.")
+    group.add_argument("-b", "--budget", type=int, help="Max tokens of file references to include, the most relevant files are picked first (others are only in the file tree).")
+    group.add_argument("-a", "--auto-compact", type=int, metavar="TOKENS", help="Compact the chat history once a prompt is over this many tokens (also see $compact).")
+    group.add_argument("--watch", action="store_true", help="Watch the project in the background to keep the file context ready between messages.")
+    group.add_argument("--cache", action="store_true", default=None, help="Keep the system prompt and project context in an explicit context cache, only uploaded again when it changes (implies --layout stable).")
+    group.add_argument("--delta", action="store_true", default=None, help="Send the project files in full once, then only diffs of what changed since (implies --layout stable).")
+    group.add_argument("--no-prefetch", dest="prefetch", action="store_false", default=None, help="Don't build the next request's context in the background while typing.")
+    group.add_argument("--layout", choices=REQUEST_LAYOUTS, help="Request layout, 'stable' puts the project context before the chat history so more of each request is cached.")
     # fmt: on
 
 def add_debug_args(parser):
@@ -60,6 +70,7 @@ def add_file_listing_args(parser):
     # fmt: off
     group.add_argument("-l", "--list-files", action="store_true", help="List all files that will be included if -f is set.")
     group.add_argument("-t", "--tokens", action="store_true", help="List all files, their token counts, and the total token count.")
+    group.add_argument("-e", "--estimate", action="store_true", help="With -t, estimate token counts offline (calibrated from past requests) instead of asking the API.")
     # fmt: on
 
 def create_parser():
@@ -96,26 +107,52 @@ def handle_list_files(args):
     files = generate_project_file_list(extra_ignore_patterns, include_patterns, cwd)
     print(files)
 
-def handle_tokens(args):
+def handle_tokens(args, client=None):
     cwd = args.directory
-    client = genai.Client(api_key=os.getenv('GOOGLE_API_KEY'))
+    model = os.getenv('GEMINI_MODEL') or ''
+
+    # Token counts (and estimator samples) are kept in the project database, so unchanged files are never re-counted
+    initialize_database(cwd)
 
     extra_ignore_patterns = args.ignore.split(',') if args.ignore else []
     include_patterns = args.files.split(',') if args.files else []
     file_paths = generate_project_file_list(extra_ignore_patterns, include_patterns, cwd)
-    total_tokens = 0
-    for file_path in file_paths.splitlines():
-        try:
-            with open(os.path.join(cwd, file_path), 'r', encoding='utf-8') as f:
-                content = f.read()
-            tokens = client.models.count_tokens(model=os.getenv('GEMINI_MODEL') or '', contents=content).total_tokens
-            total_tokens += tokens or 0
-        except FileNotFoundError:
+
+    if getattr(args, 'estimate', False):
+        counts, errors = estimate_file_tokens(cwd, file_paths.splitlines())
+    else:
+        client = client or genai.Client(api_key=os.getenv('GOOGLE_API_KEY'))
+        counts, errors = count_file_tokens(client, model, cwd, file_paths.splitlines())
+
+    for file_path, e in errors.items():
+        if isinstance(e, FileNotFoundError):
             print(f"{file_path}: NOT FOUND", file=sys.stderr)
-        except Exception as e:
+        else:
             print(f"Error with {file_path}: {e}", file=sys.stderr)
 
-    print(f"Total tokens: {total_tokens}")
+    print_token_totals("Files", counts)
+    print_token_totals("Directories", directory_totals(counts))
+
+    if getattr(args, 'estimate', False):
+        print_estimator_error()
+
+    print(f"Total tokens: {sum(counts.values())}")
+
+def print_estimator_error():
+    estimator = load_estimator()
+    estimator_error = estimator.error()
+    if estimator_error is None:
+        print("Estimated with default weights (no requests recorded yet for this project)")
+    else:
+        print(f"Estimated, {estimator_error * 100:.1f}% mean error against {len(estimator.samples)} recorded requests")
+
+def print_token_totals(title, totals):
+    if not totals:
+        return
+    print(title)
+    for path, tokens in sorted(totals.items(), key=lambda item: (-item[1], item[0])):
+        print(f"  {human_format_number(tokens):>8}  {path}")
+    print()
 
 def configure_logger(args):
     if args.debug:
@@ -168,7 +205,14 @@ def main():
         writeable=args.writeable,
         ignore_patterns=args.ignore,
         include_patterns=include_files,
-        cwd=args.directory
+        cwd=args.directory,
+        watch=args.watch,
+        token_budget=args.budget,
+        request_layout=args.layout,
+        context_cache=args.cache,
+        delta_context=args.delta,
+        prefetch=args.prefetch,
+        auto_compact=args.auto_compact
     )
 
 if __name__ == "__main__":
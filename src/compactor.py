@@ -0,0 +1,163 @@
+import re
+import uuid
+from google.genai import types
+from peewee import chunked
+from . import parser
+from .logger import debug
+from .estimator import estimate_tokens
+from .database import Chat, ChatArchive, User, db_proxy
+from .config import (
+    PARTNER_NAME,
+    GEMINI_TEMPERATURE,
+    COMPACT_KEEP_RECENT,
+    COMPACT_SUMMARY_CHARS,
+    COMPACT_SUMMARY_MODEL,
+)
+
+# Marks a message as summarized, so the model (and the recap) can tell
+SUMMARY_PREFIX = "(Summary of an earlier reply) "
+
+HEADING_REGEX = re.compile(r'^#{1,6} ')
+
+SUMMARY_PROMPT = """Summarize this reply of yours from earlier in our conversation in a few sentences (under {max_chars} characters).
+Keep the decisions made, the files and names involved, and anything left to do. Leave out code.
+
+{message}"""
+
+def replace_blocks(message, replace):
+    """Replaces each file, snippet and terminal log block with replace(kind, metadata, content), or keeps it if that returns None."""
+    pieces = []
+    cursor = 0
+    for kind, start, end, metadata, content in parser.scan_blocks(message):
+        replacement = replace(kind, metadata, content)
+        if replacement is None:
+            continue
+        pieces.append(message[cursor:start])
+        pieces.append(replacement)
+        cursor = end
+    pieces.append(message[cursor:])
+    return "".join(pieces)
+
+def strip_file_blocks(message):
+    """Replaces file blocks with a short note (once per file version), since the project context always has the current files."""
+    noted = set()
+
+    def replace(kind, metadata, content):
+        if kind != 'file':
+            return None
+        metadata = parser.parse_metadata(metadata)
+        key = (metadata.get('Path'), metadata['Version'])
+        if key in noted:
+            return ""
+        noted.add(key)
+        return f"(File {key[0]} v{key[1]}, see the project files for its current content)"
+
+    return replace_blocks(message, replace)
+
+def truncate(text, max_chars):
+    return text if len(text) <= max_chars else text[:max_chars - 3].rstrip() + "..."
+
+def summarize_heuristically(message, max_chars=COMPACT_SUMMARY_CHARS):
+    """Keeps the opening and closing paragraphs of a reply and the headings in between, code snippets are left out."""
+    def replace(kind, metadata, content):
+        if kind != 'snippet':
+            return None
+        language_match = re.search(r'\nLanguage: (.*?)\n', metadata)
+        language = language_match.group(1) if language_match else "code"
+        return f"\n\n(A {language} snippet, {len(content.splitlines())} lines)\n\n"
+
+    paragraphs = [paragraph.strip() for paragraph in re.split(r'\n\s*\n', replace_blocks(message, replace)) if paragraph.strip()]
+    headings = [paragraph.splitlines()[0] for paragraph in paragraphs[1:-1] if HEADING_REGEX.match(paragraph)]
+    kept = paragraphs[:1] + headings + paragraphs[1:][-1:]
+
+    return truncate(SUMMARY_PREFIX + "\n\n".join(kept), max_chars)
+
+def llm_summarizer(client, model=COMPACT_SUMMARY_MODEL, max_chars=COMPACT_SUMMARY_CHARS):
+    """Returns a summarizer that asks the model, falling back to the heuristic one if the request fails."""
+    def summarize(message):
+        try:
+            response = client.models.generate_content(
+                model=model,
+                contents=SUMMARY_PROMPT.format(max_chars=max_chars, message=message),
+                config=types.GenerateContentConfig(temperature=GEMINI_TEMPERATURE)
+            )
+            summary = (response.text or "").strip()
+        except Exception as e:
+            debug(f"Summary request failed: {e}")
+            summary = ""
+
+        if not summary:
+            return summarize_heuristically(message, max_chars)
+        return truncate(SUMMARY_PREFIX + summary, max_chars)
+
+    return summarize
+
+def load_summarizer(name, client=None):
+    if name == "llm" and client:
+        return llm_summarizer(client)
+    return summarize_heuristically
+
+def compact_message(message, is_reply, summarize):
+    compacted = strip_file_blocks(message).strip()
+    if is_reply and len(compacted) > COMPACT_SUMMARY_CHARS:
+        compacted = summarize(compacted)
+    return compacted
+
+def archive_chats(chats, compaction):
+    rows = [
+        {'chat_id': chat.id, 'user': chat.user_id, 'message': chat.message, 'timestamp': chat.timestamp, 'compaction': compaction}
+        for chat in chats
+    ]
+    for batch in chunked(rows, 100):
+        ChatArchive.insert_many(batch).execute()
+
+def chat_messages():
+    with db_proxy:
+        return list(Chat.select().order_by(Chat.timestamp, Chat.id))
+
+def compact_chat_history(summarize=summarize_heuristically, keep_recent=COMPACT_KEEP_RECENT):
+    """Strips file blocks from all but the last keep_recent messages, and summarizes the long replies among them.
+       The original messages are archived. Returns (messages compacted, chat history tokens before, and after).
+    """
+    if db_proxy.obj is None:
+        return 0, 0, 0
+
+    with db_proxy:
+        llm_user, _ = User.get_or_create(name=PARTNER_NAME.lower())
+    chats = chat_messages()
+    older = chats[:max(0, len(chats) - keep_recent)]
+
+    # Summaries can be API requests, so they are all made before writing anything
+    compacted = {}
+    for chat in older:
+        message = compact_message(chat.message.strip(), chat.user_id == llm_user.id, summarize)
+        if message != chat.message.strip():
+            compacted[chat.id] = message
+
+    tokens_before = sum(estimate_tokens(chat.message) for chat in chats)
+    tokens_after = sum(estimate_tokens(compacted.get(chat.id, chat.message)) for chat in chats)
+
+    if compacted:
+        with db_proxy:
+            archive_chats([chat for chat in older if chat.id in compacted], uuid.uuid4().hex)
+            for chat_id, message in compacted.items():
+                Chat.update(message=message).where(Chat.id == chat_id).execute()
+        debug(f"Compacted {len(compacted)} of {len(chats)} messages")
+
+    return len(compacted), tokens_before, tokens_after
+
+def reset_chat_history():
+    """Archives and removes every message. Returns (messages archived, chat history tokens they took)."""
+    if db_proxy.obj is None:
+        return 0, 0
+
+    chats = chat_messages()
+    if not chats:
+        return 0, 0
+
+    tokens = sum(estimate_tokens(chat.message) for chat in chats)
+    with db_proxy:
+        archive_chats(chats, uuid.uuid4().hex)
+        Chat.delete().where(Chat.id <= max(chat.id for chat in chats)).execute()
+
+    return len(chats), tokens
@@ -11,6 +11,101 @@ PARTNER_NAME = "Linus"
 
 SYSTEM_PROMPT_FILE = os.path.join(os.path.dirname(__file__), "templates", "system.md")
 CONTEXT_PROMPT_FILE = os.path.join(os.path.dirname(__file__), "templates", "context.md")
+TERMINAL_LOGS_PROMPT_FILE = os.path.join(os.path.dirname(__file__), "templates", "terminal_logs.md")
+FILE_CHANGES_PROMPT_FILE = os.path.join(os.path.dirname(__file__), "templates", "file_changes.md")
+
+# User guides added to the system prompt, the global one applies to every project
+PROJECT_GUIDE_FILE_NAME = ".lin.md"
+GLOBAL_GUIDE_FILE = os.getenv("LINUS_GLOBAL_GUIDE") or os.path.join(
+    os.getenv("XDG_CONFIG_HOME") or os.path.join(os.path.expanduser("~"), ".config"), "linus", "guide.md")
+
+# Bounded thread pool size for reading project files (reads are I/O bound, so more than the cpu count)
+FILE_READ_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+FILE_READ_BATCH_SIZE = 64
+
+# List project files from the git index (git ls-files) when inside a git work tree, instead of walking the file system
+USE_GIT_INDEX = os.getenv("LINUS_USE_GIT_INDEX", "true").lower() != "false"
+
+# Files over this size (in bytes) are truncated before going into the prompt
+MAX_FILE_SIZE = 256 * 1024
+
+# Per pattern size limits (first match wins), i.e. for generated files that are rarely useful in full
+MAX_FILE_SIZES = {
+    "*.json": 64 * 1024,
+    "*.csv": 64 * 1024,
+    "*.min.js": 16 * 1024,
+    "*.min.css": 16 * 1024,
+}
+
+# How much of a file to check for NUL bytes and invalid UTF-8 before reading it
+FILE_SNIFF_SIZE = 8192
+
+# Max tokens of file references to put in the context (0 for no limit), files that don't fit are only in the file tree
+CONTEXT_TOKEN_BUDGET = int(os.getenv("LINUS_CONTEXT_TOKEN_BUDGET") or 0)
+
+# Warn before sending a request estimated to be larger than this (prompts under ~200K tokens are priced lower)
+PROMPT_WARNING_TOKENS = 200_000
+
+# How many recent chat messages the context planner looks through for file mentions
+PLANNER_HISTORY_LIMIT = 50
+
+# How requests are laid out: "default" puts the project context in the latest message, "stable" puts it first
+# (then the chat history, then terminal logs and the latest message) so requests share a long prefix for caching
+REQUEST_LAYOUTS = ["default", "stable"]
+REQUEST_LAYOUT = os.getenv("LINUS_REQUEST_LAYOUT") or "default"
+
+# Create explicit context caches for the system prompt and project context (implies the "stable" layout),
+# kept for CONTEXT_CACHE_TTL seconds and replaced when the project context changes
+USE_CONTEXT_CACHE = os.getenv("LINUS_CONTEXT_CACHE", "false").lower() == "true"
+CONTEXT_CACHE_TTL = int(os.getenv("LINUS_CONTEXT_CACHE_TTL") or 3600)
+
+# Send the full project context once, then only diffs of the files that changed since (implies the "stable" layout).
+# A new full snapshot is sent once the diffs grow past DELTA_REBASE_RATIO of its size.
+USE_DELTA_CONTEXT = os.getenv("LINUS_DELTA_CONTEXT", "false").lower() == "true"
+DELTA_REBASE_RATIO = 0.5
+
+# Build the next request's context in the background while typing, rebuilt every PREFETCH_INTERVAL seconds
+# (or when the watcher sees a change) so it is ready, and at most this stale, when the message is sent
+USE_PREFETCH = os.getenv("LINUS_PREFETCH", "true").lower() != "false"
+PREFETCH_INTERVAL = 2.0
+
+# Stream responses with the async client, receiving, parsing and rendering in separate stages connected by queues
+# of STREAM_QUEUE_SIZE (so a slow render holds up reading the stream, instead of buffering all of it)
+USE_ASYNC_STREAM = os.getenv("LINUS_ASYNC_STREAM", "true").lower() != "false"
+STREAM_QUEUE_SIZE = 64
+
+# Streamed text is rendered at most this many times a second (only the markdown blocks completed since the last frame)
+RENDER_FPS = 30
+
+# Max concurrent count_tokens requests when listing token counts (-t)
+TOKEN_COUNT_WORKERS = 8
+
+# File parts streamed in a response are kept in memory up to this size (per file), then spill to a temp file
+FILE_PART_SPILL_SIZE = 1024 * 1024
+
+# Streamed chunks are journaled in .lin.db (to recover from a crash mid response), committed in batches of this
+# many chunks or after this many seconds, whichever comes first
+JOURNAL_BATCH_SIZE = 16
+JOURNAL_BATCH_INTERVAL = 0.5
+
+# Compact the chat history once a request's prompt passes this many tokens (0 to only compact with $compact).
+# Compaction leaves the last COMPACT_KEEP_RECENT messages alone, strips file blocks (the project context has the
+# current files) and summarizes replies longer than COMPACT_SUMMARY_CHARS, the originals are kept in ChatArchive
+AUTO_COMPACT_TOKENS = int(os.getenv("LINUS_AUTO_COMPACT_TOKENS") or 0)
+COMPACT_KEEP_RECENT = 6
+COMPACT_SUMMARY_CHARS = 1500
+
+# How replies are summarized: "heuristic" keeps the opening, headings and closing (offline), "llm" asks the model
+COMPACT_SUMMARIZERS = ["heuristic", "llm"]
+COMPACT_SUMMARIZER = os.getenv("LINUS_COMPACT_SUMMARIZER") or "heuristic"
+COMPACT_SUMMARY_MODEL = os.getenv("LINUS_COMPACT_SUMMARY_MODEL") or GEMINI_MODEL
+
+# With -w, fsync each file (and its directory) as it is written, so it survives a crash or power loss
+FSYNC_WRITES = os.getenv("LINUS_FSYNC", "false").lower() == "true"
+
+# Extension to language table built from the pygments lexer mapping (rebuilt when pygments is upgraded)
+LANGUAGE_CACHE_FILE = os.path.join(
+    os.getenv("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "linus", "languages.json")
 
 PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 
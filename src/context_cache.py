@@ -0,0 +1,76 @@
+import hashlib
+from datetime import datetime, timedelta
+from google.genai import types, errors
+from .logger import debug, warning
+from .config import CONTEXT_CACHE_TTL
+from .database import ContextCache, db_proxy
+
+# Don't hand out a cache that is about to expire mid request
+EXPIRY_MARGIN = timedelta(seconds=60)
+
+def context_cache_key(model, system_prompt, context_content, tools):
+    digest = hashlib.sha256()
+    for text in [model, system_prompt] + [part.text or "" for part in context_content.parts] + [repr(tools)]:
+        digest.update(text.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+# Keys we could not create a cache for this session (i.e. the context is under the model's minimum), not retried
+FAILED_KEYS = set()
+
+def delete_context_caches(client, names):
+    for name in names:
+        try:
+            client.caches.delete(name=name)
+            debug(f"Deleted context cache {name}")
+        except errors.APIError as e:
+            # Most likely already expired
+            debug(f"Could not delete context cache {name}: {e}")
+
+def create_context_cache(client, model, key, system_prompt, context_content, tools, ttl):
+    try:
+        cache = client.caches.create(model=model, config=types.CreateCachedContentConfig(
+            display_name=f"linus-{key[:12]}",
+            system_instruction=system_prompt,
+            contents=[context_content],
+            tools=tools,
+            ttl=f"{ttl}s"
+        ))
+    except errors.APIError as e:
+        # i.e. the context is under the model's minimum for caching, or over the quota
+        warning(f"Could not create a context cache, sending the full context: {e.message or e}")
+        FAILED_KEYS.add(key)
+        return None
+
+    debug(f"Created context cache {cache.name} (ttl {ttl}s)")
+    return cache
+
+def get_context_cache(client, model, system_prompt, context_content, tools, ttl=CONTEXT_CACHE_TTL):
+    """Returns the name of a cached content holding the system prompt, tools and project context, creating
+       one if there is no unexpired cache for them. Caches for older contexts are deleted, since the
+       project context only ever moves forward.
+    """
+    key = context_cache_key(model, system_prompt, context_content, tools)
+    if key in FAILED_KEYS:
+        return None
+    now = datetime.now()
+
+    with db_proxy:
+        cached = ContextCache.get_or_none(ContextCache.key == key)
+        if cached and cached.expire_time > now + EXPIRY_MARGIN:
+            debug(f"Using context cache {cached.name}")
+            return cached.name
+        stale = list(ContextCache.select().where(ContextCache.model == model))
+
+    # The API requests are made outside of a transaction, so the database is not locked while waiting on them
+    delete_context_caches(client, [row.name for row in stale])
+    cache = create_context_cache(client, model, key, system_prompt, context_content, tools, ttl)
+
+    with db_proxy:
+        ContextCache.delete().where(ContextCache.id.in_([row.id for row in stale])).execute()
+        # Caches for other models are kept until they expire (the API drops them by then too)
+        ContextCache.delete().where(ContextCache.expire_time <= now).execute()
+        if cache:
+            ContextCache.create(key=key, model=model, name=cache.name, expire_time=now + timedelta(seconds=ttl))
+
+    return cache.name if cache else None
@@ -30,6 +30,75 @@ class Chat(BaseModel):
     message = TextField()
     timestamp = DateTimeField(default=datetime.now)
 
+class ChatArchive(BaseModel):
+    """Chat messages as they were before being compacted (or reset), by the compaction that archived them."""
+    chat_id = IntegerField()
+    user = ForeignKeyField(User, backref='archived_chats')
+    message = TextField()
+    timestamp = DateTimeField()
+    compaction = CharField(index=True)
+    archived_at = DateTimeField(default=datetime.now)
+
+class FileCache(BaseModel):
+    """Rendered file blocks, keyed by the file's stat (and size limit) so unchanged files are never re-read."""
+    path = CharField(unique=True)
+    mtime_ns = IntegerField()
+    size = IntegerField()
+    inode = IntegerField()
+    max_size = IntegerField()
+    block = TextField()
+
+class TokenCount(BaseModel):
+    """Token counts from the API, keyed by a hash of the counted content and the model that counted it."""
+    content_hash = CharField()
+    model = CharField()
+    tokens = IntegerField()
+
+    class Meta:
+        indexes = ((('content_hash', 'model'), True),)
+
+class TokenSample(BaseModel):
+    """Prompt text features paired with the prompt_token_count the API reported, used to fit the token estimator."""
+    characters = IntegerField()
+    words = IntegerField()
+    symbols = IntegerField()
+    non_ascii = IntegerField()
+    tokens = IntegerField()
+    timestamp = DateTimeField(default=datetime.now)
+
+class FileSnapshot(BaseModel):
+    """Content addressed store of the file blocks sent as context, so later turns can send diffs against them."""
+    content_hash = CharField(unique=True)
+    content = TextField()
+
+class ContextCache(BaseModel):
+    """Explicit context caches created with the API (by resource name), keyed by a hash of what they hold."""
+    key = CharField(unique=True)
+    model = CharField()
+    name = CharField()
+    expire_time = DateTimeField()
+    timestamp = DateTimeField(default=datetime.now)
+
+class StreamJournal(BaseModel):
+    """Chunks of a response as they stream in, so a response cut off by a crash can be recovered on the next start."""
+    stream_id = CharField(index=True)
+    sequence = IntegerField()
+    text = TextField()
+    timestamp = DateTimeField(default=datetime.now)
+
+# Tables that only hold derived data, so they are dropped (and filled again) when their columns change
+CACHE_TABLES = [FileCache]
+
+def drop_outdated_cache_tables(database):
+    for model in CACHE_TABLES:
+        table_name = model._meta.table_name
+        if not database.table_exists(table_name):
+            continue
+        columns = {column.name for column in database.get_columns(table_name)}
+        if columns != set(model._meta.columns):
+            debug(f"Dropping outdated cache table: {table_name}")
+            database.drop_tables([model])
+
 def initialize_database(cwd):
     """Initializes the database connection and creates tables."""
     db_path = os.path.join(cwd, '.lin.db')
@@ -37,7 +106,8 @@ def initialize_database(cwd):
     db_proxy.initialize(database)
 
     with db_proxy:
-        db_proxy.create_tables([User, Chat], safe=True)
+        drop_outdated_cache_tables(database)
+        db_proxy.create_tables([User, Chat, ChatArchive, FileCache, TokenCount, TokenSample, FileSnapshot, ContextCache, StreamJournal], safe=True)
 
         # Pre-populate users if they don't exist
         User.get_or_create(name=USER_NAME.lower())
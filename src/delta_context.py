@@ -0,0 +1,85 @@
+import json
+from peewee import chunked
+from .logger import debug
+from .config import DELTA_REBASE_RATIO
+from .database import FileSnapshot, db_proxy
+from .file_utils import diff_contents
+from .token_counter import content_hash
+
+def store_contents(contents):
+    """Saves each content in the content addressed store, returns {key: content hash}."""
+    hashes = {key: content_hash(content) for key, content in contents.items()}
+    rows = [{'content_hash': digest, 'content': content} for digest, content in zip(hashes.values(), contents.values())]
+    with db_proxy:
+        for batch in chunked(rows, 100):
+            FileSnapshot.insert_many(batch).on_conflict_ignore().execute()
+    return hashes
+
+def load_contents(hashes):
+    contents = {}
+    with db_proxy:
+        for batch in chunked(list(set(hashes)), 500):
+            query = FileSnapshot.select().where(FileSnapshot.content_hash.in_(batch))
+            contents.update({row.content_hash: row.content for row in query})
+    return contents
+
+def prune_contents(hashes):
+    """Deletes the stored contents not in hashes, only the latest snapshot is ever diffed against."""
+    keep = set(hashes)
+    with db_proxy:
+        stale = [digest for (digest,) in FileSnapshot.select(FileSnapshot.content_hash).tuples() if digest not in keep]
+        for batch in chunked(stale, 500):
+            FileSnapshot.delete().where(FileSnapshot.content_hash.in_(batch)).execute()
+    if stale:
+        debug(f"Snapshot store: pruned {len(stale)} contents")
+
+def take_snapshot(scan, file_blocks, included_files, context_prompt):
+    """Records the file blocks sent in a full project context, to diff against in later turns."""
+    blocks = dict(zip(scan.files, file_blocks))
+    included = {file_path: blocks[file_path] for file_path in included_files}
+    hashes = store_contents(included)
+    prune_contents(hashes.values())
+    return {
+        'files': hashes,
+        'scan_files': set(scan.files),
+        'tree': scan.tree,
+        'size': sum(len(block) for block in included.values()),
+        'context_prompt': context_prompt,
+    }
+
+def file_changes(snapshot, scan, file_blocks, included_files=None, rebase_ratio=DELTA_REBASE_RATIO):
+    """Describes what changed since the snapshot: diffs of changed files, new files in full, deleted files and
+       the new file tree (if it changed). Files in included_files that the snapshot left out (i.e. to fit the
+       token budget) are sent in full too. Returns None when it is time for a new snapshot instead.
+    """
+    previous = snapshot['files']
+    current = dict(zip(scan.files, file_blocks))
+    left_out = set(included_files or ()) - set(previous)
+    changed = [
+        file_path for file_path, block in current.items()
+        if file_path in previous and content_hash(block) != previous[file_path]
+    ]
+    originals = load_contents(previous[file_path] for file_path in changed)
+
+    changes = []
+    for file_path in scan.files:
+        if file_path in changed:
+            if previous[file_path] not in originals:
+                debug(f"Snapshot of {file_path} is missing from the store")
+                return None
+            changes.append(diff_contents(originals[previous[file_path]], current[file_path], f"a/{file_path}", f"b/{file_path}", n=3))
+        elif file_path not in snapshot['scan_files'] or file_path in left_out:
+            changes.append(current[file_path])
+
+    changes += [f"Deleted: {file_path}\n" for file_path in previous if file_path not in current]
+
+    if scan.tree != snapshot['tree']:
+        changes.append(f"\nThe file tree is now:\n\n{json.dumps(scan.tree, separators=(',', ':'))}\n")
+
+    changes_size = sum(len(change) for change in changes)
+    if changes_size > rebase_ratio * snapshot['size']:
+        debug(f"File changes ({changes_size} chars) outgrew the snapshot ({snapshot['size']} chars)")
+        return None
+
+    debug(f"File changes since snapshot: {len(changed)} changed, {changes_size} chars")
+    return changes
@@ -0,0 +1,113 @@
+import re
+from .logger import debug
+from .database import TokenSample, db_proxy
+
+WORD_REGEX = re.compile(r'\w+')
+SYMBOL_REGEX = re.compile(r'[^\w\s]')
+
+# Starting weights for (characters, words, symbols, non ascii bytes, request overhead), roughly 4 characters per token.
+# The recorded samples pull the fit away from these as they come in.
+PRIOR_WEIGHTS = [0.15, 0.25, 0.25, 0.3, 0.0]
+# How strongly to pull each weight towards its prior (the overhead is per request, not per character, so it barely is)
+PRIOR_STRENGTHS = [1e4, 1e4, 1e4, 1e4, 1e-2]
+
+# Only fit against the most recent requests, in case the model (or its tokenizer) changes
+SAMPLE_LIMIT = 500
+
+def text_features(text):
+    return [
+        len(text),
+        len(WORD_REGEX.findall(text)),
+        len(SYMBOL_REGEX.findall(text)),
+        len(text.encode('utf-8')) - len(text),
+    ]
+
+def joined_text_features(texts, cache=None):
+    """text_features of "\n".join(texts), summed from the features of each text (the newlines only add characters).
+       Returns them with a cache of each text's features, pass it back in to only count the texts that changed.
+    """
+    previous = cache or {}
+    cache = {}
+    total = [max(0, len(texts) - 1), 0, 0, 0]
+    for text in texts:
+        features = cache.get(text) or previous.get(text) or text_features(text)
+        cache[text] = features
+        total = [value + feature for value, feature in zip(total, features)]
+    return total, cache
+
+def solve(matrix, vector):
+    """Solves a small linear system with gaussian elimination (partial pivoting)."""
+    size = len(vector)
+    rows = [matrix[i][:] + [vector[i]] for i in range(size)]
+    for column in range(size):
+        pivot = max(range(column, size), key=lambda row: abs(rows[row][column]))
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+        for row in range(column + 1, size):
+            factor = rows[row][column] / rows[column][column]
+            for k in range(column, size + 1):
+                rows[row][k] -= factor * rows[column][k]
+    weights = [0.0] * size
+    for row in reversed(range(size)):
+        total = sum(rows[row][k] * weights[k] for k in range(row + 1, size))
+        weights[row] = (rows[row][size] - total) / rows[row][row]
+    return weights
+
+class TokenEstimator:
+    """A linear token estimate over character class counts, fitted (ridge regression towards the prior
+       weights) against the prompt token counts the API reports for our requests.
+    """
+
+    def __init__(self, samples=None):
+        self.samples = samples or []
+        self.weights = self.fit(self.samples)
+
+    def fit(self, samples):
+        size = len(PRIOR_WEIGHTS)
+        xtx = [[PRIOR_STRENGTHS[i] if i == j else 0.0 for j in range(size)] for i in range(size)]
+        xty = [strength * weight for strength, weight in zip(PRIOR_STRENGTHS, PRIOR_WEIGHTS)]
+        for features, tokens in samples:
+            row = features + [1]
+            for i in range(size):
+                xty[i] += row[i] * tokens
+                for j in range(size):
+                    xtx[i][j] += row[i] * row[j]
+        return solve(xtx, xty)
+
+    def predict(self, features, overhead=False):
+        row = features + [1 if overhead else 0]
+        return max(0, round(sum(weight * value for weight, value in zip(self.weights, row))))
+
+    def estimate(self, text, overhead=False):
+        """Estimates the tokens of text, with overhead=True for a whole request (system prompt, tools, etc.)."""
+        return self.predict(text_features(text), overhead)
+
+    def error(self):
+        """Mean absolute percentage error against the recorded requests, or None without any."""
+        errors = [abs(self.predict(features, True) - tokens) / tokens for features, tokens in self.samples if tokens]
+        return sum(errors) / len(errors) if errors else None
+
+ESTIMATOR = None
+
+def load_estimator():
+    global ESTIMATOR
+    if ESTIMATOR is None:
+        samples = []
+        if db_proxy.obj is not None:
+            with db_proxy:
+                query = TokenSample.select().order_by(TokenSample.timestamp.desc()).limit(SAMPLE_LIMIT)
+                samples = [([row.characters, row.words, row.symbols, row.non_ascii], row.tokens) for row in query]
+        ESTIMATOR = TokenEstimator(samples)
+        debug(f"Token estimator fitted on {len(samples)} requests: {ESTIMATOR.weights}")
+    return ESTIMATOR
+
+def record_token_sample(features, tokens):
+    """Records the real prompt token count of a request, so the next estimate is fitted with it."""
+    global ESTIMATOR
+    if db_proxy.obj is None or not tokens:
+        return
+    characters, words, symbols, non_ascii = features
+    TokenSample.create(characters=characters, words=words, symbols=symbols, non_ascii=non_ascii, tokens=tokens)
+    ESTIMATOR = None
+
+def estimate_tokens(text, overhead=False):
+    return load_estimator().estimate(text, overhead)
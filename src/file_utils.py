@@ -1,13 +1,36 @@
 import os
+import re
+import mmap
+import codecs
+import stat as statlib
+import subprocess
 import difflib
+from concurrent.futures import ThreadPoolExecutor
 import pathspec
+from peewee import chunked
 from .logger import debug
-from .config import DEFAULT_IGNORE_PATTERNS
+from .config import (
+    DEFAULT_IGNORE_PATTERNS,
+    FILE_READ_WORKERS,
+    FILE_READ_BATCH_SIZE,
+    USE_GIT_INDEX,
+    MAX_FILE_SIZE,
+    MAX_FILE_SIZES,
+    FILE_SNIFF_SIZE
+)
+from .database import FileCache, db_proxy
 from .parser import (
     file_block,
     get_language_from_extension,
 )
 
+# Compiled nested .gitignore matchers, keyed by path: (mtime_ns, spec)
+NESTED_IGNORE_SPECS = {}
+
+MAX_FILE_SIZE_SPECS = [
+    (pathspec.PathSpec.from_lines('gitwildmatch', [pattern]), max_size) for pattern, max_size in MAX_FILE_SIZES.items()
+]
+
 def format_number(num, magnitude):
     # TODO: Add more prefixes if needed (e.g., 'G' for billions)
     suffixes = ['', 'K', 'M', 'B', 'T']
@@ -24,128 +47,410 @@ def load_ignore_patterns(extra_ignore_patterns=None, cwd=os.getcwd()):
         ignore_patterns.extend(extra_ignore_patterns)
     return ignore_patterns
 
+def diff_contents(original_content, current_content, fromfile, tofile, n=5):
+    diff = difflib.unified_diff(
+        original_content.splitlines(keepends=True),
+        current_content.splitlines(keepends=True),
+        fromfile=fromfile,
+        tofile=tofile,
+        n=n
+    )
+
+    return ''.join(diff)
+
 def generate_diff(file_path, current_content):
     try:
         with open(file_path, 'r', encoding='utf-8') as f:
-            file_content = f.readlines()
+            file_content = f.read()
     except FileNotFoundError:
         return current_content
 
-    diff = difflib.unified_diff(
-        file_content,
-        current_content.splitlines(keepends=True),
-        fromfile=f"{file_path} (disk)",
-        tofile=f"{file_path} (context)",
-        n=5
-    )
+    return diff_contents(file_content, current_content, f"{file_path} (disk)", f"{file_path} (context)")
 
-    stringifed_diff = ''.join(diff)
+class IgnoreSpec(pathspec.PathSpec):
+    """A PathSpec that checks every pattern with one combined regex, unless there are negated (!) patterns
+       where the order of matches matters.
+    """
 
-    return stringifed_diff
+    def __init__(self, patterns):
+        super().__init__(patterns)
+        active_patterns = [pattern for pattern in self.patterns if pattern.include is not None]
+        self.combined_regex = None
+        if active_patterns and all(pattern.include for pattern in active_patterns):
+            # NOTE: each gitwildmatch regex has the same named group, which can't repeat in one regex
+            self.combined_regex = re.compile('|'.join(
+                f"(?:{pattern.regex.pattern.replace('(?P<ps_d>', '(?:')})" for pattern in active_patterns))
 
-# NOTE: we don't use the args.files here, because we want to include all non-default ignored files
-def generate_project_structure(extra_ignore_patterns=None, include_patterns=None, cwd=None):
-    if include_patterns is None:
-        include_patterns = []
-    cwd = cwd or os.getcwd()  # Use provided cwd or default to current.
-    ignore_patterns = load_ignore_patterns(extra_ignore_patterns, cwd)
-    ignore_spec = pathspec.PathSpec.from_lines('gitwildmatch', ignore_patterns)
-    include_spec = pathspec.PathSpec.from_lines('gitwildmatch', include_patterns)
-    allow_all = "." in include_patterns
-
-    file_tree = [{
-        "id": "$root",
-        "name": os.path.basename(cwd),
-        "parent": None,
-        "type": "directory"
-    }]
-
-    for root, dirs, files in os.walk(cwd, topdown=True):
-        relative_path = os.path.relpath(root, cwd)
-        if relative_path == '.':
-            relative_path = ''
-
-        # Filter out ignored directories (for walking, not for the list)
-        dirs[:] = [d for d in dirs if not ignore_spec.match_file(os.path.join(relative_path, d))]
+    def match_file(self, file, separators=None):
+        if self.combined_regex is None:
+            return super().match_file(file, separators)
+        return self.combined_regex.match(pathspec.util.normalize_file(file, separators)) is not None
+
+def load_nested_ignore_spec(ignore_file_entry):
+    """Compiles a nested .gitignore into a matcher, cached until the file changes."""
+    try:
+        mtime_ns = ignore_file_entry.stat().st_mtime_ns
+    except OSError:
+        return None
+
+    cached = NESTED_IGNORE_SPECS.get(ignore_file_entry.path)
+    if cached and cached[0] == mtime_ns:
+        return cached[1]
+
+    with open(ignore_file_entry.path, encoding="utf-8") as f:
+        patterns = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    spec = IgnoreSpec.from_lines('gitwildmatch', patterns) if patterns else None
+    NESTED_IGNORE_SPECS[ignore_file_entry.path] = (mtime_ns, spec)
+    return spec
+
+def is_ignored(relative_path, ignore_spec, nested_specs):
+    if ignore_spec.match_file(relative_path):
+        return True
+    # Nested .gitignore patterns are relative to the directory they live in
+    for spec_dir, spec in nested_specs:
+        if spec.match_file(relative_path[len(spec_dir) + 1:]):
+            return True
+    return False
+
+def walk_project(cwd, ignore_spec):
+    """Yields (relative path, is dir, DirEntry) for every non-ignored directory and file, top down.
+       Ignored directories are pruned before descending, and nested .gitignore files are honored.
+    """
+    pending = [('', [])]
+
+    while pending:
+        relative_dir, nested_specs = pending.pop()
+        try:
+            with os.scandir(os.path.join(cwd, relative_dir)) as it:
+                entries = list(it)
+        except OSError as e:
+            debug(f"Unable to scan {relative_dir or cwd}: {e}")
+            continue
+
+        # The root .gitignore is already part of ignore_spec
+        ignore_file = next((entry for entry in entries if entry.name == '.gitignore'), None)
+        if relative_dir and ignore_file:
+            spec = load_nested_ignore_spec(ignore_file)
+            if spec:
+                nested_specs = nested_specs + [(relative_dir, spec)]
+
+        dirs = []
+        files = []
+        for entry in entries:
+            relative_path = os.path.join(relative_dir, entry.name)
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                continue
+            if is_dir:
+                # Match with a trailing slash so directory only patterns (i.e. "build/") prune the walk
+                if not is_ignored(f"{relative_path}/", ignore_spec, nested_specs):
+                    dirs.append((relative_path, True, entry))
+            elif not is_ignored(relative_path, ignore_spec, nested_specs):
+                files.append((relative_path, False, entry))
+
+        yield from dirs
+        yield from files
+
+        # NOTE: symlinked directories are listed but not followed (same as os.walk)
+        pending.extend((relative_path, nested_specs) for relative_path, _, entry in reversed(dirs) if not entry.is_symlink())
+
+def git_dirty_files(cwd):
+    """Lists files (relative to cwd) that are modified or untracked in the git work tree."""
+    commands = [
+        ["git", "diff", "-z", "--name-only", "--relative", "HEAD"],
+        ["git", "ls-files", "-z", "--others", "--exclude-standard"]
+    ]
+    dirty_files = set()
+    for command in commands:
+        try:
+            result = subprocess.run(command, cwd=cwd, capture_output=True, check=False)
+        except OSError:
+            return dirty_files
+        if result.returncode == 0:
+            dirty_files.update(os.fsdecode(path) for path in result.stdout.split(b'\0') if path)
+    return dirty_files
+
+def git_project_files(cwd):
+    """Lists tracked and untracked (but not git ignored) files from the git index, or None outside of a git repo."""
+    command = ["git", "ls-files", "-z", "--cached", "--others", "--exclude-standard"]
+    try:
+        result = subprocess.run(command, cwd=cwd, capture_output=True, check=False)
+    except OSError:
+        return None
+    if result.returncode != 0:
+        return None
+    # NOTE: files deleted from the work tree (but still in the index) are listed too, so callers must stat them
+    return list(dict.fromkeys(os.fsdecode(path) for path in result.stdout.split(b'\0') if path))
+
+def walk_git_project(ignore_spec, file_paths):
+    """Yields (relative path, is dir, None) for every non-ignored directory and file in a git file list.
+       Directories are derived from the file paths, so empty directories are not included.
+    """
+    ignored_dirs = {}
+    seen_dirs = set()
+
+    def is_dir_ignored(relative_dir):
+        if relative_dir not in ignored_dirs:
+            parent = os.path.dirname(relative_dir)
+            ignored_dirs[relative_dir] = bool(parent and is_dir_ignored(parent)) or \
+                bool(ignore_spec.match_file(f"{relative_dir}/"))
+        return ignored_dirs[relative_dir]
+
+    for relative_path in file_paths:
+        relative_dir = os.path.dirname(relative_path)
+        if (relative_dir and is_dir_ignored(relative_dir)) or ignore_spec.match_file(relative_path):
+            continue
+
+        parts = relative_dir.split('/') if relative_dir else []
+        for index in range(1, len(parts) + 1):
+            parent_dir = '/'.join(parts[:index])
+            if parent_dir not in seen_dirs:
+                seen_dirs.add(parent_dir)
+                yield parent_dir, True, None
+
+        yield relative_path, False, None
+
+class ProjectScan:
+    """A single walk of the project that produces the file tree, the included file list and their stats.
+       Files come from the git index when the project is in a git work tree, otherwise from walking the file system.
+    """
+
+    def __init__(self, extra_ignore_patterns=None, include_patterns=None, cwd=None, use_git=USE_GIT_INDEX):
+        self.cwd = cwd or os.getcwd()  # Use provided cwd or default to current.
+        self.use_git = use_git
+        self.backend = None
+        self.include_patterns = include_patterns or []
+        ignore_patterns = load_ignore_patterns(extra_ignore_patterns, self.cwd)
+        self.ignore_spec = IgnoreSpec.from_lines('gitwildmatch', ignore_patterns)
+        self.include_spec = pathspec.PathSpec.from_lines('gitwildmatch', self.include_patterns)
+        self.allow_all = "." in self.include_patterns
+        self.tree = []
+        self.files = []
+        self.stats = {}
+        self.scan()
+
+    def is_included(self, path):
+        return self.allow_all or self.include_spec.match_file(path)
+
+    def tree_entry(self, path, entry_type):
+        parent = os.path.dirname(path)
+        return {
+            "id": path,
+            "name": os.path.basename(path),
+            "parent": parent != '.' and parent or "$root",
+            "type": entry_type
+        }
+
+    def scan(self):
+        tree = [{
+            "id": "$root",
+            "name": os.path.basename(self.cwd),
+            "parent": None,
+            "type": "directory"
+        }]
+
+        git_files = git_project_files(self.cwd) if self.use_git else None
+
+        if git_files is not None:
+            self.backend = "git"
+            entries = walk_git_project(self.ignore_spec, git_files)
+        else:
+            self.backend = "walk"
+            entries = walk_project(self.cwd, self.ignore_spec)
 
         # TODO: be better, i.e. add the cwd to the tree even if empty or match fails (because it's for a file vs a dir)
-        for dir_path in dirs:
-            dir_path = os.path.join(relative_path, dir_path)
-            dir_parent = os.path.dirname(dir_path)
-            allowed = not ignore_spec.match_file(dir_path) and (allow_all or include_spec.match_file(dir_path))
-
-            if allowed:
-                debug(f"Project structure (add): {dir_path}")
-                file_tree.append({
-                    "id": dir_path,
-                    "name": os.path.basename(dir_path),
-                    "parent": dir_parent != '.' and dir_parent or "$root",
-                    "type": "directory"
-                })
-
-        for file in files:
-            file_path = os.path.join(relative_path, file)
-            file_parent = os.path.dirname(file_path)
-            allowed = not ignore_spec.match_file(file_path) and (allow_all or include_spec.match_file(file_path))
-            if allowed:
-                debug(f"Project structure (add): {file_path}")
-                file_tree.append({
-                    "id": file_path,
-                    "name": os.path.basename(file),
-                    "parent": file_parent != '.' and file_parent or "$root",
-                    "type": "file"
-                })
-
-    file_tree = sorted(file_tree, key=lambda x: x['id'])
-
-    return file_tree
-
-def generate_project_file_contents(extra_ignore_patterns=None, include_patterns=None, cwd=None):
-    if include_patterns is None:
-        include_patterns = []
-    files = generate_project_file_list(extra_ignore_patterns, include_patterns, cwd)
-    output = ""
-
-    # TODO: make an array
-    for file_path in files.splitlines():
-        debug(f"File contents (add): {file_path}")
-        # NOTE: we always user version 1 here, since any newer versions will be in conversation history
-        output += get_file_contents(file_path, cwd=cwd)
-
-    return output
-
-def generate_project_file_list(extra_ignore_patterns=None, include_patterns=None, cwd=None):
-    if include_patterns is None:
-        include_patterns = []
-    cwd = cwd or os.getcwd()  # Use provided cwd or default to current.
-    ignore_patterns = load_ignore_patterns(extra_ignore_patterns, cwd)
-    ignore_spec = pathspec.PathSpec.from_lines('gitwildmatch', ignore_patterns)
-    include_spec = pathspec.PathSpec.from_lines('gitwildmatch', include_patterns)
-    allow_all = "." in include_patterns
-    output = []  # Use a list to store file names
-
-    for root, dirs, files in os.walk(cwd, topdown=True):
-        relative_path = os.path.relpath(root, cwd)
-        if relative_path == '.':
-            relative_path = ''
-
-        # Filter out ignored directories
-        dirs[:] = [d for d in dirs if not ignore_spec.match_file(os.path.join(relative_path, d))]
-
-        for file in files:
-            file_path = os.path.join(relative_path, file)
-            allowed = not ignore_spec.match_file(file_path) and (allow_all or include_spec.match_file(file_path))
-            if allowed:
-                output.append(file_path)
-
-    return "\n".join(output)  # Join with newlines
+        for relative_path, is_dir, entry in entries:
+            if not self.is_included(relative_path):
+                continue
+
+            if is_dir:
+                debug(f"Project structure (add): {relative_path}")
+                tree.append(self.tree_entry(relative_path, "directory"))
+                continue
+
+            stat = self.entry_stat(entry) if entry else self.regular_file_stat(relative_path)
+            # Skip git entries that are deleted from the work tree or are not files (i.e. submodules)
+            if not entry and not stat:
+                continue
+
+            debug(f"Project structure (add): {relative_path}")
+            tree.append(self.tree_entry(relative_path, "file"))
+            self.files.append(relative_path)
+            self.stats[relative_path] = stat
+
+        self.tree = sorted(tree, key=lambda x: x['id'])
+        # In path order, whatever order the backend lists them in, so the file blocks (and the prompt) are stable
+        self.files.sort()
+
+    def entry_stat(self, entry):
+        try:
+            st = entry.stat()
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def regular_file_stat(self, file_path):
+        try:
+            st = os.stat(os.path.join(self.cwd, file_path))
+        except OSError:
+            return None
+        if not statlib.S_ISREG(st.st_mode):
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def stat(self, file_path):
+        try:
+            st = os.stat(os.path.join(self.cwd, file_path))
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+# NOTE: we don't use the args.files here, because we want to include all non-default ignored files
+def generate_project_structure(extra_ignore_patterns=None, include_patterns=None, cwd=None, scan=None):
+    scan = scan or ProjectScan(extra_ignore_patterns, include_patterns, cwd)
+    return scan.tree
+
+def generate_project_file_contents(extra_ignore_patterns=None, include_patterns=None, cwd=None, scan=None):
+    scan = scan or ProjectScan(extra_ignore_patterns, include_patterns, cwd)
+    return "".join(generate_project_file_blocks(scan))
+
+def generate_project_file_blocks(scan):
+    """Returns the rendered block of each file in the scan (in the same order), reading only files not in the cache."""
+    cached_blocks = load_cached_file_blocks([os.path.join(scan.cwd, file_path) for file_path in scan.files])
+    blocks = [None] * len(scan.files)
+    dirty_indexes = []
+
+    for index, file_path in enumerate(scan.files):
+        stat = scan.stats.get(file_path)
+        cached = cached_blocks.get(os.path.join(scan.cwd, file_path))
+
+        # A changed size limit changes how the file is truncated
+        if stat and cached and (cached.mtime_ns, cached.size, cached.inode) == stat and cached.max_size == max_file_size(file_path):
+            debug(f"File contents (cached): {file_path}")
+            blocks[index] = cached.block
+        else:
+            dirty_indexes.append(index)
+
+    dirty_blocks = []
+
+    if dirty_indexes:
+        dirty_paths = [scan.files[index] for index in dirty_indexes]
+        # Hand out files in batches so thread pool overhead doesn't outweigh small reads.
+        # NOTE: map keeps the results in the same (stable) order as the file list
+        batches = chunked(dirty_paths, FILE_READ_BATCH_SIZE)
+        with ThreadPoolExecutor(max_workers=FILE_READ_WORKERS) as executor:
+            results = executor.map(lambda batch: [read_dirty_file_block(path, scan.cwd) for path in batch], batches)
+            results = [result for batch in results for result in batch]
+
+        for index, file_path, (block, cacheable) in zip(dirty_indexes, dirty_paths, results):
+            blocks[index] = block
+            stat = scan.stats.get(file_path)
+            if cacheable and stat:
+                dirty_blocks.append((os.path.join(scan.cwd, file_path), stat, max_file_size(file_path), block))
+
+    save_cached_file_blocks(dirty_blocks)
+    evict_cached_file_blocks(scan)
+
+    return blocks
+
+def read_dirty_file_block(file_path, cwd):
+    debug(f"File contents (add): {file_path}")
+    # NOTE: we always user version 1 here, since any newer versions will be in conversation history
+    try:
+        return read_file_block(file_path, cwd=cwd), True
+    except Exception as e:
+        # TODO: use logging here not return
+        return f"    Error reading {file_path}: {e}\n", False
+
+def load_cached_file_blocks(full_paths):
+    # The cache lives in .lin.db, so there is nothing to use until the database is initialized
+    if db_proxy.obj is None:
+        return {}
+    cached_blocks = {}
+    with db_proxy:
+        for batch in chunked(full_paths, 500):
+            cached_blocks.update({row.path: row for row in FileCache.select().where(FileCache.path.in_(batch))})
+    return cached_blocks
+
+def evict_cached_file_blocks(scan):
+    """Deletes the cached blocks of files that are not in the scan (deleted, renamed or no longer included)."""
+    if db_proxy.obj is None:
+        return
+    scanned = {os.path.join(scan.cwd, file_path) for file_path in scan.files}
+    with db_proxy:
+        stale = [path for (path,) in FileCache.select(FileCache.path).tuples() if path not in scanned]
+        for batch in chunked(stale, 500):
+            FileCache.delete().where(FileCache.path.in_(batch)).execute()
+    if stale:
+        debug(f"File cache: evicted {len(stale)} files")
+
+def save_cached_file_blocks(dirty_blocks):
+    if db_proxy.obj is None or not dirty_blocks:
+        return
+    rows = [{
+        "path": full_path,
+        "mtime_ns": mtime_ns,
+        "size": size,
+        "inode": inode,
+        "max_size": max_size,
+        "block": block
+    } for full_path, (mtime_ns, size, inode), max_size, block in dirty_blocks]
+    with db_proxy:
+        for batch in chunked(rows, 100):
+            FileCache.insert_many(batch).on_conflict_replace().execute()
+
+def generate_project_file_list(extra_ignore_patterns=None, include_patterns=None, cwd=None, scan=None):
+    scan = scan or ProjectScan(extra_ignore_patterns, include_patterns, cwd)
+    return "\n".join(scan.files)  # Join with newlines
+
+def max_file_size(file_path):
+    for pattern, max_size in MAX_FILE_SIZE_SPECS:
+        if pattern.match_file(file_path):
+            return max_size
+    return MAX_FILE_SIZE
+
+def is_text(head, final):
+    if b'\0' in head:
+        return False
+    try:
+        # NOTE: incremental, so a multi-byte character cut off at the end of the block is fine (unless it's the end of the file)
+        codecs.getincrementaldecoder('utf-8')().decode(head, final=final)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+def decode_text(data, errors='strict'):
+    # Same newline handling as reading in text mode
+    return data.decode('utf-8', errors=errors).replace('\r\n', '\n').replace('\r', '\n')
+
+def read_file_block(file_path, cwd, version=1):
+    """Renders a file block, skipping binary files and truncating files over their size limit."""
+    with open(os.path.join(cwd, file_path), 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            contents = ""
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if not is_text(mm[:FILE_SNIFF_SIZE], final=size <= FILE_SNIFF_SIZE):
+                    debug(f"File contents (skip binary): {file_path}")
+                    return f"    Skipped {file_path}: binary or non UTF-8 file ({human_format_bytes(size)})\n"
+
+                max_size = max_file_size(file_path)
+                if size > max_size:
+                    debug(f"File contents (truncate): {file_path}")
+                    cut = mm.rfind(b'\n', 0, max_size) + 1 or max_size
+                    contents = decode_text(mm[:cut], errors='ignore')
+                    contents += f"\n... (truncated, showing {human_format_bytes(cut)} of {human_format_bytes(size)})"
+                else:
+                    contents = decode_text(mm[:])
+
+    block = file_block(file_path, contents, get_language_from_extension(file_path), version)
+    return f"{block}\n"
 
 def get_file_contents(file_path, cwd, version=1):
     try:
-        with open(os.path.join(cwd, file_path), 'r', encoding='utf-8') as f:
-            contents = f.read()
-        block = file_block(file_path, contents, get_language_from_extension(file_path), version)
-        return f"{block}\n"
+        return read_file_block(file_path, cwd, version)
     except Exception as e:
         # TODO: use logging here not return
         return f"    Error reading {file_path}: {e}\n"
@@ -157,3 +462,13 @@ def human_format_number(num):
         magnitude += 1
         num /= 1000.0
     return format_number(num, magnitude)
+
+def human_format_bytes(num):
+    """Converts a byte count to a human-readable string (e.g., 512 bytes, 1.5 KB, 2.0 MB)."""
+    if num < 1024:
+        return f"{num} bytes"
+    for unit in ['KB', 'MB', 'GB']:
+        num /= 1024.0
+        if num < 1024:
+            break
+    return f"{num:.1f} {unit}"
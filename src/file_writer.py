@@ -0,0 +1,89 @@
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from .logger import debug
+from .config import FSYNC_WRITES
+
+def current_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+# Read once (at startup), since setting the umask to read it is not safe while other threads create files
+UMASK = current_umask()
+
+def fsync_directory(directory_path):
+    # So the rename itself survives a crash (not supported on all platforms, i.e. Windows)
+    try:
+        fd = os.open(directory_path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def write_file_atomically(full_path, assembled_file, fsync=FSYNC_WRITES):
+    """Writes the assembled file (a parser.BufferedFile) to a temp file next to full_path and renames it into
+       place, so the file is never seen half written. Keeps the permissions of the file it replaces.
+    """
+    directory_path = os.path.dirname(full_path) or "."
+    os.makedirs(directory_path, exist_ok=True)
+
+    try:
+        mode = os.stat(full_path).st_mode & 0o7777
+    except FileNotFoundError:
+        # Temp files are only readable by us, new files should get the usual permissions
+        mode = 0o666 & ~UMASK
+
+    fd, temp_path = tempfile.mkstemp(dir=directory_path, prefix=f".{os.path.basename(full_path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            assembled_file.write_to(f)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, full_path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+    if fsync:
+        fsync_directory(directory_path)
+
+class FileWriter:
+    """Writes assembled files on a background thread as they come in (mid stream), so streaming never waits
+       on the disk. One thread keeps the writes in order, i.e. for two versions of the same file.
+    """
+
+    def __init__(self, cwd, fsync=FSYNC_WRITES):
+        self.cwd = cwd
+        self.fsync = fsync
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="linus-writer")
+        self.pending = []
+
+    def submit(self, file_path, assembled_file):
+        full_path = os.path.join(self.cwd, file_path)
+        future = self.executor.submit(self.write, full_path, assembled_file)
+        self.pending.append((file_path, future))
+
+    def write(self, full_path, assembled_file):
+        try:
+            write_file_atomically(full_path, assembled_file, self.fsync)
+            debug(f"Wrote {full_path}")
+        finally:
+            assembled_file.close()
+
+    def wait(self):
+        """Waits for the submitted writes, returns [(file path, exception or None)] in the order they were submitted."""
+        results = []
+        for file_path, future in self.pending:
+            results.append((file_path, future.exception()))
+        self.pending = []
+        return results
+
+    def close(self):
+        self.executor.shutdown(wait=True)
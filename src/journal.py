@@ -0,0 +1,61 @@
+import time
+import uuid
+from peewee import chunked
+from .logger import debug
+from .config import JOURNAL_BATCH_SIZE, JOURNAL_BATCH_INTERVAL
+from .database import StreamJournal, db_proxy
+
+class ResponseJournal:
+    """Appends the chunks of a streamed response to the StreamJournal table as they come in (committed in
+       batches), so a crash mid response leaves what was received in .lin.db. Cleared once the response is saved.
+    """
+
+    def __init__(self, batch_size=JOURNAL_BATCH_SIZE, batch_interval=JOURNAL_BATCH_INTERVAL):
+        self.stream_id = uuid.uuid4().hex
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.sequence = 0
+        self.pending = []
+        self.last_commit = time.monotonic()
+
+    def add(self, text):
+        """Queues a chunk without committing it. Returns True once a batch is due (see flush)."""
+        self.pending.append({'stream_id': self.stream_id, 'sequence': self.sequence, 'text': text})
+        self.sequence += 1
+        return len(self.pending) >= self.batch_size or time.monotonic() - self.last_commit >= self.batch_interval
+
+    def append(self, text):
+        if self.add(text):
+            self.flush()
+
+    def flush(self):
+        # Taken up front, so chunks added while a worker thread commits this batch are kept for the next one
+        self.last_commit = time.monotonic()
+        pending, self.pending = self.pending, []
+        if db_proxy.obj is None or not pending:
+            return
+        with db_proxy:
+            for batch in chunked(pending, 100):
+                StreamJournal.insert_many(batch).execute()
+
+    def clear(self):
+        self.pending = []
+        if db_proxy.obj is None:
+            return
+        clear_interrupted_response(self.stream_id)
+
+def interrupted_responses():
+    """Returns [(stream id, text)] of the responses left in the journal (cut off by a crash), oldest first."""
+    if db_proxy.obj is None:
+        return []
+    responses = {}
+    with db_proxy:
+        query = StreamJournal.select().order_by(StreamJournal.id)
+        for row in query:
+            responses.setdefault(row.stream_id, []).append((row.sequence, row.text))
+    debug(f"Stream journal: {len(responses)} interrupted response(s)")
+    return [(stream_id, "".join(text for _, text in sorted(chunks))) for stream_id, chunks in responses.items()]
+
+def clear_interrupted_response(stream_id):
+    with db_proxy:
+        StreamJournal.delete().where(StreamJournal.stream_id == stream_id).execute()
@@ -7,6 +7,8 @@ VERBOSE_ON = False
 
 DEBUG_ON = False
 
+QUIET_ON = False
+
 console = Console(theme=ConsoleTheme)
 
 styles.STYLES["everforest-dark"] = EverforestDarkStyle
@@ -16,6 +18,8 @@ def quiet_logging():
     VERBOSE_ON = False
     global DEBUG_ON
     DEBUG_ON = False
+    global QUIET_ON
+    QUIET_ON = True
 
 def verbose_logging():
     global VERBOSE_ON
@@ -32,11 +36,17 @@ def is_debug():
 def is_verbose():
     return VERBOSE_ON
 
+def is_quiet():
+    return QUIET_ON
+
 def debug(message):
     if DEBUG_ON:
         message = f"DEBUG: {message}" if message else ""
         console.print(message, style="bold yellow")
 
+def warning(message):
+    console.print(f"WARNING: {message}", style="bold yellow")
+
 def error(message):
     console.print(f"ERROR: {message}", style="bold red")
 
@@ -1,10 +1,19 @@
 import os
+import io
 import re
+import json
+import tempfile
 import shlex
+import fnmatch
+import functools
+import threading
 from collections import defaultdict
+import pygments
 from pygments.util import ClassNotFound
-from pygments.lexers import get_lexer_for_filename, guess_lexer_for_filename
+from pygments.lexers import get_lexer_for_filename, guess_lexer_for_filename, find_lexer_class
+from pygments.lexers._mapping import LEXERS
 from .logger import debug
+from .config import LANGUAGE_CACHE_FILE, FILE_PART_SPILL_SIZE
 
 # NOTE: We must use this way to generate the placeholder wrapper so this parsing doesn't fail for this file when
 #       using this project on itself
@@ -25,13 +34,65 @@ FILES_PLACEHOLDER =         placeholder('FILE_REFERENCES')
 FILES_START_SEP =           placeholder('FILE_REFERENCES START')
 FILES_END_SEP =             placeholder('FILE_REFERENCES END')
 TERMINAL_LOGS_PLACEHOLDER = placeholder('TERMINAL_LOGS')
+FILE_CHANGES_PLACEHOLDER =  placeholder('FILE_CHANGES')
 PROJECT_SPECIFIC_GUIDE =    placeholder('PROJECT_SPECIFIC_GUIDE')
 GLOBAL_USER_GUIDE =         placeholder('GLOBAL_USER_GUIDE')
 
+class BufferedFile:
+    """The parts of one file, appended to a spooled temp file as UTF-8 (so it moves to disk once it
+       grows past spill_size), with an index of (offset, length) by part number.
+    """
+
+    COPY_SIZE = 64 * 1024
+
+    def __init__(self, spill_size=FILE_PART_SPILL_SIZE):
+        self.spill_size = spill_size
+        self.spool = tempfile.SpooledTemporaryFile(max_size=spill_size, mode='w+b')
+        self.parts = {}
+        self.size = 0
+
+    @property
+    def on_disk(self):
+        return self.size > self.spill_size
+
+    def add(self, part, data):
+        encoded = data.encode('utf-8')
+        self.spool.seek(0, os.SEEK_END)
+        # A resent part replaces the old one in the index
+        self.parts[part] = (self.spool.tell(), len(encoded))
+        self.spool.write(encoded)
+        self.size += len(encoded)
+
+    def missing_parts(self):
+        if not self.parts:
+            return []
+        return [part for part in range(1, max(self.parts) + 1) if part not in self.parts]
+
+    def write_to(self, handle):
+        """Writes the parts in order to a binary file handle, without joining them in memory."""
+        written = 0
+        for part in sorted(self.parts):
+            offset, length = self.parts[part]
+            self.spool.seek(offset)
+            while length > 0:
+                data = self.spool.read(min(length, self.COPY_SIZE))
+                handle.write(data)
+                length -= len(data)
+                written += len(data)
+        return written
+
+    def read(self):
+        content = io.BytesIO()
+        self.write_to(content)
+        return content.getvalue().decode('utf-8')
+
+    def close(self):
+        self.spool.close()
+
 class FilePartBuffer:
-    def __init__(self):
-        self.buffer = defaultdict(lambda: defaultdict(str))
-        # Remove total_parts, no longer needed
+    def __init__(self, spill_size=FILE_PART_SPILL_SIZE):
+        self.spill_size = spill_size
+        self.buffer = {} # (file_path, version) -> BufferedFile
         self.final_parts = {} # Keep track of files with a final part
 
     def add(self, file_path, part_data, current_part, no_more_parts, version):
@@ -41,22 +102,204 @@ class FilePartBuffer:
             self.final_parts[(file_path, version)] = True
         else:
             debug(f"Received part {current_part} of {file_path} (v{version})")
-            self.buffer[(file_path, version)][current_part] = part_data
+            if (file_path, version) not in self.buffer:
+                self.buffer[(file_path, version)] = BufferedFile(self.spill_size)
+            self.buffer[(file_path, version)].add(current_part, part_data)
+
+    def start(self, file_path, version):
+        """Tracks a file as in progress, even if none of its parts were received whole (i.e. the first one was cut off)."""
+        if (file_path, version) not in self.buffer:
+            self.buffer[(file_path, version)] = BufferedFile(self.spill_size)
 
     def is_complete(self, file_path, version):
-        # TODO: debug log if we are missing any parts (i.e. have 2, but not 1)
         return (file_path, version) in self.final_parts
 
-    def assemble(self, file_path, version):
+    def missing_parts(self, file_path, version):
+        buffered_file = self.buffer.get((file_path, version))
+        return buffered_file.missing_parts() if buffered_file else []
+
+    def in_progress(self):
+        """Returns [(file path, version, parts received)] of the files still waiting on parts."""
+        return [
+            (file_path, version, sorted(buffered_file.parts))
+            for (file_path, version), buffered_file in self.buffer.items()
+            if (file_path, version) not in self.final_parts
+        ]
+
+    def pop(self, file_path, version):
+        """Removes a complete file from the buffer and returns it (a BufferedFile), or None if it is not complete."""
         if not self.is_complete(file_path, version):
             return None
 
-        sorted_parts = sorted(self.buffer[(file_path, version)].items())
-        # TODO: ignore the nomoreparts (part 0)? should be empty always
-        full_content = ''.join(part_data for _, part_data in sorted_parts)
-        del self.buffer[(file_path, version)]
+        missing_parts = self.missing_parts(file_path, version)
+        if missing_parts:
+            debug(f"Missing part(s) {', '.join(map(str, missing_parts))} of {file_path} (v{version})")
+
         del self.final_parts[(file_path, version)]  # Clean up
-        return full_content
+        return self.buffer.pop((file_path, version), None) or BufferedFile(self.spill_size)
+
+class StreamParser:
+    """Incrementally splits a streamed response into events as chunks arrive, in O(total length):
+
+       ("text", text)                    plain text outside of any block
+       ("file_metadata", metadata)       a file part's metadata (see parse_metadata)
+       ("file_content", delta)           raw content of the current file part, as it streams in
+       ("part_end", (metadata, content)) a complete file part, with content as find_files would return it
+       ("snippet", (language, code))     a complete code snippet, as find_snippets would return it
+
+       finish() flushes the end of the stream, which can also emit:
+
+       ("part_incomplete", (metadata, content)) a file part that was cut off (minus its possibly partial last line)
+       ("block_incomplete", text)              a block that was cut off in its metadata
+    """
+
+    BLOCK_STARTS = (FILE_METADATA_START, SNIPPET_METADATA_START)
+    HOLD_BACK = max(len(marker) for marker in BLOCK_STARTS) - 1
+
+    def __init__(self):
+        self.state = "text"
+        self.buffer = ""
+        self.scan_from = 0
+        self.offset = 0  # Where the buffer starts in the full response
+        self.block_start = None
+        self.block_raw = []
+        self.metadata = None
+        self.metadata_raw = ""
+        self.content = []
+
+    def feed(self, delta):
+        self.buffer += delta
+        events = []
+        while getattr(self, f"step_{self.state}")(events):
+            pass
+        return events
+
+    def consume(self, end):
+        consumed = self.buffer[:end]
+        self.buffer = self.buffer[end:]
+        self.offset += end
+        self.scan_from = 0
+        if self.state != "text":
+            self.block_raw.append(consumed)
+        return consumed
+
+    def find(self, marker):
+        index = self.buffer.find(marker, self.scan_from)
+        if index == -1:
+            # Only the tail could still be the start of a marker split across chunks
+            self.scan_from = max(0, len(self.buffer) - len(marker) + 1)
+        return index
+
+    def start_block(self, marker, state):
+        self.block_start = self.offset
+        self.block_raw = []
+        self.state = state
+        self.consume(len(marker))
+
+    def end_block(self, marker):
+        self.consume(len(marker))
+        self.state = "text"
+        raw = ''.join(self.content)
+        self.content = []
+        return raw[1:] if raw.startswith('\n') else raw
+
+    def step_text(self, events):
+        index = self.buffer.find(FILE_METADATA_START, self.scan_from)
+        snippet_index = self.buffer.find(SNIPPET_METADATA_START, self.scan_from)
+        if index == -1 or (snippet_index != -1 and snippet_index < index):
+            index = snippet_index
+
+        if index == -1:
+            self.scan_from = max(0, len(self.buffer) - self.HOLD_BACK)
+            if self.scan_from > 0:
+                events.append(("text", self.consume(self.scan_from)))
+            return False
+
+        if index > 0:
+            events.append(("text", self.consume(index)))
+
+        if self.buffer.startswith(FILE_METADATA_START):
+            self.start_block(FILE_METADATA_START, "file_metadata")
+        else:
+            self.start_block(SNIPPET_METADATA_START, "snippet_metadata")
+        return True
+
+    def step_file_metadata(self, events):
+        index = self.find(FILE_METADATA_END)
+        if index == -1:
+            return False
+        metadata_str = self.metadata_raw = self.consume(index)
+        self.consume(len(FILE_METADATA_END))
+        self.metadata = parse_metadata(metadata_str[1:] if metadata_str.startswith('\n') else metadata_str)
+        self.state = "file_content"
+        events.append(("file_metadata", self.metadata))
+        return True
+
+    def step_file_content(self, events):
+        index = self.find(END_OF_FILE)
+        if index == -1:
+            safe = len(self.buffer) - len(END_OF_FILE) + 1
+            if safe > 0:
+                delta = self.consume(safe)
+                self.content.append(delta)
+                events.append(("file_content", delta))
+            return False
+
+        delta = self.consume(index)
+        self.content.append(delta)
+        events.append(("file_content", delta))
+        content = self.end_block(END_OF_FILE)
+        # NOTE: same trailing newline handling as find_files
+        events.append(("part_end", (self.metadata, re.sub(r'\n$', '', content) + '\n')))
+        return True
+
+    def step_snippet_metadata(self, events):
+        index = self.find(SNIPPET_METADATA_END)
+        if index == -1:
+            return False
+        metadata_str = self.consume(index)
+        self.consume(len(SNIPPET_METADATA_END))
+        language_match = re.search(r'\nLanguage: (.*?)\n', metadata_str)
+        self.metadata = language_match.group(1) if language_match else None
+        self.state = "snippet_content"
+        return True
+
+    def step_snippet_content(self, events):
+        index = self.find(END_OF_SNIPPET)
+        if index == -1:
+            safe = len(self.buffer) - len(END_OF_SNIPPET) + 1
+            if safe > 0:
+                self.content.append(self.consume(safe))
+            return False
+
+        self.content.append(self.consume(index))
+        code = self.end_block(END_OF_SNIPPET)
+        if self.metadata is not None:
+            events.append(("snippet", (self.metadata, code)))
+        return True
+
+    def finish(self):
+        events = []
+        if self.state == "text":
+            if self.buffer:
+                events.append(("text", self.consume(len(self.buffer))))
+        elif self.state == "file_content":
+            lines = (''.join(self.content) + self.consume(len(self.buffer))).splitlines()
+            if lines and not lines[0]:
+                lines.pop(0)  # The newline right after the metadata
+            if lines:
+                lines.pop()  # Remove the last line, in case its cut off
+            self.content = []
+            events.append(("part_incomplete", (self.metadata, re.sub(r'\n$', '', "\n".join(lines)) + '\n')))
+        elif self.state == "file_metadata":
+            self.consume(len(self.buffer))
+            events.append(("block_incomplete", ''.join(self.block_raw)))
+        else:
+            # An unfinished snippet is just shown as text
+            self.consume(len(self.buffer))
+            events.append(("text", ''.join(self.block_raw)))
+        self.state = "text"
+        return events
 
 def find_file_references(content):
     file_references = re.findall(r'@(\S+)', content)
@@ -182,6 +425,27 @@ def is_snippet(content):
 def is_terminal_log(content):
     return str(content).strip().startswith(TERMINAL_METADATA_START)
 
+# File, snippet and terminal log blocks in one compiled pattern (see scan_blocks). The shared
+# start of the markers is kept as a literal prefix, so the regex engine can skip ahead to it.
+BLOCK_START_PREFIX = placeholder('START ')[:-3]
+BLOCK_REGEX = re.compile(re.escape(BLOCK_START_PREFIX) + '(?:' + '|'.join(
+    rf'(?P<{kind}>{re.escape(start[len(BLOCK_START_PREFIX):])}(?P<{kind}_metadata>.*?){end}\n?(?P<{kind}_content>.*?){close})'
+    for kind, start, end, close in [
+        ('file', FILE_METADATA_START, FILE_METADATA_END, END_OF_FILE),
+        ('snippet', SNIPPET_METADATA_START, SNIPPET_METADATA_END, END_OF_SNIPPET),
+        ('terminal', TERMINAL_METADATA_START, TERMINAL_METADATA_END, END_OF_TERMINAL_LOG),
+    ]) + ')', flags=re.DOTALL)
+
+def scan_blocks(content):
+    """Finds every file, snippet and terminal log block in a single pass over the content.
+       Returns (kind, start, end, metadata string, block content) tuples, in order.
+    """
+    blocks = []
+    for match in BLOCK_REGEX.finditer(content):
+        kind = match.lastgroup
+        blocks.append((kind, match.start(), match.end(), match.group(f'{kind}_metadata'), match.group(f'{kind}_content')))
+    return blocks
+
 def match_code_block():
     file_regex = rf'{FILE_METADATA_START}.*?{FILE_METADATA_END}.*?{END_OF_FILE}'
     snippet_regex = rf'{SNIPPET_METADATA_START}.*?{SNIPPET_METADATA_END}.*?{END_OF_SNIPPET}'
@@ -253,42 +517,132 @@ Name: {title}
 {END_OF_TERMINAL_LOG}
 """
 
-def get_language_from_extension(filename):
-    try:
-        _, ext = os.path.splitext(filename)
-        if ext and ext != '.sh':
-            lexer = get_lexer_for_filename(filename)
-            lexer_name = lexer.name.lower()
-            if lexer_name == 'text only':
-                return "text"
-            return lexer_name
-
-        if not os.path.exists(filename):
-            if ext == '.sh':
-                return "sh"
-            else:
-                return "text"
+# Lexer filename patterns that are just an extension, everything else (i.e. Makefile, *.html.j2) is special
+SIMPLE_EXTENSION_PATTERN = re.compile(r'^\*\.[^*?\[\].]+$')
 
-        with open(filename, 'r', encoding='utf-8') as f:
-            first_line = f.readline()
+LANGUAGE_TABLE = None
+LANGUAGE_TABLE_LOCK = threading.Lock()
 
-        program = get_program_from_shebang(first_line)
+def build_language_table():
+    """Maps each extension to the language get_lexer_for_filename would pick for it, using the
+       same tie break (lexer priority, then class name), and lists the special filename patterns.
+    """
+    candidates = defaultdict(set)
+    special_patterns = []
+    for _, name, _, filenames, _ in LEXERS.values():
+        for pattern in filenames:
+            if SIMPLE_EXTENSION_PATTERN.match(pattern):
+                candidates[pattern[1:]].add(name)
+            else:
+                special_patterns.append(pattern)
+
+    extensions = {}
+    for ext, names in candidates.items():
+        if len(names) > 1:
+            # Only load the lexer classes we need to break a tie
+            lexer = max((find_lexer_class(name) for name in names), key=lambda cls: (cls.priority, cls.__name__))
+            extensions[ext] = lexer.name.lower()
+        else:
+            extensions[ext] = next(iter(names)).lower()
 
-        if program:
-            if "python" in program:
-                return "python"
-            elif program == "bash":
-                return "bash"
-            elif program == "sh":
-                return "sh"
-            # Could add more mappings here, but keep it minimal
+    return {'pygments': pygments.__version__, 'extensions': extensions, 'special_patterns': sorted(set(special_patterns))}
 
-        # Use guess_lexer_for_filename, passing filename *and* first_line
+def save_language_table(table, cache_file):
+    """Writes the table to a temp file next to cache_file and renames it into place, so it is never read half written."""
+    directory_path = os.path.dirname(cache_file)
+    os.makedirs(directory_path, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory_path, prefix=f".{os.path.basename(cache_file)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(table, f)
+        os.replace(temp_path, cache_file)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+def load_language_table(cache_file=LANGUAGE_CACHE_FILE):
+    global LANGUAGE_TABLE
+    if LANGUAGE_TABLE is not None:
+        return LANGUAGE_TABLE
+
+    # The first files are read by several worker threads at once, only one of them builds the table
+    with LANGUAGE_TABLE_LOCK:
+        if LANGUAGE_TABLE is not None:
+            return LANGUAGE_TABLE
+
+        table = None
         try:
-            lexer = guess_lexer_for_filename(filename, first_line)
-            return lexer.name.lower()
+            with open(cache_file, 'r', encoding='utf-8') as f:
+                table = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+        if not table or table.get('pygments') != pygments.__version__:
+            debug("Building language table from the pygments lexer mapping")
+            table = build_language_table()
+            try:
+                save_language_table(table, cache_file)
+            except OSError as e:
+                debug(f"Could not cache language table in {cache_file}: {e}")
+
+        table['special_regex'] = re.compile('|'.join(fnmatch.translate(pattern) for pattern in table['special_patterns']))
+        LANGUAGE_TABLE = table
+        return table
+
+@functools.lru_cache(maxsize=256)
+def language_for_special_filename(basename):
+    return get_lexer_for_filename(basename).name.lower()
+
+def language_for_filename(filename):
+    """The language for a filename with an extension, without a pygments lookup in the common case."""
+    table = load_language_table()
+    basename = os.path.basename(filename)
+
+    if table['special_regex'].match(basename):
+        try:
+            return language_for_special_filename(basename)
         except ClassNotFound:
-            return "text"  # Special case if guess_lexer can't figure it out.
+            return "text"
+
+    return table['extensions'].get(os.path.splitext(basename)[1], "text")
+
+@functools.lru_cache(maxsize=1024)
+def language_for_file_contents(full_path, mtime_ns):
+    """Detects the language of a file with no extension (or .sh) from its shebang, keyed by (path, mtime)."""
+    with open(full_path, 'r', encoding='utf-8') as f:
+        first_line = f.readline()
+
+    program = get_program_from_shebang(first_line)
+
+    if program:
+        if "python" in program:
+            return "python"
+        elif program == "bash":
+            return "bash"
+        elif program == "sh":
+            return "sh"
+        # Could add more mappings here, but keep it minimal
+
+    # Use guess_lexer_for_filename, passing filename *and* first_line
+    try:
+        lexer = guess_lexer_for_filename(full_path, first_line)
+        return lexer.name.lower()
+    except ClassNotFound:
+        return "text"  # Special case if guess_lexer can't figure it out.
+
+def get_language_from_extension(filename):
+    try:
+        _, ext = os.path.splitext(filename)
+        if ext and ext != '.sh':
+            language = language_for_filename(filename)
+            return "text" if language == 'text only' else language
+
+        try:
+            mtime_ns = os.stat(filename).st_mtime_ns
+        except FileNotFoundError:
+            return "sh" if ext == '.sh' else "text"
+
+        return language_for_file_contents(os.path.abspath(filename), mtime_ns)
 
     except ClassNotFound:
         return "text"
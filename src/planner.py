@@ -0,0 +1,85 @@
+import os
+import re
+from .logger import debug
+from .parser import find_file_references, FILE_METADATA_START
+from .file_utils import git_dirty_files
+from .database import Chat, db_proxy
+from .config import PLANNER_HISTORY_LIMIT
+from .estimator import estimate_tokens
+
+# How much each signal is worth when ranking files, a reference in the current message always wins
+REFERENCED_SCORE = 1000
+MENTIONED_SCORE = 100
+DIRTY_SCORE = 50
+
+# Added to the context when files are left out, the file tree has their paths
+SKIPPED_FILES_NOTE = "\n(Some files are only listed in the file tree, to fit the context budget. Ask me for them if needed.)\n"
+
+# Paths in file blocks, and path like words in the text (trailing punctuation is not part of the path)
+FILE_BLOCK_PATH_REGEX = re.compile(rf'{re.escape(FILE_METADATA_START)}\nPath: (.*?)\n')
+PATH_REGEX = re.compile(r'[\w./-]*\w')
+
+def recent_messages(limit=PLANNER_HISTORY_LIMIT):
+    """Returns the most recent chat messages, newest first."""
+    if db_proxy.obj is None:
+        return []
+    with db_proxy:
+        return [chat.message for chat in Chat.select().order_by(Chat.timestamp.desc()).limit(limit)]
+
+def mentioned_files(history, file_paths):
+    """Returns {file path: index of the newest message mentioning it} for the given files, going through each message once."""
+    known = set(file_paths)
+    mentions = {}
+    for index, text in enumerate(history):
+        paths = set(find_file_references(text)) | set(FILE_BLOCK_PATH_REGEX.findall(text)) | set(PATH_REGEX.findall(text))
+        for file_path in paths & known:
+            mentions.setdefault(file_path, index)
+    return mentions
+
+def rank_files(file_paths, message=None, history=None, dirty_files=None):
+    """Scores files by @ references in the current message, how recently they were mentioned in
+       the chat history and whether they have uncommitted changes.
+    """
+    history = history or []
+    dirty_files = dirty_files or set()
+    referenced = set(find_file_references(message or ""))
+    mentions = mentioned_files(history, file_paths)
+    scores = {}
+
+    for file_path in file_paths:
+        score = 0
+        if file_path in referenced or os.path.basename(file_path) in referenced:
+            score += REFERENCED_SCORE
+        mentioned_at = mentions.get(file_path)
+        if mentioned_at is not None:
+            score += MENTIONED_SCORE / (1 + mentioned_at)
+        if file_path in dirty_files:
+            score += DIRTY_SCORE
+        scores[file_path] = score
+
+    return scores
+
+def plan_file_blocks(scan, blocks, token_budget, message=None, estimate=estimate_tokens):
+    """Greedily fills the token budget with the highest ranked file blocks (ties go to the smaller file).
+       Returns the selected blocks in their original order, and the paths left out (these stay in the file tree).
+    """
+    costs = [estimate(block) for block in blocks]
+
+    if sum(costs) <= token_budget:
+        return blocks, []
+
+    scores = rank_files(scan.files, message, recent_messages(), git_dirty_files(scan.cwd))
+    ranked = sorted(range(len(blocks)), key=lambda index: (-scores[scan.files[index]], costs[index]))
+
+    # Leave room for the note about the files left out
+    remaining = token_budget - estimate(SKIPPED_FILES_NOTE)
+    selected = set()
+    for index in ranked:
+        if costs[index] <= remaining:
+            selected.add(index)
+            remaining -= costs[index]
+
+    skipped = [file_path for index, file_path in enumerate(scan.files) if index not in selected]
+    debug(f"Context planner: {len(selected)} files fit in {token_budget} tokens, {len(skipped)} in file tree only")
+
+    return [block for index, block in enumerate(blocks) if index in selected], skipped
@@ -0,0 +1,78 @@
+import threading
+import time
+from .logger import debug
+from .config import PREFETCH_INTERVAL
+
+class ContextPrefetcher:
+    """Builds the next request's context in a background thread while the user types, so it is ready when
+       they hit enter. Rebuilds every interval (or on refresh, i.e. when the watcher sees a change), which is
+       cheap when nothing changed since the request memo reuses unchanged components. fingerprint() (if given)
+       is checked again when the context is taken, so a context built from what has since changed is never used.
+    """
+
+    def __init__(self, build, interval=PREFETCH_INTERVAL, fingerprint=None):
+        self.build = build
+        self.interval = interval
+        self.fingerprint = fingerprint
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.latest = None  # (context, seconds it took to build, fingerprint it was built from)
+        self.thread = None
+
+    def start(self):
+        """Starts building contexts, if not already (i.e. when a response finishes)."""
+        if self.thread and self.thread.is_alive():
+            return
+        self.stopped.clear()
+        self.wake.clear()
+        with self.lock:
+            self.latest = None
+        self.thread = threading.Thread(target=self.run, name="linus-prefetch", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.wake.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def refresh(self):
+        self.wake.set()
+
+    def take(self):
+        """Stops prefetching and returns the latest (context, build seconds, waited seconds), the context is None if
+           there is nothing to use. Waits for a build that is in progress, so nothing runs alongside the request.
+        """
+        start = time.perf_counter()
+        self.stop()
+        waited = time.perf_counter() - start
+        with self.lock:
+            context, build_seconds, fingerprint = self.latest or (None, 0, None)
+            self.latest = None
+
+        if context is not None and self.fingerprint and fingerprint != self.fingerprint():
+            debug("Prefetched context is stale")
+            context = None
+        return context, build_seconds, waited
+
+    def run(self):
+        while not self.stopped.is_set():
+            start = time.perf_counter()
+            try:
+                # Taken before building, so a change during the build makes it stale too
+                fingerprint = self.fingerprint() if self.fingerprint else None
+                context = self.build()
+            except Exception as e:
+                # Leave it to the request to build the context (and report the error)
+                debug(f"Context prefetch failed: {e}")
+                context = None
+            build_seconds = time.perf_counter() - start
+
+            with self.lock:
+                self.latest = (context, build_seconds, fingerprint) if context is not None else None
+            debug(f"Context prefetched in {build_seconds * 1000:.0f}ms")
+
+            self.wake.wait(self.interval)
+            self.wake.clear()
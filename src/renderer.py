@@ -0,0 +1,120 @@
+import re
+import sys
+import time
+from contextlib import nullcontext
+from .config import RENDER_FPS
+from .logger import console, is_quiet, print_markdown
+
+# Fenced code blocks can have blank lines in them, so they only end at the closing fence
+FENCE_REGEX = re.compile(r' {0,3}(```|~~~)')
+
+# Markdown blocks that rich renders with a blank line before them already
+LEADING_NEWLINE_REGEX = re.compile(r'\s*([-*+] |\d+[.)] |>|\|)')
+
+class StreamRenderer:
+    """Renders streamed markdown text as it completes, at most once per frame (RENDER_FPS). Text is queued, and
+       each frame renders only the markdown blocks (paragraphs, lists, code blocks, ...) completed since the
+       last one, the rest waits for more text. In quiet mode it skips rich and writes the raw text instead.
+       Keeps track of the CPU time spent rendering.
+    """
+
+    def __init__(self, status_message, fps=RENDER_FPS, quiet=None):
+        self.quiet = is_quiet() if quiet is None else quiet
+        self.frame_interval = 1 / fps
+        self.last_frame = 0
+        self.status_message = status_message
+        self.spinner = nullcontext() if self.quiet else console.status(status_message, spinner="point")
+        self.live_status = None
+        self.pending = ""
+        self.scanned = 0 # How much of pending has been checked for completed blocks
+        self.completed = 0 # Where the completed blocks in pending end
+        self.in_fence = False
+        self.separate = False # If the next text section needs a blank line before it
+        self.cpu_seconds = 0.0
+        self.frames = 0
+
+    def __enter__(self):
+        self.live_status = self.spinner.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.spinner.__exit__(*exc_info)
+
+    def stop(self):
+        if self.live_status:
+            self.live_status.stop()
+
+    def status(self, message):
+        # Only touch the spinner when the message changes, not on every chunk
+        if self.live_status and message != self.status_message:
+            self.status_message = message
+            self.live_status.update(message)
+
+    def text(self, delta):
+        self.pending += delta
+        if self.quiet:
+            self.completed = len(self.pending)
+        else:
+            self.scan()
+
+        if self.completed and time.monotonic() - self.last_frame >= self.frame_interval:
+            self.render_completed()
+
+    def scan(self):
+        """Finds the end of the last completed block in pending (a blank line outside of a code block)."""
+        while (line_end := self.pending.find("\n", self.scanned)) != -1:
+            line = self.pending[self.scanned:line_end]
+            self.scanned = line_end + 1
+            if FENCE_REGEX.match(line):
+                self.in_fence = not self.in_fence
+            elif not self.in_fence and not line.strip():
+                self.completed = self.scanned
+
+    def render_completed(self):
+        section = self.pending[:self.completed]
+        self.pending = self.pending[self.completed:]
+        self.scanned -= self.completed
+        self.completed = 0
+        self.render_text(section)
+        self.last_frame = time.monotonic()
+
+    def render_text(self, section, end=""):
+        if self.quiet:
+            self.write(section + end)
+            return
+
+        section = section.strip("\n")
+        if not section:
+            return
+        if self.separate and not LEADING_NEWLINE_REGEX.match(section):
+            self.render(console.print)
+        self.render(print_markdown, section, end=end)
+        self.separate = not end
+
+    def flush(self, end=""):
+        """Renders all the queued text, i.e. before a block or at the end of the stream."""
+        section = self.pending
+        self.pending = ""
+        self.scanned = self.completed = 0
+        self.in_fence = False
+        self.render_text(section, end)
+        self.separate = False
+
+    def markdown(self, block, end="\n"):
+        """Renders a whole markdown block (i.e. a code snippet or file), after any queued text."""
+        if self.quiet:
+            self.write(block + end)
+        else:
+            self.render(print_markdown, block, end=end)
+        self.separate = False
+
+    def write(self, text):
+        self.render(sys.stdout.write, text)
+        self.render(sys.stdout.flush)
+
+    def render(self, fn, *args, **kwargs):
+        # The thread's CPU time, so waiting on the terminal and other threads' work are left out
+        start = time.thread_time()
+        fn(*args, **kwargs)
+        self.cpu_seconds += time.thread_time() - start
+        self.frames += 1
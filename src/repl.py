@@ -1,15 +1,14 @@
 import os
-import re
+import time
 from prompt_toolkit.styles import Style
 from prompt_toolkit import PromptSession
 from prompt_toolkit.key_binding import KeyBindings
 from prompt_toolkit.keys import Keys
 from prompt_toolkit.completion import FuzzyCompleter, Completer, Completion
 from prompt_toolkit.shortcuts import CompleteStyle
-import pathspec
 
 # TODO: rename this to prompt.py or something more appropriate? (chat is technically the true repl)
-from .config import DEFAULT_IGNORE_PATTERNS
+from .file_utils import ProjectScan
 
 key_bindings = KeyBindings()
 
@@ -22,21 +21,27 @@ def _(event):
     event.current_buffer.history_forward()
 
 class FilePathCompleter(Completer):
-    def __init__(self, cwd=os.getcwd()):
-        self.ignore_patterns = self.load_ignore_patterns()
-        self.spec = pathspec.PathSpec.from_lines('gitwildmatch', self.ignore_patterns)
+    """Completes @ file references from latest_scan() (the session's newest ProjectScan, if any), otherwise from
+       its own scan of the project, which is reused for SCAN_TTL seconds instead of being taken on every keystroke.
+    """
+
+    SCAN_TTL = 5.0
+
+    def __init__(self, cwd=os.getcwd(), latest_scan=None):
         self.cwd = cwd
+        self.latest_scan = latest_scan
+        self.scan = None
+        self.scanned_at = 0.0
 
-    def load_ignore_patterns(self):
-        ignore_patterns = [] + DEFAULT_IGNORE_PATTERNS
-        for ignore_file in ['.gitignore', '.linignore']:
-            if os.path.exists(ignore_file):
-                with open(ignore_file, encoding='utf-8') as f:
-                    ignore_patterns.extend([line.strip() for line in f if line.strip() and not line.startswith('#')])
-        return ignore_patterns
+    def project_scan(self):
+        scan = self.latest_scan() if self.latest_scan else None
+        if scan:
+            return scan
 
-    def is_ignored(self, path):
-        return self.spec.match_file(path)
+        if self.scan is None or time.monotonic() - self.scanned_at > self.SCAN_TTL:
+            self.scan = ProjectScan(include_patterns=["."], cwd=self.cwd)
+            self.scanned_at = time.monotonic()
+        return self.scan
 
     def get_completions(self, document, __complete_event__):
         word_before_cursor = document.get_word_before_cursor()
@@ -45,13 +50,9 @@ class FilePathCompleter(Completer):
         if '@' not in word_before_cursor:
             return
 
-        for root, dirs, items in os.walk(self.cwd, topdown=True):
-            # Filter out ignored directories
-            dirs[:] = [d for d in dirs if not self.is_ignored(os.path.join(root, d))]
-            for item in items:
-                path = re.sub(r'^\./', '', os.path.relpath(os.path.join(root, item)))
-                if not self.is_ignored(path) and item.startswith(word_before_cursor[1:]):  # Skip the '@' character
-                    yield Completion(path, start_position=-len(word_before_cursor) + 1)
+        for path in self.project_scan().files:
+            if os.path.basename(path).startswith(word_before_cursor[1:]):  # Skip the '@' character
+                yield Completion(path, start_position=-len(word_before_cursor) + 1)
 
 
 class CommandCompleter(Completer):
@@ -68,10 +69,10 @@ class CommandCompleter(Completer):
             if command.startswith(word_before_cursor[1:]):
                 yield Completion(command, start_position=-len(word_before_cursor) + 1)
 
-def create_prompt_session(cwd):
+def create_prompt_session(cwd, latest_scan=None):
     prompt_style = Style.from_dict({'': '#8CB9B3 bold'})
 
-    file_completer = FuzzyCompleter(FilePathCompleter(cwd))
+    file_completer = FuzzyCompleter(FilePathCompleter(cwd, latest_scan))
     command_completer = FuzzyCompleter(CommandCompleter(['compact', 'reset', 'exit', 'continue']))
 
     # Combine completers
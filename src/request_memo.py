@@ -0,0 +1,39 @@
+from .logger import debug
+
+def files_fingerprint(scan):
+    """The included files and their stats, any edit changes the mtime or size (and a replace the inode)."""
+    return tuple((file_path, scan.stats.get(file_path)) for file_path in scan.files)
+
+def tree_fingerprint(scan):
+    return tuple((entry['id'], entry['type']) for entry in scan.tree)
+
+class RequestMemo:
+    """Keeps the last built value of each request component (i.e. the file blocks, project context or terminal
+       logs) with a fingerprint of what it was built from, so it is only built again when the fingerprint changes.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.request_hits = 0
+        self.request_misses = 0
+
+    def start_request(self):
+        self.request_hits = 0
+        self.request_misses = 0
+
+    def get(self, component, fingerprint, build):
+        entry = self.entries.get(component)
+        if entry is not None and entry[0] == fingerprint:
+            debug(f"Request memo (hit): {component}")
+            self.hits += 1
+            self.request_hits += 1
+            return entry[1]
+
+        debug(f"Request memo (miss): {component}")
+        self.misses += 1
+        self.request_misses += 1
+        value = build()
+        self.entries[component] = (fingerprint, value)
+        return value
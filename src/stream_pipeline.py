@@ -0,0 +1,55 @@
+import asyncio
+import time
+from .config import STREAM_QUEUE_SIZE
+
+# Marks the end of a stage's output
+DONE = object()
+
+async def run_pipeline(stream, parse, render, queue_size=STREAM_QUEUE_SIZE):
+    """Runs an async stream through separate receive, parse and render stages, connected by bounded queues.
+       parse(chunk) returns a list of events and should be cheap, render(events) may be slow (i.e. markdown and
+       diffs) so it runs in a worker thread, with the events that queued up while it was busy as one batch.
+       A full queue holds up the stage before it, so a slow renderer slows down reading the stream
+       instead of buffering all of it. Returns the time to the first render and the total time (in seconds).
+    """
+    chunks = asyncio.Queue(queue_size)
+    events = asyncio.Queue(queue_size)
+    timings = {'first_render': None, 'total': None}
+    start = time.perf_counter()
+
+    async def receive():
+        async for chunk in stream:
+            await chunks.put(chunk)
+        await chunks.put(DONE)
+
+    async def parse_chunks():
+        while (chunk := await chunks.get()) is not DONE:
+            for event in parse(chunk):
+                await events.put(event)
+        await events.put(DONE)
+
+    async def render_events():
+        done = False
+        while not done:
+            batch = [await events.get()]
+            while batch[-1] is not DONE and not events.empty():
+                batch.append(events.get_nowait())
+            done = batch[-1] is DONE
+            if done:
+                batch.pop()
+            if batch:
+                await asyncio.to_thread(render, batch)
+                if timings['first_render'] is None:
+                    timings['first_render'] = time.perf_counter() - start
+
+    try:
+        async with asyncio.TaskGroup() as group:
+            group.create_task(receive())
+            group.create_task(parse_chunks())
+            group.create_task(render_events())
+    except ExceptionGroup as errors:
+        # The other stages are cancelled, report what went wrong like a single threaded loop would
+        raise errors.exceptions[0]
+
+    timings['total'] = time.perf_counter() - start
+    return timings
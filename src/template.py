@@ -0,0 +1,78 @@
+import os
+import re
+from . import parser
+
+# Placeholders filled in when rendering, any other {{{...}}} marker in a template is kept as is
+TEMPLATE_PLACEHOLDERS = [
+    parser.FILE_TREE_PLACEHOLDER,
+    parser.FILES_PLACEHOLDER,
+    parser.TERMINAL_LOGS_PLACEHOLDER,
+    parser.FILE_CHANGES_PLACEHOLDER,
+    parser.PROJECT_SPECIFIC_GUIDE,
+    parser.GLOBAL_USER_GUIDE,
+]
+
+PLACEHOLDER_REGEX = re.compile('(' + '|'.join(re.escape(name) for name in TEMPLATE_PLACEHOLDERS) + ')')
+
+# {path: ((mtime_ns, size), text, Template or None)}, Templates are parsed on first use
+FILE_CACHE = {}
+
+class Template:
+    """A template parsed into literal and placeholder segments, so rendering is a single join."""
+
+    def __init__(self, text):
+        # re.split keeps the placeholders, so every odd segment is a placeholder and every even one a literal
+        self.segments = PLACEHOLDER_REGEX.split(text)
+
+    @property
+    def placeholders(self):
+        return self.segments[1::2]
+
+    def render(self, values):
+        """Fills in each placeholder from values ({placeholder: text}), placeholders missing from values are left empty."""
+        segments = self.segments[:]
+        segments[1::2] = [values.get(name, '') for name in self.placeholders]
+        return "".join(segments)
+
+def file_fingerprint(path):
+    """The (mtime_ns, size) a file is cached by, or None if it doesn't exist."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+def cached_entry(path):
+    key = file_fingerprint(path)
+    if key is None:
+        FILE_CACHE.pop(path, None)
+        return None
+
+    entry = FILE_CACHE.get(path)
+    if entry is None or entry[0] != key:
+        with open(path, 'r', encoding='utf-8') as f:
+            entry = (key, f.read(), None)
+        FILE_CACHE[path] = entry
+
+    return entry
+
+def read_cached_file(path):
+    """Returns the file's text (None if it doesn't exist), only read again when its mtime or size changes."""
+    entry = cached_entry(path)
+    return entry[1] if entry else None
+
+def load_template(path):
+    """Returns the parsed Template for a file, only parsed again when its mtime or size changes."""
+    entry = cached_entry(path)
+    if entry is None:
+        raise FileNotFoundError(path)
+
+    key, text, template = entry
+    if template is None:
+        template = Template(text)
+        FILE_CACHE[path] = (key, text, template)
+
+    return template
+
+def render_template(path, values):
+    return load_template(path).render(values)
@@ -32,14 +32,38 @@ def get_current_tmux_pane_id():
     except KeyError:
         return None
 
+def get_tmux_session_name():
+    command = ["tmux", "display-message", "-p", "#S"]
+    return subprocess.run(command, capture_output=True, text=True, check=True).stdout.strip()
+
+def get_tmux_fingerprint():
+    """A cheap stand in for the tmux logs (one list-panes call instead of a capture per pane).
+       Output updates the window activity time, history size or cursor, so the logs only changed if this did.
+    """
+    current_pane_id = get_current_tmux_pane_id()
+    if not current_pane_id:
+        return None
+
+    try:
+        session_name = get_tmux_session_name()
+        command = [
+            "tmux", "list-panes", "-s", "-t", session_name, "-F",
+            "#D #{window_activity} #{history_size} #{cursor_x} #{cursor_y} #W-#P-#T"
+        ]
+        result = subprocess.run(command, capture_output=True, text=True, check=True)
+    except subprocess.CalledProcessError:
+        # Never matches, so the logs are captured again (and report the error)
+        return object()
+
+    return (current_pane_id, session_name, result.stdout)
+
 def get_tmux_logs():
     current_pane_id = get_current_tmux_pane_id()
     if not current_pane_id:
         return ""
 
     try:
-        command = ["tmux", "display-message", "-p", "#S"]
-        session_name = subprocess.run(command, capture_output=True, text=True, check=True).stdout.strip()
+        session_name = get_tmux_session_name()
     except subprocess.CalledProcessError as e:
         error(f"Error getting tmux session name: {e}")
         return f"Error getting tmux session name: {e}\n"
@@ -0,0 +1,106 @@
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from peewee import chunked
+from .logger import debug
+from .config import TOKEN_COUNT_WORKERS
+from .database import TokenCount, db_proxy
+from .estimator import estimate_tokens
+
+def content_hash(content):
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def read_file(cwd, file_path):
+    with open(os.path.join(cwd, file_path), 'r', encoding='utf-8') as f:
+        return f.read()
+
+def load_cached_token_counts(hashes, model):
+    if db_proxy.obj is None or not hashes:
+        return {}
+    counts = {}
+    with db_proxy:
+        for batch in chunked(list(hashes), 500):
+            query = TokenCount.select().where((TokenCount.model == model) & (TokenCount.content_hash.in_(batch)))
+            counts.update({row.content_hash: row.tokens for row in query})
+    return counts
+
+def save_token_counts(counts, model):
+    if db_proxy.obj is None or not counts:
+        return
+    rows = [{"content_hash": digest, "model": model, "tokens": tokens} for digest, tokens in counts.items()]
+    with db_proxy:
+        for batch in chunked(rows, 100):
+            TokenCount.insert_many(batch).on_conflict_replace().execute()
+
+def count_file_tokens(client, model, cwd, file_paths, workers=TOKEN_COUNT_WORKERS):
+    """Counts the tokens of each file, only asking the API about content it has not counted before.
+       Returns ({file path: tokens}, {file path: error}).
+    """
+    contents = {}
+    errors = {}
+    for file_path in file_paths:
+        try:
+            contents[file_path] = read_file(cwd, file_path)
+        except Exception as e:
+            errors[file_path] = e
+
+    hashes = {file_path: content_hash(content) for file_path, content in contents.items()}
+    cached = load_cached_token_counts(set(hashes.values()), model)
+
+    # One request per unique uncounted content (duplicate files are only counted once)
+    uncounted = {}
+    for file_path, digest in hashes.items():
+        if digest not in cached:
+            uncounted.setdefault(digest, contents[file_path])
+
+    debug(f"Token counts: {len(hashes) - len(uncounted)} cached, {len(uncounted)} to count")
+
+    def count(digest):
+        try:
+            response = client.models.count_tokens(model=model, contents=uncounted[digest])
+            return digest, response.total_tokens or 0, None
+        except Exception as e:
+            return digest, None, e
+
+    counted = {}
+    failed = {}
+    if uncounted:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for digest, tokens, error in executor.map(count, uncounted):
+                if error:
+                    failed[digest] = error
+                else:
+                    counted[digest] = tokens
+
+    save_token_counts(counted, model)
+
+    all_counts = {**cached, **counted}
+    counts = {}
+    for file_path, digest in hashes.items():
+        if digest in all_counts:
+            counts[file_path] = all_counts[digest]
+        else:
+            errors[file_path] = failed[digest]
+
+    return counts, errors
+
+def estimate_file_tokens(cwd, file_paths):
+    """Estimates the tokens of each file offline. Returns ({file path: tokens}, {file path: error})."""
+    counts = {}
+    errors = {}
+    for file_path in file_paths:
+        try:
+            counts[file_path] = estimate_tokens(read_file(cwd, file_path))
+        except Exception as e:
+            errors[file_path] = e
+    return counts, errors
+
+def directory_totals(counts):
+    """Sums file token counts into every parent directory."""
+    totals = {}
+    for file_path, tokens in counts.items():
+        directory = os.path.dirname(file_path)
+        while directory:
+            totals[directory] = totals.get(directory, 0) + tokens
+            directory = os.path.dirname(directory)
+    return totals
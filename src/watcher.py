@@ -0,0 +1,152 @@
+import os
+import threading
+from .logger import debug
+from .file_utils import ProjectScan, IgnoreSpec, load_ignore_patterns, generate_project_file_blocks
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+POLL_INTERVAL = 2.0
+DEBOUNCE_INTERVAL = 0.2
+
+# NOTE: opened/closed events are skipped, otherwise reading files during a refresh would trigger another refresh
+CHANGE_EVENT_TYPES = ('created', 'deleted', 'modified', 'moved')
+
+class ProjectEventHandler(FileSystemEventHandler):
+    def __init__(self, watcher):
+        super().__init__()
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        if event.event_type not in CHANGE_EVENT_TYPES:
+            return
+        # A directory is modified when an entry in it is created or deleted, which has its own event
+        if event.is_directory and event.event_type == 'modified':
+            return
+        for path in [getattr(event, 'src_path', None), getattr(event, 'dest_path', None)]:
+            if path and self.watcher.is_relevant(os.fsdecode(path)):
+                self.watcher.mark_dirty()
+                return
+
+class ProjectWatcher:
+    """Keeps the project scan and rendered file blocks current in the background, so sending a
+       message only has to serialize them. Uses watchdog when installed, otherwise polls the project.
+    """
+
+    def __init__(self, extra_ignore_patterns=None, include_patterns=None, cwd=None, poll_interval=POLL_INTERVAL):
+        self.extra_ignore_patterns = extra_ignore_patterns
+        self.include_patterns = include_patterns
+        self.cwd = cwd or os.getcwd()
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.dirty = threading.Event()
+        self.stopped = threading.Event()
+        self.current = None  # (scan, file blocks)
+        # Until the first scan, i.e. for our own database writes during it
+        self.ignore_spec = IgnoreSpec.from_lines('gitwildmatch', load_ignore_patterns(extra_ignore_patterns, self.cwd))
+        self.on_refresh = None  # Called after publishing a new snapshot
+        self.observer = None
+        self.thread = None
+
+    @property
+    def polling(self):
+        return self.observer is None
+
+    def start(self):
+        if Observer is not None:
+            self.observer = Observer()
+            self.observer.schedule(ProjectEventHandler(self), self.cwd, recursive=True)
+            self.observer.daemon = True
+            self.observer.start()
+            debug(f"Watching project with watchdog: {self.cwd}")
+        else:
+            debug(f"Watching project by polling every {self.poll_interval}s: {self.cwd}")
+
+        self.dirty.set()  # Build the first snapshot in the background
+        self.thread = threading.Thread(target=self.run, name="linus-watcher", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.dirty.set()
+        if self.observer:
+            self.observer.stop()
+            self.observer.join()
+        if self.thread:
+            self.thread.join()
+
+    def is_relevant(self, full_path):
+        relative_path = os.path.relpath(full_path, self.cwd)
+        with self.lock:
+            scan = self.current[0] if self.current else None
+        # Events for ignored paths (like .lin.db, which we write to ourselves) never dirty the snapshot
+        ignore_spec = scan.ignore_spec if scan else self.ignore_spec
+        return not ignore_spec.match_file(relative_path)
+
+    def mark_dirty(self):
+        with self.lock:
+            self.current = self.current and (self.current[0], None)
+        self.dirty.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            changed = self.dirty.wait(None if not self.polling else self.poll_interval)
+            if self.stopped.is_set():
+                break
+
+            if changed:
+                self.settle()
+                self.refresh()
+            elif self.polling:
+                self.poll()
+
+    def settle(self):
+        # Let bursts of events (i.e. a git checkout) settle before rescanning
+        while self.dirty.is_set() and not self.stopped.is_set():
+            self.dirty.clear()
+            self.stopped.wait(DEBOUNCE_INTERVAL)
+
+    def poll(self):
+        scan = ProjectScan(self.extra_ignore_patterns, self.include_patterns, self.cwd)
+        with self.lock:
+            current_scan = self.current[0] if self.current else None
+        if current_scan is None or scan.tree != current_scan.tree or scan.stats != current_scan.stats:
+            debug("Project watcher (poll): changes found")
+            self.refresh(scan)
+
+    def refresh(self, scan=None):
+        self.dirty.clear()
+        scan = scan or ProjectScan(self.extra_ignore_patterns, self.include_patterns, self.cwd)
+        blocks = generate_project_file_blocks(scan)
+        with self.lock:
+            # Only publish if nothing changed while we were building
+            published = not self.dirty.is_set()
+            if published:
+                self.current = (scan, blocks)
+        debug(f"Project watcher: refreshed {len(scan.files)} files")
+        if published and self.on_refresh:
+            self.on_refresh()
+
+    def latest_scan(self):
+        """Returns the newest scan, even if a change since has not been scanned yet (or None before the first)."""
+        with self.lock:
+            return self.current[0] if self.current else None
+
+    def snapshot(self):
+        """Returns the current (scan, file blocks), or None if it is stale or not built yet."""
+        with self.lock:
+            current = self.current
+        if not current or current[1] is None:
+            return None
+
+        scan, blocks = current
+
+        # Polling can lag behind edits, so double check the included files have not changed on disk
+        if self.polling and any(scan.stat(path) != stat for path, stat in scan.stats.items()):
+            return None
+
+        return scan, blocks
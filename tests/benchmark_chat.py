@@ -0,0 +1,135 @@
+"""Benchmarks for rendering the chat history recap, prompt templates and building request contents. Run with `bin/bench`, not part of the test suite."""
+import os
+import re
+import sys
+import time
+import tempfile
+from unittest.mock import patch
+
+# Make sure the src directory is in the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src import chat, parser, database
+from src.config import CONTEXT_PROMPT_FILE
+from src.template import render_template
+from src.request_memo import RequestMemo
+
+MESSAGE_COUNT = 5000
+
+def synthetic_message(index):
+    text = f"Message {index}: here is what changed and why. " * 20 + "\n\n"
+    if index % 4 == 0:
+        return text
+    if index % 4 == 1:
+        return text + parser.snippet_block(f"bin/test --case {index}", "sh") + "\nRun that."
+    content = "def handler(event):\n    return event['value'] * 2\n" * 30
+    files = parser.file_block(f"src/module_{index % 50}.py", content, language="python")
+    files += parser.file_block(f"src/other_{index % 7}.js", content, language="javascript", version=2)
+    return text + files + parser.snippet_block("bin/test", "sh") + "\nThat should do it."
+
+def create_history(cwd, message_count=MESSAGE_COUNT):
+    """A .lin.db with message_count chats, alternating between the user and the partner."""
+    database.initialize_database(cwd)
+    users = [database.User.get_or_create(name=name)[0] for name in ["user", "linus"]]
+    rows = [{'user': users[index % 2], 'message': synthetic_message(index)} for index in range(message_count)]
+    with database.db_proxy.atomic():
+        for batch in range(0, len(rows), 500):
+            database.Chat.insert_many(rows[batch:batch + 500]).execute()
+
+def regex_recap_message(message):
+    # The previous print_recap: find_files, then two re.sub passes over the message per file found
+    for file_path, version, content, _, _, _ in parser.find_files(message):
+        language = parser.get_language_from_extension(file_path)
+        replaced_content = content.replace("\\", "\\\\")
+        suffix = " (EMPTY)" if not replaced_content else ""
+        message = re.sub(
+            parser.match_file(file_path),
+            rf'#### {file_path} (v{version}){suffix}\n\n```{language}\n{replaced_content}\n```',
+            message,
+            flags=re.DOTALL,
+            count=1)
+        message = re.sub(parser.match_file(file_path), '', message, flags=re.DOTALL)
+
+    return re.sub(parser.match_snippet(), r'#### \1\n\n```\1\n\2\n```', message, flags=re.DOTALL)
+
+def load_messages():
+    with database.db_proxy:
+        return [chat.message.strip() for chat in database.Chat.select().join(database.User).order_by(database.Chat.timestamp)]
+
+def bench_recap(cwd):
+    messages = load_messages()
+    print(f"rebuilding the recap of {len(messages)} messages")
+    timings = {}
+    results = {}
+    for name, fn in [("regex substitutions", regex_recap_message), ("block scanner", chat.recap_message)]:
+        start = time.perf_counter()
+        results[name] = [fn(message) for message in messages]
+        timings[name] = time.perf_counter() - start
+        print(f"  {name}: {timings[name]:.3f}s")
+    assert results["regex substitutions"] == results["block scanner"]
+    print(f"  speedup: {timings['regex substitutions'] / timings['block scanner']:.1f}x")
+
+    start = time.perf_counter()
+    with patch('src.chat.print_markdown'), patch('src.chat.print', create=True):
+        chat.print_recap()
+    print(f"  print_recap (without markdown rendering): {time.perf_counter() - start:.3f}s")
+
+def replace_context_prompt(project_structure, project_files):
+    # The previous render_context_prompt: read the template, then a copy of the whole prompt per replace
+    with open(CONTEXT_PROMPT_FILE, 'r', encoding='utf-8') as f:
+        prompt = f.read()
+    prompt = prompt.replace(parser.FILE_TREE_PLACEHOLDER, project_structure)
+    return prompt.replace(parser.FILES_PLACEHOLDER, project_files)
+
+def bench_templates(iterations=200):
+    project_files = "".join(
+        parser.file_block(f"src/module_{index}.py", "def handler(event):\n    return event['value'] * 2\n" * 100, language="python")
+        for index in range(100))
+    project_structure = '["src",[' + ",".join(f'"module_{index}.py"' for index in range(100)) + ']]'
+    print(f"rendering the context prompt with {len(project_files) // 1024}KB of files {iterations} times")
+
+    values = {parser.FILE_TREE_PLACEHOLDER: project_structure, parser.FILES_PLACEHOLDER: project_files}
+    timings = {}
+    for name, fn in [
+        ("read and replace", lambda: replace_context_prompt(project_structure, project_files)),
+        ("cached template", lambda: render_template(CONTEXT_PROMPT_FILE, values)),
+    ]:
+        start = time.perf_counter()
+        for _ in range(iterations):
+            result = fn()
+        timings[name] = time.perf_counter() - start
+        print(f"  {name}: {timings[name] * 1000 / iterations:.3f}ms per render")
+    assert result == replace_context_prompt(project_structure, project_files)
+    print(f"  speedup: {timings['read and replace'] / timings['cached template']:.1f}x")
+
+def bench_request_contents(cwd, file_count=2000, iterations=10):
+    for index in range(file_count):
+        os.makedirs(os.path.join(cwd, f"src/package_{index % 20}"), exist_ok=True)
+        with open(os.path.join(cwd, f"src/package_{index % 20}/module_{index}.py"), 'w', encoding='utf-8') as f:
+            f.write("def handler(event):\n    return event['value'] * 2\n" * 20)
+    database.initialize_database(cwd)
+    print(f"building the contents of a request for {file_count} unchanged files {iterations} times")
+
+    timings = {}
+    for name in ["rebuilt", "memoized"]:
+        state = chat.create_session_state(cwd=cwd, include_patterns=["."], request_layout="stable")
+        chat.ai_request_contents("Warm up", state)
+        start = time.perf_counter()
+        for _ in range(iterations):
+            if name == "rebuilt":
+                state['request_memo'] = RequestMemo()
+            chat.ai_request_contents("Hello", state)
+        timings[name] = time.perf_counter() - start
+        print(f"  {name}: {timings[name] * 1000 / iterations:.1f}ms per request")
+    print(f"  speedup: {timings['rebuilt'] / timings['memoized']:.1f}x")
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as cwd:
+        bench_request_contents(cwd)
+
+    bench_templates()
+
+    # Language detection is the same for both, and slow enough on its own to hide the difference
+    with tempfile.TemporaryDirectory() as cwd, patch('src.parser.get_language_from_extension', return_value="python"):
+        create_history(cwd)
+        bench_recap(cwd)
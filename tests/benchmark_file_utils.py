@@ -0,0 +1,93 @@
+"""Benchmarks for building the project file context. Run with `bin/bench`, not part of the test suite."""
+import os
+import sys
+import subprocess
+import time
+import tempfile
+from unittest.mock import patch
+
+# Make sure the src directory is in the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.file_utils import ProjectScan, generate_project_file_contents, get_file_contents
+
+FILE_COUNT = 10000
+FILES_PER_DIR = 100
+
+def create_synthetic_project(root, file_count=FILE_COUNT):
+    line = "def function_{index}(value):\n    return value * {index}  # padding padding padding\n"
+    for index in range(file_count):
+        directory = os.path.join(root, f"pkg_{index // FILES_PER_DIR}")
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"module_{index}.py"), 'w', encoding='utf-8') as f:
+            f.write(line.format(index=index) * 20)
+
+def drop_page_cache(scan):
+    """Evicts the project files from the page cache (no root needed), returns False if unsupported."""
+    if not hasattr(os, 'posix_fadvise'):
+        return False
+    for file_path in scan.files:
+        fd = os.open(os.path.join(scan.cwd, file_path), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    return True
+
+def sequential_file_contents(scan):
+    # The previous implementation: one file after another, appending to a string
+    output = ""
+    for file_path in scan.files:
+        output += get_file_contents(file_path, cwd=scan.cwd)
+    return output
+
+def thread_pool_file_contents(scan):
+    return generate_project_file_contents(scan=scan)
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+def bench_file_contents(scan):
+    print(f"generate_project_file_contents ({len(scan.files)} files)")
+    for cache in ["cold", "warm"]:
+        timings = {}
+        for name, fn in [("sequential", sequential_file_contents), ("thread pool", thread_pool_file_contents)]:
+            if cache == "cold" and not drop_page_cache(scan):
+                print("  (cold page cache not supported on this platform)")
+                break
+            if cache == "warm":
+                fn(scan)  # Warm up the page cache first
+            timings[name], _ = timed(fn, scan)
+        if timings:
+            speedup = timings["sequential"] / timings["thread pool"]
+            print(f"  {cache:>4}: sequential {timings['sequential']:.3f}s, "
+                  f"thread pool {timings['thread pool']:.3f}s ({speedup:.1f}x)")
+
+def bench_scan_backends(root):
+    subprocess.run(["git", "init", "-q"], cwd=root, check=True)
+    subprocess.run(["git", "add", "-A"], cwd=root, check=True)
+
+    print(f"ProjectScan backends ({FILE_COUNT} files)")
+    timings = {}
+    for name, use_git in [("walk", False), ("git", True)]:
+        ProjectScan(include_patterns=["."], cwd=root, use_git=use_git)  # Warm up
+        timings[name] = min(timed(ProjectScan, None, ["."], root, use_git)[0] for _ in range(3))
+    speedup = timings["walk"] / timings["git"]
+    print(f"  walk {timings['walk']:.3f}s, git index {timings['git']:.3f}s ({speedup:.1f}x)")
+
+def main():
+    with tempfile.TemporaryDirectory() as root:
+        create_synthetic_project(root)
+        scan = ProjectScan(include_patterns=["."], cwd=root)
+
+        # NOTE: pygments language detection is cpu bound and would drown out the i/o we want to measure
+        with patch('src.file_utils.get_language_from_extension', return_value="python"):
+            bench_file_contents(scan)
+
+        bench_scan_backends(root)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Benchmarks for parsing streamed responses. Run with `bin/bench`, not part of the test suite."""
+import os
+import re
+import sys
+import time
+
+# Make sure the src directory is in the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from pygments.lexers import get_lexer_for_filename
+from src import parser
+
+RESPONSE_SIZE = 1024 * 1024
+# Smaller chunks make the regex rescan take minutes on 1MB
+CHUNK_SIZES = [1024, 4096, 16384]
+
+def create_synthetic_response(file_count, size=RESPONSE_SIZE):
+    """A response of roughly `size` characters: some prose, then `file_count` files and a snippet."""
+    line = "def function(value):\n    return value * 2  # padding padding padding padding\n"
+    file_size = size // file_count
+    blocks = ["Here is the plan, then the files.\n\n"]
+    for index in range(file_count):
+        blocks.append(parser.file_block(f"src/module_{index}.py", line * (file_size // len(line)), language="python"))
+        blocks.append(f"\nUpdated module {index}.\n")
+    blocks.append(parser.snippet_block("bin/test", "sh"))
+    return "".join(blocks)
+
+def chunked(response, chunk_size):
+    return [response[index:index + chunk_size] for index in range(0, len(response), chunk_size)]
+
+def regex_rescan(chunks):
+    # The previous process_request_stream: rescan the whole queued text for blocks on every chunk
+    parts = []
+    queued_response_text = ""
+    for chunk in chunks:
+        queued_response_text += chunk
+        parser.find_in_progress_file(queued_response_text)
+        if not re.search(parser.match_code_block(), queued_response_text, flags=re.DOTALL):
+            continue
+        sections = re.split(parser.match_code_block(), queued_response_text, flags=re.DOTALL)
+        queued_response_text = sections[-1]
+        for section in sections[1:-1:2]:
+            parts += parser.find_files(section) if parser.is_file(section) else parser.find_snippets(section)
+    return parts
+
+def stream_parser(chunks):
+    events = []
+    streamed = parser.StreamParser()
+    for chunk in chunks:
+        events += streamed.feed(chunk)
+    return [event for event in events + streamed.finish() if event[0] in ("part_end", "snippet")]
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+def bench_stream_parsing():
+    for file_count in [1, 20]:
+        response = create_synthetic_response(file_count)
+        print(f"parsing a {len(response) / 1024:.0f}KB response with {file_count} file(s)")
+        for chunk_size in CHUNK_SIZES:
+            chunks = chunked(response, chunk_size)
+            rescan_time, rescan_parts = timed(regex_rescan, chunks)
+            stream_time, stream_events = timed(stream_parser, chunks)
+            assert len(rescan_parts) == len(stream_events)
+            print(f"  {chunk_size:>5} char chunks: regex rescan {rescan_time:.3f}s, "
+                  f"stream parser {stream_time:.3f}s ({rescan_time / stream_time:.1f}x)")
+
+LANGUAGE_LOOKUPS = 5000
+LANGUAGE_FILENAMES = ["src/app.py", "web/index.js", "lib/util.rb", "include/api.h", "README.md", "CMakeLists.txt", "style.css"]
+
+def pygments_language(filename):
+    # The previous get_language_from_extension, for files with an extension
+    return get_lexer_for_filename(filename).name.lower()
+
+def bench_language_detection():
+    filenames = [LANGUAGE_FILENAMES[index % len(LANGUAGE_FILENAMES)] for index in range(LANGUAGE_LOOKUPS)]
+    print(f"detecting the language of {len(filenames)} files")
+    table_time, _ = timed(parser.load_language_table)
+    pygments_time, expected = timed(lambda: [pygments_language(filename) for filename in filenames])
+    lookup_time, languages = timed(lambda: [parser.get_language_from_extension(filename) for filename in filenames])
+    assert languages == expected
+    print(f"  load language table: {table_time:.3f}s")
+    print(f"  pygments lookup {pygments_time:.3f}s, language table {lookup_time:.3f}s ({pygments_time / lookup_time:.0f}x)")
+
+if __name__ == "__main__":
+    bench_stream_parsing()
+    bench_language_detection()
@@ -0,0 +1,134 @@
+"""Benchmarks for streaming responses against a local fake Gemini server. Run with `bin/bench`, not part of the test suite."""
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
+# Make sure the src directory is in the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from google import genai
+from google.genai import types
+from src import chat, parser, database
+from src.logger import console, print_markdown
+from src.renderer import StreamRenderer
+
+CHUNK_COUNT = 80
+CHUNK_INTERVAL = 0.02 # Seconds between chunks from the server
+RENDER_DELAY = 0.03 # Seconds per markdown render, i.e. a slow terminal or a large section
+
+def synthetic_response():
+    sections = [
+        f"Step {index}: run this to check the change.\n\n" + parser.snippet_block(f"bin/test --case {index}", "sh")
+        for index in range(CHUNK_COUNT // 2)
+    ]
+    return "\n".join(sections) + "\nThat should do it."
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    """Answers streamGenerateContent with server sent events, one chunk every CHUNK_INTERVAL seconds."""
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+        response = synthetic_response()
+        size = len(response) // CHUNK_COUNT + 1
+        for index in range(0, len(response), size):
+            time.sleep(CHUNK_INTERVAL)
+            chunk = {"candidates": [{"content": {"role": "model", "parts": [{"text": response[index:index + size]}]}}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\r\n\r\n".encode('utf-8'))
+            self.wfile.flush()
+
+    def log_message(self, *args):
+        pass
+
+def bench_stream(cwd, port):
+    client = genai.Client(api_key="fake", http_options=types.HttpOptions(base_url=f"http://127.0.0.1:{port}"))
+    print(f"streaming {CHUNK_COUNT} chunks {CHUNK_INTERVAL * 1000:.0f}ms apart, rendering takes {RENDER_DELAY * 1000:.0f}ms per section")
+
+    timings = {}
+    for name, async_stream in [("single thread", False), ("async pipeline", True)]:
+        state = chat.create_session_state(cwd=cwd, async_stream=async_stream, prefetch=False)
+        renders = []
+
+        def slow_render(*args, **kwargs):
+            renders.append(time.perf_counter())
+            time.sleep(RENDER_DELAY)
+
+        with patch('src.renderer.print_markdown', side_effect=slow_render), \
+             patch('src.chat.get_tmux_logs', return_value=""), \
+             patch('src.chat.process_response_metadata'):
+            start = time.perf_counter()
+            chat.send_request_to_ai("Hello", state, client)
+            total = time.perf_counter() - start
+        if state['stream_runner']:
+            state['stream_runner'].close()
+
+        timings[name] = total
+        print(f"  {name}: first render after {renders[0] - start:.3f}s, done after {total:.3f}s ({len(renders)} renders)")
+    print(f"  speedup: {timings['single thread'] / timings['async pipeline']:.1f}x")
+
+def section_render(chunks, chunk_interval):
+    # The previous rendering: a status update per chunk, and the text rendered in whole sections (here, at the end)
+    with console.status("Thinking...", spinner="point") as status:
+        pending_text = []
+        for chunk in chunks:
+            time.sleep(chunk_interval)
+            pending_text.append(chunk)
+            status.update("Typing...")
+            yield
+        print_markdown("".join(pending_text), end="")
+        yield
+
+def throttled_render(chunks, chunk_interval):
+    with StreamRenderer("Thinking...") as renderer:
+        for chunk in chunks:
+            time.sleep(chunk_interval)
+            renderer.text(chunk)
+            renderer.status("Typing...")
+            yield
+        renderer.flush()
+        yield
+
+def bench_render(paragraphs=300, chunk_size=20, chunk_interval=0.0005):
+    text = "".join(
+        f"Paragraph {index}: the **change** keeps `parse` and `render` apart, see [the docs](https://example.com).\n\n"
+        + (f"- item {index}\n- another item\n\n" if index % 5 == 0 else "")
+        for index in range(paragraphs))
+    chunks = [text[index:index + chunk_size] for index in range(0, len(text), chunk_size)]
+    print(f"rendering {len(text) // 1024}KB of markdown in {len(chunks)} chunks {chunk_interval * 1000:.1f}ms apart")
+
+    with open(os.devnull, 'w', encoding='utf-8') as devnull:
+        file, force_terminal = console.file, console._force_terminal
+        console.file, console._force_terminal = devnull, True
+        try:
+            for name, render in [("sections", section_render), ("throttled", throttled_render)]:
+                outputs = []
+                write = devnull.write
+                with patch.object(devnull, 'write', side_effect=lambda data: ("Paragraph" in data and outputs.append(time.perf_counter())) or write(data)):
+                    start = time.perf_counter()
+                    cpu_start = time.thread_time()
+                    for _ in render(chunks, chunk_interval):
+                        pass
+                    cpu = time.thread_time() - cpu_start
+                    total = time.perf_counter() - start
+                print(f"  {name}: {cpu * 1000:.0f}ms cpu, first text after {outputs[0] - start:.3f}s, done after {total:.3f}s")
+        finally:
+            console.file, console._force_terminal = file, force_terminal
+
+if __name__ == "__main__":
+    bench_render()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeGeminiHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    with tempfile.TemporaryDirectory() as cwd:
+        database.initialize_database(cwd)
+        bench_stream(cwd, server.server_address[1])
+    server.shutdown()
@@ -1,6 +1,7 @@
 import pytest
 import os
 import sys
+import time
 from unittest.mock import patch, MagicMock
 
 # Make sure the src directory is in the Python path
@@ -35,7 +36,7 @@ def test_stream_parsing_and_file_writing(MockGenaiClient, temp_cwd_with_db):
     mocked API stream, assembles them, and writes the final file to disk.
     """
     cwd = temp_cwd_with_db
-    state = chat.create_session_state(cwd=str(cwd), writeable=True, include_patterns=None)
+    state = chat.create_session_state(cwd=str(cwd), writeable=True, include_patterns=None, async_stream=False)
 
     # 1. Define the file content and path for our test
     file_path = "src/new_file.py"
@@ -108,6 +109,37 @@ NoMoreParts: True
         assert f"Path: {file_path}" not in last_chat.message
         assert last_chat.user.name == 'linus', "The chat history should be saved under the 'linus' user"
 
+def test_files_are_written_mid_stream(temp_cwd_with_db):
+    """
+    Tests that with write access each file is written as soon as it is assembled, before the stream ends,
+    and the summary is still printed at the end.
+    """
+    cwd = temp_cwd_with_db
+    state = chat.create_session_state(cwd=str(cwd), writeable=True, async_stream=False)
+    written_mid_stream = []
+
+    def stream():
+        yield MagicMock(text="First file:\n\n" + parser.file_block("src/a.py", "a = 1\n"), usage_metadata=None)
+        yield MagicMock(text="\nSecond file:\n\n", usage_metadata=None)
+        # Give the writer a moment, the stream is still going
+        deadline = time.time() + 5
+        while not (cwd / "src" / "a.py").exists() and time.time() < deadline:
+            time.sleep(0.01)
+        written_mid_stream.append((cwd / "src" / "a.py").exists())
+        yield MagicMock(text=parser.file_block("src/b.py", "b = 2\n") + "\nDone.", usage_metadata=None)
+
+    client = MagicMock()
+    client.models.generate_content_stream.return_value = stream()
+    with patch('src.chat.console') as mock_console:
+        chat.send_request_to_ai("Write two files", state, client)
+    state['file_writer'].close()
+
+    assert written_mid_stream == [True]
+    assert (cwd / "src" / "a.py").read_text(encoding='utf-8') == "a = 1\n"
+    assert (cwd / "src" / "b.py").read_text(encoding='utf-8') == "b = 2\n"
+    printed = [call.args[0] for call in mock_console.print.call_args_list if call.args]
+    assert printed[-3:] == ["\nFiles Changed\n", "  src/a.py", "  src/b.py"]
+
 @patch('src.chat.genai.Client')
 def test_chat_message_strips_files(MockGenaiClient, temp_cwd_with_db):
     """
@@ -115,7 +147,7 @@ def test_chat_message_strips_files(MockGenaiClient, temp_cwd_with_db):
     to the chat history in the database.
     """
     cwd = temp_cwd_with_db
-    state = chat.create_session_state(cwd=str(cwd), writeable=False) # Not writing files
+    state = chat.create_session_state(cwd=str(cwd), writeable=False, async_stream=False) # Not writing files
 
     file_path = "a/b/c.txt"
     file_content = "This is the content."
@@ -147,11 +179,13 @@ def test_chat_message_strips_files(MockGenaiClient, temp_cwd_with_db):
         # The file content (part of the file block) should NOT be there
         assert file_content not in last_chat.message
 
-def test_llm_system_prompt_guides(temp_cwd_with_db):
+def test_llm_system_prompt_guides(temp_cwd_with_db, monkeypatch):
     """
     Tests that project-specific and global guides are correctly injected into the prompt.
     """
     cwd = temp_cwd_with_db
+    global_guide_path = cwd.parent / "guide.md"
+    monkeypatch.setattr(chat, 'GLOBAL_GUIDE_FILE', str(global_guide_path))
 
     # 1. Test without a .lin.md file present
     prompt_no_guide = chat.llm_system_prompt(cwd=str(cwd))
@@ -168,3 +202,141 @@ def test_llm_system_prompt_guides(temp_cwd_with_db):
     assert guide_content in prompt_with_guide
     assert "* Empty, no global user guide is defined." in prompt_with_guide
     assert "* Empty, no project-specific user guide is defined." not in prompt_with_guide
+
+    # 3. Test with a global guide too
+    global_guide_content = "This is the global guide."
+    global_guide_path.write_text(global_guide_content, encoding="utf-8")
+
+    prompt_with_guides = chat.llm_system_prompt(cwd=str(cwd))
+    assert guide_content in prompt_with_guides
+    assert global_guide_content in prompt_with_guides
+    assert "* Empty, no global user guide is defined." not in prompt_with_guides
+
+def test_stream_cut_off_mid_file_part(temp_cwd_with_db):
+    """
+    Tests that a stream cut off mid file part closes off the part in the response text, and asks
+    for a force continue that sends the part again (it is not kept, its last lines are lost).
+    """
+    state = chat.create_session_state(cwd=str(temp_cwd_with_db), writeable=False)
+
+    response_text = f"""Starting on it.
+{parser.placeholder('START FILE METADATA')}
+Path: cut.py
+Language: python
+Version: 1
+Part: 1
+{parser.placeholder('END FILE METADATA')}
+first = 1
+second = 2
+thi"""
+    fake_chunks = [MagicMock(text=response_text[index:index + 10]) for index in range(0, len(response_text), 10)]
+
+    full_response_text, last_chunk, assembled_files = chat.process_request_stream(iter(fake_chunks), state)
+
+    assert state['force_continue']
+    assert last_chunk is fake_chunks[-1]
+    assert assembled_files == {}
+    assert state['file_part_buffer'].in_progress() == [("cut.py", 1, [])]
+    assert "cut.py (v1) part(s) none, continue from part 1" in chat.continuation_note(state)
+    assert full_response_text.startswith("Starting on it.\n")
+    assert full_response_text.endswith(f"second = 2\n{parser.placeholder('END OF FILE')}")
+
+def test_recap_message():
+    """
+    Tests that files are shown once with all their parts (joined like find_files does),
+    snippets become markdown code blocks and terminal logs are left alone.
+    """
+    file_path = "src/app.py"
+    message = f"""Here you go.
+{parser.placeholder('START FILE METADATA')}
+Path: {file_path}
+Language: python
+Version: 2
+Part: 1
+{parser.placeholder('END FILE METADATA')}
+a = 1
+{parser.placeholder('END OF FILE')}
+{parser.placeholder('START FILE METADATA')}
+Path: {file_path}
+Language: python
+Version: 2
+Part: 2
+{parser.placeholder('END FILE METADATA')}
+b = '\\\\n'
+{parser.placeholder('END OF FILE')}
+Then run:
+{parser.snippet_block("bin/test", "sh")}{parser.terminal_log_block("$ ls", "shell")}"""
+
+    expected = f"""Here you go.#### {file_path} (v2)
+
+```python
+a = 1b = '\\\\n'
+
+```Then run:
+
+#### sh
+
+```sh
+bin/test
+
+```
+{parser.terminal_log_block("$ ls", "shell")}"""
+
+    assert chat.recap_message(message) == expected
+
+class PrefixCachingClient:
+    """
+    A stand-in for the Gemini client that reports implicit cache hits like the API does: the longest
+    prefix a request shares with an earlier one is cached (if it is long enough), counting 4 chars per token.
+    """
+    MIN_CACHED_TOKENS = 1024
+
+    def __init__(self):
+        self.models = self
+        self.requests = []
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+    def generate_content_stream(self, model, contents, config):
+        request = config.system_instruction + "".join(
+            f"\n<{content.role}>\n" + "".join(part.text for part in content.parts) for content in contents)
+        shared = max([len(os.path.commonprefix([request, previous])) for previous in self.requests] or [0])
+        self.requests.append(request)
+
+        prompt_token_count = len(request) // 4
+        cached_content_token_count = shared // 4 if shared // 4 >= self.MIN_CACHED_TOKENS else 0
+        self.prompt_tokens += prompt_token_count
+        self.cached_tokens += cached_content_token_count
+
+        usage_metadata = MagicMock(
+            prompt_token_count=prompt_token_count, candidates_token_count=5, total_token_count=prompt_token_count + 5,
+            cached_content_token_count=cached_content_token_count, thoughts_token_count=0, tool_use_prompt_token_count=0)
+        return iter([MagicMock(text=f"Reply {len(self.requests)}.", usage_metadata=usage_metadata)])
+
+def cached_token_ratio(cwd, request_layout, turns=6):
+    """Runs a scripted session (a file changes half way through, terminal logs change every turn)."""
+    for index in range(5):
+        (cwd / f"module_{index}.py").write_text(f"def function_{index}():\n    return {index}\n" * 100, encoding='utf-8')
+
+    state = chat.create_session_state(cwd=str(cwd), include_patterns=["."], request_layout=request_layout, async_stream=False)
+    client = PrefixCachingClient()
+    for turn in range(turns):
+        if turn == turns // 2:
+            (cwd / "module_4.py").write_text("def changed():\n    pass\n", encoding='utf-8')
+        with patch('src.chat.get_tmux_logs', return_value=f"$ bin/test\n{turn} passed"):
+            chat.send_request_to_ai(f"Message number {turn}", state, client)
+
+    return client.cached_tokens / client.prompt_tokens
+
+def test_stable_request_layout_is_cached_more(temp_cwd_with_db, tmp_path):
+    stable_ratio = cached_token_ratio(temp_cwd_with_db, "stable")
+
+    other_project = tmp_path / "other_project"
+    other_project.mkdir()
+    database.initialize_database(str(other_project))
+    default_ratio = cached_token_ratio(other_project, "default")
+
+    # The default layout only shares the system prompt (about 0.3 here), the stable one everything
+    # up to the terminal logs, apart from the first request and the one after a file changed (about 0.8)
+    assert default_ratio < 0.4
+    assert stable_ratio > 0.7
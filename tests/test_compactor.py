@@ -0,0 +1,130 @@
+import pytest
+import os
+import sys
+from unittest.mock import MagicMock, patch
+
+# Make sure the src directory is in the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src import chat, compactor, parser, database
+from src.config import USER_NAME, PARTNER_NAME
+from src.database import Chat, ChatArchive, User
+
+@pytest.fixture
+def project(tmp_path):
+    db = database.initialize_database(str(tmp_path))
+    yield tmp_path
+    db.close()
+
+def file_part(file_path, content, part):
+    return f"""{parser.placeholder('START FILE METADATA')}
+Path: {file_path}
+Language: python
+Version: 2
+Part: {part}
+{parser.placeholder('END FILE METADATA')}
+{content}
+{parser.placeholder('END OF FILE')}"""
+
+def long_reply(index):
+    middle = "\n\n".join(f"Detail {line} of the change, with some reasoning about it." for line in range(40))
+    return f"Reply {index} opening.\n\n## Plan\n\n{middle}\n\n{parser.snippet_block('bin/test', 'sh')}\nReply {index} closing."
+
+def add_chats(*messages):
+    human_user = User.get(name=USER_NAME.lower())
+    llm_user = User.get(name=PARTNER_NAME.lower())
+    with database.db_proxy:
+        for index, message in enumerate(messages):
+            Chat.create(user=human_user if index % 2 == 0 else llm_user, message=message)
+
+def chat_messages():
+    return [chat.message for chat in compactor.chat_messages()]
+
+def test_strip_file_blocks():
+    message = f"Here:\n{file_part('a.py', 'a = 1', 1)}\n{file_part('a.py', 'b = 2', 2)}\n{parser.snippet_block('ls', 'sh')}"
+
+    stripped = compactor.strip_file_blocks(message)
+
+    assert stripped.count("(File a.py v2, see the project files for its current content)") == 1
+    assert "a = 1" not in stripped and "b = 2" not in stripped
+    assert parser.snippet_block('ls', 'sh') in stripped
+
+def test_summarize_heuristically():
+    summary = compactor.summarize_heuristically(long_reply(1))
+
+    assert summary == f"{compactor.SUMMARY_PREFIX}Reply 1 opening.\n\n## Plan\n\nReply 1 closing."
+
+    truncated = compactor.summarize_heuristically("A long opening. " * 20 + "\n\nThe end.", max_chars=100)
+    assert len(truncated) <= 100 and truncated.endswith("...")
+
+def test_llm_summarizer_falls_back_to_heuristic():
+    client = MagicMock()
+    client.models.generate_content.return_value = MagicMock(text="It planned the change.")
+    assert compactor.llm_summarizer(client)(long_reply(1)) == f"{compactor.SUMMARY_PREFIX}It planned the change."
+
+    client.models.generate_content.side_effect = ConnectionError("offline")
+    assert compactor.llm_summarizer(client)(long_reply(1)) == compactor.summarize_heuristically(long_reply(1))
+
+def test_compact_chat_history_archives_originals(project):
+    pasted = f"Look at this\n{file_part('a.py', 'a = 1', 1)}"
+    add_chats(pasted, long_reply(1), "Thanks", "Short reply", "Next", long_reply(2))
+
+    compacted, tokens_before, tokens_after = compactor.compact_chat_history(keep_recent=2)
+
+    assert compacted == 2
+    assert tokens_after < tokens_before
+    assert chat_messages() == [
+        "Look at this\n(File a.py v2, see the project files for its current content)",
+        compactor.summarize_heuristically(long_reply(1)),
+        "Thanks", "Short reply", "Next", long_reply(2),
+    ]
+    with database.db_proxy:
+        assert [row.message for row in ChatArchive.select().order_by(ChatArchive.chat_id)] == [pasted, long_reply(1)]
+
+    # Already compact
+    assert compactor.compact_chat_history(keep_recent=2)[0] == 0
+
+def test_reset_chat_history(project):
+    add_chats("Hello", "Hi")
+
+    assert compactor.reset_chat_history()[0] == 2
+    assert chat_messages() == []
+    with database.db_proxy:
+        assert ChatArchive.select().count() == 2
+    assert compactor.reset_chat_history() == (0, 0)
+
+def test_auto_compacts_over_the_token_limit(project):
+    add_chats("First", long_reply(1), "Second", long_reply(2), "Third", long_reply(3), "Fourth", long_reply(4))
+
+    def response(prompt_token_count):
+        usage_metadata = MagicMock(prompt_token_count=prompt_token_count, candidates_token_count=0, cached_content_token_count=0,
+                                   total_token_count=prompt_token_count, thoughts_token_count=0, tool_use_prompt_token_count=0)
+        return iter([MagicMock(text="Done.", usage_metadata=usage_metadata)])
+
+    state = chat.create_session_state(cwd=str(project), async_stream=False, prefetch=False, auto_compact=1000)
+    client = MagicMock()
+
+    with patch('src.chat.get_tmux_logs', return_value=""):
+        client.models.generate_content_stream.return_value = response(999)
+        chat.send_request_to_ai("Fifth", state, client)
+        assert long_reply(1) in chat_messages()
+
+        client.models.generate_content_stream.return_value = response(1001)
+        chat.send_request_to_ai("Sixth", state, client)
+
+    messages = chat_messages()
+    assert compactor.summarize_heuristically(long_reply(1)) in messages
+    assert compactor.summarize_heuristically(long_reply(3)) in messages
+    assert long_reply(4) in messages # Recent
+    assert messages[-1] == "Done."
+
+def test_nothing_to_compact_is_only_reported_when_asked(project):
+    add_chats("First", "Short reply")
+    state = chat.create_session_state(cwd=str(project), async_stream=False, prefetch=False, auto_compact=1000)
+
+    with patch('src.chat.console') as console:
+        chat.compact_history(state, MagicMock(), automatic=True)
+        assert not console.print.called
+
+        chat.compact_history(state, MagicMock())
+        console.print.assert_called_once_with("Nothing to compact.\n", style="bold yellow")
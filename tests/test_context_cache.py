@@ -0,0 +1,129 @@
+import pytest
+import os
+import sys
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+from google.genai import types, errors
+
+# Make sure the src directory is in the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src import chat, database
+from src.context_cache import get_context_cache, FAILED_KEYS
+from src.database import ContextCache
+
+class FakeCaches:
+    def __init__(self):
+        self.created = []
+        self.deleted = []
+        self.fail = False
+        self.attempts = 0
+        self.in_transaction = []
+
+    def create(self, model, config):
+        self.attempts += 1
+        self.in_transaction.append(database.db_proxy.in_transaction())
+        if self.fail:
+            raise errors.ClientError(400, {'error': {'code': 400, 'message': 'Cached content is too small'}})
+        cache = SimpleNamespace(name=f"cachedContents/{len(self.created)}", model=model, config=config)
+        self.created.append(cache)
+        return cache
+
+    def delete(self, name):
+        self.in_transaction.append(database.db_proxy.in_transaction())
+        self.deleted.append(name)
+
+class FakeClient:
+    def __init__(self):
+        self.caches = FakeCaches()
+        self.models = MagicMock()
+
+@pytest.fixture
+def project(tmp_path):
+    db = database.initialize_database(str(tmp_path))
+    yield tmp_path
+    db.close()
+    FAILED_KEYS.clear()
+
+def context(text):
+    return types.UserContent(parts=[types.Part.from_text(text=text)])
+
+def test_context_cache_is_reused_until_the_context_changes(project):
+    client = FakeClient()
+
+    name = get_context_cache(client, "model-a", "system", context("snapshot 1"), [], ttl=600)
+    assert name == "cachedContents/0"
+    assert client.caches.created[0].config.ttl == "600s"
+    assert client.caches.created[0].config.system_instruction == "system"
+    assert get_context_cache(client, "model-a", "system", context("snapshot 1"), [], ttl=600) == name
+    assert len(client.caches.created) == 1
+
+    # A new snapshot replaces the old cache
+    assert get_context_cache(client, "model-a", "system", context("snapshot 2"), [], ttl=600) == "cachedContents/1"
+    assert client.caches.deleted == ["cachedContents/0"]
+    with database.db_proxy:
+        assert [row.name for row in ContextCache.select()] == ["cachedContents/1"]
+    # The API is never called with the database locked
+    assert client.caches.in_transaction == [False, False, False]
+
+def test_context_cache_expires_and_survives_restarts(project):
+    client = FakeClient()
+    name = get_context_cache(client, "model-a", "system", context("snapshot"), [], ttl=600)
+
+    # A new session (same .lin.db) picks up the cache
+    database.initialize_database(str(project))
+    assert get_context_cache(client, "model-a", "system", context("snapshot"), [], ttl=600) == name
+
+    with database.db_proxy:
+        ContextCache.update(expire_time=datetime.now() + timedelta(seconds=30)).execute()
+
+    # About to expire, so it is replaced
+    assert get_context_cache(client, "model-a", "system", context("snapshot"), [], ttl=600) == "cachedContents/1"
+    assert client.caches.deleted == [name]
+
+def test_expired_context_caches_of_other_models_are_removed(project):
+    client = FakeClient()
+    get_context_cache(client, "model-a", "system", context("snapshot"), [], ttl=600)
+    with database.db_proxy:
+        ContextCache.update(expire_time=datetime.now() - timedelta(seconds=1)).execute()
+
+    get_context_cache(client, "model-b", "system", context("snapshot"), [], ttl=600)
+    with database.db_proxy:
+        assert [row.model for row in ContextCache.select()] == ["model-b"]
+
+def test_context_cache_falls_back_when_it_cannot_be_created(project):
+    client = FakeClient()
+    client.caches.fail = True
+
+    assert get_context_cache(client, "model-a", "system", context("tiny"), []) is None
+    with database.db_proxy:
+        assert ContextCache.select().count() == 0
+
+    # Not retried for the same context
+    with patch('src.context_cache.warning') as warning:
+        assert get_context_cache(client, "model-a", "system", context("tiny"), []) is None
+    assert client.caches.attempts == 1
+    warning.assert_not_called()
+
+    assert get_context_cache(client, "model-a", "system", context("tiny, but changed"), []) is None
+    assert client.caches.attempts == 2
+
+def test_send_request_with_context_cache(project):
+    client = FakeClient()
+    (project / "app.py").write_text("print('hi')\n")
+    state = chat.create_session_state(cwd=str(project), include_patterns=["."], context_cache=True, async_stream=False)
+    assert state['request_layout'] == "stable"
+
+    client.models.generate_content_stream.return_value = iter([MagicMock(text="Hi.", usage_metadata=None)])
+    with patch('src.chat.get_tmux_logs', return_value="$ ls"):
+        chat.send_request_to_ai("Hello", state, client)
+
+    kwargs = client.models.generate_content_stream.call_args.kwargs
+    assert kwargs['config'].cached_content == "cachedContents/0"
+    assert kwargs['config'].system_instruction is None
+    assert kwargs['config'].tools is None
+    # Only the latest message is sent, the project context is in the cache
+    assert len(kwargs['contents']) == 1
+    assert "print('hi')" in client.caches.created[0].config.contents[0].parts[0].text
+    assert "Hello" in kwargs['contents'][0].parts[-1].text
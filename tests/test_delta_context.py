@@ -0,0 +1,135 @@
+import pytest
+import os
+import sys
+from unittest.mock import MagicMock, patch
+
+# Make sure the src directory is in the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src import chat, database
+from src.database import FileSnapshot
+from src.delta_context import take_snapshot, file_changes
+from src.estimator import estimate_tokens
+from src.file_utils import ProjectScan, generate_project_file_blocks
+
+@pytest.fixture
+def project(tmp_path):
+    for index in range(3):
+        (tmp_path / f"module_{index}.py").write_text("".join(f"line {line}\n" for line in range(50)), encoding='utf-8')
+    db = database.initialize_database(str(tmp_path))
+    yield tmp_path
+    db.close()
+
+def scan_project(project):
+    scan = ProjectScan(include_patterns=["."], cwd=str(project), use_git=False)
+    return scan, generate_project_file_blocks(scan)
+
+def test_file_changes_since_snapshot(project):
+    scan, blocks = scan_project(project)
+    snapshot = take_snapshot(scan, blocks, scan.files, "context")
+
+    scan, blocks = scan_project(project)
+    assert file_changes(snapshot, scan, blocks) == []
+
+    (project / "module_0.py").write_text("".join(f"line {line}\n" for line in range(49)) + "changed\n", encoding='utf-8')
+    (project / "new.py").write_text("print('new')\n", encoding='utf-8')
+    os.remove(project / "module_2.py")
+    scan, blocks = scan_project(project)
+    changes = file_changes(snapshot, scan, blocks)
+
+    assert len(changes) == 4
+    diff = next(change for change in changes if change.startswith("--- "))
+    tree = changes[-1]
+    new_file = blocks[scan.files.index("new.py")]
+    assert new_file in changes
+    assert "Deleted: module_2.py\n" in changes
+    assert diff.startswith("--- a/module_0.py\n+++ b/module_0.py\n")
+    assert "-line 49\n+changed\n" in diff
+    assert "line 40\n" not in diff # Only a few lines of context
+    assert '"new.py"' in tree
+
+def test_file_changes_needs_a_new_snapshot(project):
+    scan, blocks = scan_project(project)
+    snapshot = take_snapshot(scan, blocks, scan.files, "context")
+
+    # Most of the project changed, so a full snapshot is about as small
+    for index in range(3):
+        (project / f"module_{index}.py").write_text("rewritten\n" * 50, encoding='utf-8')
+    scan, blocks = scan_project(project)
+    assert file_changes(snapshot, scan, blocks) is None
+
+    # Or the snapshot is gone from the store
+    (project / "module_0.py").write_text("small change\n", encoding='utf-8')
+    snapshot = take_snapshot(*scan_project(project), scan.files, "context")
+    (project / "module_0.py").write_text("another small change\n", encoding='utf-8')
+    with database.db_proxy:
+        FileSnapshot.delete().execute()
+    assert file_changes(snapshot, *scan_project(project), rebase_ratio=10) is None
+
+def test_new_snapshot_prunes_the_store(project):
+    scan, blocks = scan_project(project)
+    take_snapshot(scan, blocks, scan.files, "context")
+    (project / "module_0.py").write_text("rewritten\n", encoding='utf-8')
+    scan, blocks = scan_project(project)
+    snapshot = take_snapshot(scan, blocks, scan.files, "context")
+
+    with database.db_proxy:
+        assert {row.content_hash for row in FileSnapshot.select()} == set(snapshot['files'].values())
+
+def test_delta_context_requests(project):
+    state = chat.create_session_state(cwd=str(project), include_patterns=["."], delta_context=True, async_stream=False)
+    client = MagicMock()
+    requests = []
+
+    def generate_content_stream(model, contents, config):
+        requests.append(contents)
+        return iter([MagicMock(text="Ok.", usage_metadata=None)])
+    client.models.generate_content_stream.side_effect = generate_content_stream
+
+    with patch('src.chat.get_tmux_logs', return_value="$ ls"):
+        chat.send_request_to_ai("First", state, client)
+        (project / "module_1.py").write_text("".join(f"line {line}\n" for line in range(50)) + "appended\n", encoding='utf-8')
+        chat.send_request_to_ai("Second", state, client)
+
+    first, second = requests
+    # The same full context is sent first, so it can be cached, with only the diff at the end
+    assert second[0].parts[0].text == first[0].parts[0].text
+    assert "line 25" in first[0].parts[0].text
+    assert "### File Changes" not in first[-1].parts[0].text
+    latest = second[-1].parts[0].text
+    assert "+appended\n" in latest
+    assert "line 25" not in latest
+
+def test_file_changes_sends_planned_files_left_out_of_the_snapshot(project):
+    scan, blocks = scan_project(project)
+    snapshot = take_snapshot(scan, blocks, scan.files[:2], "context")
+
+    assert file_changes(snapshot, scan, blocks, scan.files[:2]) == []
+    assert file_changes(snapshot, scan, blocks, scan.files[1:]) == [blocks[2]]
+
+def test_delta_context_requests_with_a_token_budget(project):
+    scan, blocks = scan_project(project)
+    budget = round(estimate_tokens(blocks[0]) * 2.5)
+    state = chat.create_session_state(cwd=str(project), include_patterns=["."], delta_context=True, token_budget=budget,
+                                      async_stream=False, prefetch=False)
+    client = MagicMock()
+    requests = []
+
+    def generate_content_stream(model, contents, config):
+        requests.append(contents)
+        return iter([MagicMock(text="Ok.", usage_metadata=None)])
+    client.models.generate_content_stream.side_effect = generate_content_stream
+
+    with patch('src.chat.get_tmux_logs', return_value="$ ls"), patch('src.planner.git_dirty_files', return_value=set()):
+        chat.send_request_to_ai("First", state, client)
+        snapshot = state['context_snapshot']
+        left_out = next(file_path for file_path in scan.files if file_path not in snapshot['files'])
+        chat.send_request_to_ai(f"Look at @{left_out}", state, client)
+
+    first, second = requests
+    left_out_block = blocks[scan.files.index(left_out)]
+    # Still diffing against the first snapshot, with the referenced file in full
+    assert state['context_snapshot'] is snapshot
+    assert second[0].parts[0].text == first[0].parts[0].text
+    assert left_out_block not in first[0].parts[0].text
+    assert left_out_block in second[-1].parts[0].text
@@ -0,0 +1,72 @@
+import pytest
+import os
+import sys
+from unittest.mock import patch
+
+# Make sure the src directory is in the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src import database, estimator
+from src.estimator import TokenEstimator, PRIOR_WEIGHTS, solve, text_features, joined_text_features, record_token_sample, load_estimator
+
+CODE = "def add(a, b):\n    return a + b  # sum\n"
+PROSE = "Tokens are roughly words, give or take. "
+
+@pytest.fixture
+def temp_db(tmp_path):
+    db = database.initialize_database(str(tmp_path))
+    estimator.ESTIMATOR = None
+    yield db
+    estimator.ESTIMATOR = None
+    db.close()
+
+def test_text_features():
+    assert text_features("héllo, wörld!") == [13, 2, 2, 2]
+
+def test_joined_text_features():
+    texts = ["# Files", "héllo, wörld!", "def a():\n    return 1"]
+    features, cache = joined_text_features(texts)
+    assert features == text_features("\n".join(texts))
+
+    with patch('src.estimator.text_features', wraps=text_features) as counted:
+        features, cache = joined_text_features(texts[:2] + ["New message"], cache)
+    assert features == text_features("\n".join(texts[:2] + ["New message"]))
+    assert [call.args[0] for call in counted.call_args_list] == ["New message"]
+    assert set(cache) == {"# Files", "héllo, wörld!", "New message"}
+
+def test_solve():
+    assert [round(x, 6) for x in solve([[2.0, 1.0], [1.0, 3.0]], [3.0, 5.0])] == [0.8, 1.4]
+
+def test_estimator_uses_prior_without_samples():
+    """Tests that the estimate falls back to the prior weights, and has no error to report."""
+    fresh = TokenEstimator()
+    assert [round(weight, 6) for weight in fresh.weights] == PRIOR_WEIGHTS
+    assert fresh.estimate("x" * 400) > 0
+    assert fresh.error() is None
+
+def test_estimator_fits_recorded_usage():
+    """Tests that fitting on (text, prompt_token_count) pairs learns the per request overhead and rate."""
+    samples = []
+    for code_lines, prose_lines in [(100, 10), (2000, 50), (500, 900), (50, 3000), (1200, 1200), (3000, 5)]:
+        text = CODE * code_lines + PROSE * prose_lines
+        samples.append((text_features(text), round(len(text) / 3.5) + 2500))
+
+    fitted = TokenEstimator(samples)
+    assert fitted.error() < 0.01
+
+    text = CODE * 700 + PROSE * 700
+    expected = round(len(text) / 3.5) + 2500
+    assert abs(fitted.estimate(text, overhead=True) - expected) / expected < 0.01
+    # Per file estimates leave out the request overhead
+    assert fitted.estimate(text) < fitted.estimate(text, overhead=True)
+
+def test_record_token_sample_refits(temp_db):
+    """Tests that recorded samples are stored in .lin.db and used by the next estimate."""
+    assert load_estimator().samples == []
+
+    features = text_features(CODE * 100)
+    record_token_sample(features, 1234)
+
+    reloaded = load_estimator()
+    assert reloaded.samples == [(features, 1234)]
+    assert reloaded.error() is not None
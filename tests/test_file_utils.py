@@ -2,18 +2,26 @@ import pytest
 import os
 import sys
 import json
+import sqlite3
+import subprocess
+import pathspec
+from unittest.mock import patch
 
 # Make sure the src directory is in the Python path
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from src.file_utils import (
+    ProjectScan,
     generate_project_structure,
     generate_project_file_list,
     generate_project_file_contents,
     load_ignore_patterns,
+    read_file_block,
+    human_format_bytes,
     generate_diff
 )
 from src.config import DEFAULT_IGNORE_PATTERNS
+from src import database
 
 # The fixture directory is created manually, so we can reference it directly.
 FIXTURE_DIR = os.path.join(os.path.dirname(__file__), 'fixtures', 'file_utils_project')
@@ -89,6 +97,195 @@ def test_generate_project_file_contents():
     assert 'print("hello from file1.py")' in contents
     assert "Path: subdir/file3.js" not in contents
 
+def test_project_scan_shared_by_consumers():
+    """Tests that one scan provides the tree, file list, stats and contents without re-walking."""
+    scan = ProjectScan(include_patterns=["."], cwd=FIXTURE_DIR)
+
+    assert scan.files == generate_project_file_list(cwd=FIXTURE_DIR, include_patterns=["."]).splitlines()
+    assert scan.tree == generate_project_structure(cwd=FIXTURE_DIR, include_patterns=["."])
+    assert set(scan.stats) == set(scan.files)
+
+    mtime_ns, size, _ = scan.stats['file1.py']
+    assert size == os.path.getsize(os.path.join(FIXTURE_DIR, 'file1.py'))
+    assert mtime_ns > 0
+
+    contents = generate_project_file_contents(scan=scan)
+    assert "Path: file1.py" in contents
+    assert "Path: subdir/file3.js" in contents
+
+def test_project_scan_honors_nested_gitignore(tmp_path):
+    """Tests that .gitignore files in subdirectories apply relative to their own directory."""
+    (tmp_path / "main.py").write_text("")
+    vendored = tmp_path / "vendored"
+    vendored.mkdir()
+    (vendored / ".gitignore").write_text("generated/\n*.min.js\n")
+    (vendored / "lib.js").write_text("")
+    (vendored / "lib.min.js").write_text("")
+    (vendored / "generated").mkdir()
+    (vendored / "generated" / "out.js").write_text("")
+    # Only ignored inside vendored/, not at the root
+    (tmp_path / "app.min.js").write_text("")
+
+    scan = ProjectScan(include_patterns=["."], cwd=str(tmp_path))
+    paths = {item['id'] for item in scan.tree}
+
+    assert sorted(scan.files) == ["app.min.js", "main.py", "vendored/.gitignore", "vendored/lib.js"]
+    assert "vendored/generated" not in paths
+
+def test_project_scan_prunes_ignored_directories(tmp_path):
+    """Tests that directories matching directory only patterns are never descended into."""
+    (tmp_path / "node_modules" / "pkg").mkdir(parents=True)
+    (tmp_path / "node_modules" / "pkg" / "index.js").write_text("")
+    (tmp_path / "index.js").write_text("")
+
+    with patch('src.file_utils.os.scandir', wraps=os.scandir) as mock_scandir:
+        scan = ProjectScan(include_patterns=["."], cwd=str(tmp_path))
+
+    scanned = [os.path.relpath(call.args[0], tmp_path) for call in mock_scandir.call_args_list]
+    assert scanned == ["."]
+    assert scan.files == ["index.js"]
+    assert "node_modules" not in {item['id'] for item in scan.tree}
+
+def test_project_scan_uses_git_index(tmp_path):
+    """Tests that files come from the git index in a repo, with default, .linignore and extra ignores on top."""
+    subprocess.run(["git", "init", "-q"], cwd=tmp_path, check=True)
+    (tmp_path / ".gitignore").write_text("*.log\n")
+    (tmp_path / ".linignore").write_text("docs/\n")
+    (tmp_path / "main.py").write_text("")
+    (tmp_path / "deleted.py").write_text("")
+    (tmp_path / "Pipfile.lock").write_text("")
+    (tmp_path / "debug.log").write_text("")
+    (tmp_path / "skip.custom").write_text("")
+    (tmp_path / "docs").mkdir()
+    (tmp_path / "docs" / "guide.py").write_text("")
+    (tmp_path / "pkg").mkdir()
+    (tmp_path / "pkg" / "untracked.py").write_text("")
+    subprocess.run(["git", "add", "main.py", "deleted.py", "Pipfile.lock", "docs"], cwd=tmp_path, check=True)
+    (tmp_path / "deleted.py").unlink()
+
+    scan = ProjectScan(["*.custom"], include_patterns=["."], cwd=str(tmp_path))
+
+    assert scan.backend == "git"
+    # Sorted, with untracked files in path order among the tracked ones
+    assert scan.files == [".gitignore", "main.py", "pkg/untracked.py"]
+    assert "pkg" in {item['id'] for item in scan.tree}
+
+    walked = ProjectScan(["*.custom"], include_patterns=["."], cwd=str(tmp_path), use_git=False)
+    assert walked.backend == "walk"
+    assert walked.files == scan.files
+
+def test_project_scan_falls_back_to_walking_outside_git(tmp_path):
+    """Tests that the file system walker is used when the project is not a git repo."""
+    (tmp_path / "main.py").write_text("")
+    scan = ProjectScan(include_patterns=["."], cwd=str(tmp_path))
+    assert scan.backend == "walk"
+    assert scan.files == ["main.py"]
+
+def test_generate_project_file_contents_uses_stat_cache(tmp_path):
+    """Tests that unchanged files are served from the .lin.db cache and changed files are re-read."""
+    db = database.initialize_database(str(tmp_path))
+    (tmp_path / "a.py").write_text("print('a')\n")
+    (tmp_path / "b.py").write_text("print('b')\n")
+
+    try:
+        first = generate_project_file_contents(cwd=str(tmp_path), include_patterns=["*.py"])
+
+        with patch('src.file_utils.read_file_block', side_effect=AssertionError("should be cached")):
+            assert generate_project_file_contents(cwd=str(tmp_path), include_patterns=["*.py"]) == first
+
+        (tmp_path / "b.py").write_text("print('b changed')\n")
+
+        with patch('src.file_utils.read_file_block', wraps=read_file_block) as mock_read:
+            updated = generate_project_file_contents(cwd=str(tmp_path), include_patterns=["*.py"])
+
+        assert [call.args[0] for call in mock_read.call_args_list] == ["b.py"]
+        assert "print('a')" in updated
+        assert "print('b changed')" in updated
+    finally:
+        db.close()
+
+def test_file_cache_evicts_files_and_follows_the_size_limit(tmp_path):
+    """Tests that files no longer in the scan are evicted, and a changed size limit re-reads the file."""
+    db = database.initialize_database(str(tmp_path))
+    (tmp_path / "a.py").write_text("print('a')\n" * 10)
+    (tmp_path / "b.py").write_text("print('b')\n")
+
+    try:
+        generate_project_file_contents(cwd=str(tmp_path), include_patterns=["*.py"])
+        (tmp_path / "b.py").unlink()
+        generate_project_file_contents(cwd=str(tmp_path), include_patterns=["*.py"])
+        with database.db_proxy:
+            assert [row.path for row in database.FileCache.select()] == [str(tmp_path / "a.py")]
+
+        with patch('src.file_utils.MAX_FILE_SIZE', 20):
+            contents = generate_project_file_contents(cwd=str(tmp_path), include_patterns=["*.py"])
+        assert "\n... (truncated, showing 11 bytes of 110 bytes)" in contents
+    finally:
+        db.close()
+
+def test_outdated_file_cache_table_is_dropped(tmp_path):
+    """Tests that a file cache table from an older version (other columns) is replaced, not used."""
+    legacy = sqlite3.connect(tmp_path / ".lin.db")
+    legacy.execute("CREATE TABLE filecache (id INTEGER PRIMARY KEY, path VARCHAR(255) UNIQUE, mtime_ns INTEGER, size INTEGER, inode INTEGER, block TEXT)")
+    legacy.execute("INSERT INTO filecache (path, mtime_ns, size, inode, block) VALUES ('a.py', 0, 0, 0, 'old')")
+    legacy.commit()
+    legacy.close()
+
+    db = database.initialize_database(str(tmp_path))
+    try:
+        with database.db_proxy:
+            assert database.FileCache.select().count() == 0
+            assert "max_size" in [column.name for column in db.get_columns("filecache")]
+    finally:
+        db.close()
+
+def test_generate_project_file_contents_keeps_file_order(tmp_path):
+    """Tests that files read on the thread pool are joined in the same order as the file list."""
+    for index in range(200):
+        (tmp_path / f"file_{index:03}.py").write_text(f"value = {index}\n")
+
+    scan = ProjectScan(include_patterns=["*.py"], cwd=str(tmp_path))
+    contents = generate_project_file_contents(scan=scan)
+
+    positions = [contents.index(f"Path: {file_path}\n") for file_path in scan.files]
+    assert positions == sorted(positions)
+    assert contents == "".join(read_file_block(file_path, str(tmp_path)) for file_path in scan.files)
+
+def test_read_file_block_skips_binary_and_non_utf8_files(tmp_path):
+    """Tests that binary and non UTF-8 files are referenced by path instead of being read."""
+    (tmp_path / "blob.dat").write_bytes(b"abc\0def" * 100)
+    (tmp_path / "latin1.txt").write_bytes("caf\xe9".encode("latin-1"))
+
+    for file_path in ["blob.dat", "latin1.txt"]:
+        block = read_file_block(file_path, str(tmp_path))
+        assert block.startswith(f"    Skipped {file_path}: binary or non UTF-8 file")
+        assert "Path:" not in block
+
+def test_read_file_block_truncates_large_files(tmp_path):
+    """Tests that files over their size limit are cut at a line boundary with a marker."""
+    (tmp_path / "big.py").write_text("x = 1\n" * 10)
+    (tmp_path / "data.json").write_text('{"a": 1}\n' * 10)
+
+    with patch('src.file_utils.MAX_FILE_SIZE', 20), \
+         patch('src.file_utils.MAX_FILE_SIZE_SPECS', [(pathspec.PathSpec.from_lines('gitwildmatch', ['*.json']), 10)]):
+        big = read_file_block("big.py", str(tmp_path))
+        data = read_file_block("data.json", str(tmp_path))
+
+    assert "x = 1\nx = 1\nx = 1\n\n... (truncated, showing 18 bytes of 60 bytes)" in big
+    assert '{"a": 1}\n\n... (truncated, showing 9 bytes of 90 bytes)' in data
+
+def test_human_format_bytes():
+    assert human_format_bytes(0) == "0 bytes"
+    assert human_format_bytes(1023) == "1023 bytes"
+    assert human_format_bytes(1536) == "1.5 KB"
+    assert human_format_bytes(2 * 1024 ** 2) == "2.0 MB"
+    assert human_format_bytes(3 * 1024 ** 4) == "3072.0 GB"
+
+def test_read_file_block_normalizes_newlines(tmp_path):
+    """Tests that files are read with the same newline handling as text mode."""
+    (tmp_path / "windows.txt").write_bytes(b"one\r\ntwo\r\n")
+    assert "one\ntwo\n" in read_file_block("windows.txt", str(tmp_path))
+
 def test_diff_generation(tmp_path):
     """Tests the generation of diffs for existing files."""
     file = tmp_path / "test.txt"
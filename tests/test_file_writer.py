@@ -0,0 +1,71 @@
+import pytest
+import os
+import sys
+import stat
+from unittest.mock import patch
+
+# Make sure the src directory is in the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.parser import BufferedFile
+from src.file_writer import FileWriter, write_file_atomically, UMASK
+
+def buffered_file(content):
+    assembled_file = BufferedFile()
+    assembled_file.add(1, content)
+    return assembled_file
+
+def test_write_file_atomically(tmp_path):
+    full_path = tmp_path / "src" / "main.py"
+    write_file_atomically(str(full_path), buffered_file("print('hello')\n"))
+
+    assert full_path.read_text(encoding='utf-8') == "print('hello')\n"
+    assert stat.S_IMODE(os.stat(full_path).st_mode) == 0o666 & ~UMASK
+    # Nothing left behind
+    assert os.listdir(tmp_path / "src") == ["main.py"]
+
+    # Replacing a file keeps its permissions
+    os.chmod(full_path, 0o755)
+    write_file_atomically(str(full_path), buffered_file("print('hello world')\n"))
+    assert full_path.read_text(encoding='utf-8') == "print('hello world')\n"
+    assert stat.S_IMODE(os.stat(full_path).st_mode) == 0o755
+
+def test_write_file_atomically_fsync(tmp_path):
+    with patch('src.file_writer.os.fsync') as fsync:
+        write_file_atomically(str(tmp_path / "main.py"), buffered_file("x = 1\n"), fsync=True)
+    # The file and its directory
+    assert fsync.call_count == 2
+
+    with patch('src.file_writer.os.fsync') as fsync:
+        write_file_atomically(str(tmp_path / "main.py"), buffered_file("x = 2\n"), fsync=False)
+    fsync.assert_not_called()
+
+def test_write_error_leaves_the_file_alone(tmp_path):
+    full_path = tmp_path / "main.py"
+    full_path.write_text("original\n", encoding='utf-8')
+    assembled_file = buffered_file("new\n")
+
+    with patch.object(assembled_file, 'write_to', side_effect=OSError("disk full")):
+        with pytest.raises(OSError, match="disk full"):
+            write_file_atomically(str(full_path), assembled_file)
+
+    assert full_path.read_text(encoding='utf-8') == "original\n"
+    assert os.listdir(tmp_path) == ["main.py"]
+
+def test_file_writer(tmp_path):
+    (tmp_path / "taken").mkdir()
+    writer = FileWriter(str(tmp_path))
+    try:
+        writer.submit("a.py", buffered_file("v1\n"))
+        writer.submit("taken", buffered_file("not a directory\n"))
+        writer.submit("a.py", buffered_file("v2\n"))
+        results = writer.wait()
+    finally:
+        writer.close()
+
+    assert [file_path for file_path, _ in results] == ["a.py", "taken", "a.py"]
+    assert results[0][1] is None and results[2][1] is None
+    assert isinstance(results[1][1], OSError)
+    # Written in the order they were submitted
+    assert (tmp_path / "a.py").read_text(encoding='utf-8') == "v2\n"
+    assert writer.wait() == []
@@ -0,0 +1,161 @@
+import pytest
+import re
+import os
+import sys
+from unittest.mock import MagicMock, patch
+
+# Make sure the src directory is in the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src import chat, parser, database
+from src.database import StreamJournal
+from src.journal import ResponseJournal, interrupted_responses, clear_interrupted_response
+
+@pytest.fixture
+def project(tmp_path):
+    db = database.initialize_database(str(tmp_path))
+    yield tmp_path
+    db.close()
+
+def journal_rows():
+    with database.db_proxy:
+        return StreamJournal.select().count()
+
+def test_journal_commits_in_batches(project):
+    journal = ResponseJournal(batch_size=3, batch_interval=60)
+    journal.append("Hello")
+    journal.append(", ")
+    assert journal_rows() == 0
+    journal.append("world")
+    assert journal_rows() == 3
+
+    journal.append("!")
+    journal.flush()
+    other = ResponseJournal(batch_size=1)
+    other.append("Another response")
+
+    assert interrupted_responses() == [(journal.stream_id, "Hello, world!"), (other.stream_id, "Another response")]
+
+    journal.clear()
+    assert interrupted_responses() == [(other.stream_id, "Another response")]
+    clear_interrupted_response(other.stream_id)
+    assert journal_rows() == 0
+
+def test_journal_commits_after_interval(project):
+    journal = ResponseJournal(batch_size=100, batch_interval=0)
+    journal.append("Hello")
+    assert journal_rows() == 1
+
+def part_block(file_path, content, part=None):
+    metadata = f"Part: {part}" if part else "NoMoreParts: True"
+    return f"""{parser.placeholder('START FILE METADATA')}
+Path: {file_path}
+Language: python
+Version: 1
+{metadata}
+{parser.placeholder('END FILE METADATA')}
+{content}{parser.placeholder('END OF FILE')}
+"""
+
+def test_recover_and_resume_after_crash(project):
+    """
+    Tests that a response cut off by a crash mid file part is recovered on the next start, and the
+    continuation asks for the part that was cut off again instead of the whole file.
+    """
+    cut_off_part = part_block("main.py", "second = 2\nthird = 3\n", part=2)
+    cut_off_part = cut_off_part[:cut_off_part.index("third") + 3]
+
+    def crashing_stream():
+        yield MagicMock(text="Writing it now.\n" + part_block("main.py", "first = 1\n", part=1), usage_metadata=None)
+        yield MagicMock(text=cut_off_part, usage_metadata=None)
+        raise ConnectionError("Connection reset by peer")
+
+    state = chat.create_session_state(cwd=str(project), writeable=True, async_stream=False, prefetch=False)
+    client = MagicMock()
+    client.models.generate_content_stream.return_value = crashing_stream()
+    with patch('src.chat.get_tmux_logs', return_value=""), pytest.raises(ConnectionError):
+        chat.send_request_to_ai("Write main.py", state, client)
+    assert journal_rows() == 2
+
+    # The next start
+    state = chat.create_session_state(cwd=str(project), writeable=True, async_stream=False, prefetch=False)
+    chat.recover_interrupted_responses(state)
+
+    assert journal_rows() == 0
+    assert state['force_continue']
+    assert state['file_part_buffer'].in_progress() == [("main.py", 1, [1])]
+    with database.db_proxy:
+        assert database.Chat.select().order_by(database.Chat.id.desc()).get().message.startswith("Writing it now.")
+
+    # The model only knows what the note tells it, so it sends the whole part from the start
+    requests = []
+    def generate_content_stream(model, contents, config):
+        requests.append(contents)
+        part = int(re.search(r"continue from part (\d+)", contents[-1].parts[-1].text).group(1))
+        parts = {2: "second = 2\nthird = 3\n", 3: "fourth = 4\n"}
+        text = "".join(part_block("main.py", parts[number], part=number) for number in range(part, 4))
+        return iter([MagicMock(text=text + part_block("main.py", "") + "Done.", usage_metadata=None)])
+    client.models.generate_content_stream.side_effect = generate_content_stream
+
+    with patch('src.chat.get_tmux_logs', return_value=""), patch('src.chat.process_response_metadata'):
+        chat.send_request_to_ai(None, state, client)
+    state['file_writer'].close()
+
+    assert "main.py (v1) part(s) 1, continue from part 2" in requests[0][-1].parts[-1].text
+    assert (project / "main.py").read_text(encoding='utf-8') == "first = 1\nsecond = 2\nthird = 3\nfourth = 4\n"
+    assert journal_rows() == 0
+
+def test_recovery_does_not_write_finished_files_again(project):
+    """
+    Tests that files finished before a crash (and written as they streamed in) are not written over on recovery.
+    """
+    def crashing_stream():
+        yield MagicMock(text="Writing it now.\n" + part_block("main.py", "first = 1\n", part=1) + part_block("main.py", ""),
+                        usage_metadata=None)
+        raise ConnectionError("Connection reset by peer")
+
+    state = chat.create_session_state(cwd=str(project), writeable=True, async_stream=False, prefetch=False)
+    client = MagicMock()
+    client.models.generate_content_stream.return_value = crashing_stream()
+    with patch('src.chat.get_tmux_logs', return_value=""), pytest.raises(ConnectionError):
+        chat.send_request_to_ai("Write main.py", state, client)
+    state['file_writer'].close()
+    assert (project / "main.py").read_text(encoding='utf-8') == "first = 1\n"
+
+    # Edited by hand before the next start
+    (project / "main.py").write_text("edited = True\n", encoding='utf-8')
+    state = chat.create_session_state(cwd=str(project), writeable=True, async_stream=False, prefetch=False)
+    chat.recover_interrupted_responses(state)
+    state['file_writer'].close()
+
+    assert (project / "main.py").read_text(encoding='utf-8') == "edited = True\n"
+    assert not state['force_continue']
+    assert journal_rows() == 0
+
+def test_interrupted_response_is_discarded_when_not_quitting(project):
+    """
+    Tests that a response stopped with Ctrl-C (without quitting) is not left in the journal, to be recovered later on.
+    """
+    def interrupted_stream():
+        yield MagicMock(text="Writing it now.\n", usage_metadata=None)
+        raise KeyboardInterrupt()
+
+    state = chat.create_session_state(cwd=str(project), async_stream=False, prefetch=False)
+    client = MagicMock()
+    client.models.generate_content_stream.return_value = interrupted_stream()
+    session = MagicMock()
+    session.prompt.side_effect = ["Write main.py", "$exit"]
+
+    # Journal rows when asked to quit
+    rows_at_quit_prompt = []
+    def answer_no(prompt):
+        rows_at_quit_prompt.append(journal_rows())
+        return "n"
+
+    with patch('src.chat.get_tmux_logs', return_value=""), patch('builtins.input', side_effect=answer_no):
+        chat.repl_loop(session, client, state)
+
+    assert rows_at_quit_prompt == [1]
+    assert journal_rows() == 0
+    assert interrupted_responses() == []
+    assert state['journal'] is None
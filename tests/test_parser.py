@@ -1,11 +1,18 @@
 import pytest
 import os
+import re
+import json
 import sys
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
 
 # Make sure the src directory is in the Python path
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 import src.parser as parser
+from src.file_writer import write_file_atomically
 
 # Helper to create delimiter strings using the placeholder function
 ph = parser.placeholder
@@ -358,3 +365,213 @@ Language: {language}
 {END_OF_SNIPPET}
 """
     assert parser.snippet_block(content, language) == expected
+
+def stream_events(response, chunk_size):
+    stream_parser = parser.StreamParser()
+    events = []
+    for index in range(0, len(response), chunk_size):
+        events += stream_parser.feed(response[index:index + chunk_size])
+    return events + stream_parser.finish()
+
+def stream_parts(events):
+    return [
+        [metadata['Path'], metadata['Version'], content, metadata.get('Language'), metadata['Part'], metadata['NoMoreParts']]
+        for event_type, (metadata, content) in [event for event in events if event[0] == "part_end"]
+    ]
+
+STREAM_RESPONSES = [
+    "Just some text, no blocks at all.",
+    "Before\n" + parser.file_block("src/main.py", "import os\n\nprint(os.getcwd())\n") + "\nAfter",
+    parser.snippet_block("print('hi')", "python") + "text" + parser.file_block("a.txt", "") + parser.snippet_block("ls -la\n", "bash"),
+    f"{FILE_METADATA_START}Path: raw.py\nPart: 2{FILE_METADATA_END}no newlines{END_OF_FILE}{{{{{{not a marker}}}}}}",
+    "Curly {{{braces}}} {{{START nothing}}} " + parser.file_block("x.py", "a = '{{{'\n\n\n") + "done",
+]
+
+@pytest.mark.parametrize("response", STREAM_RESPONSES)
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 64, 100000])
+def test_stream_parser_matches_find_files_and_find_snippets(response, chunk_size):
+    events = stream_events(response, chunk_size)
+
+    # process_request_stream used to run find_files on each complete block on its own
+    blocks = [match.group(0) for match in re.finditer(parser.match_code_block(), response, flags=re.DOTALL)]
+    assert stream_parts(events) == [parser.find_files(block)[0] for block in blocks if parser.is_file(block)]
+    assert [data for event_type, data in events if event_type == "snippet"] == parser.find_snippets(response)
+
+    text = "".join(data for event_type, data in events if event_type == "text")
+    assert text == "".join(re.split(parser.match_code_block(), response, flags=re.DOTALL)[::2])
+
+def test_stream_parser_file_content_deltas():
+    response = parser.file_block("big.py", "line\n" * 1000)
+    events = stream_events(response, 50)
+    deltas = [data for event_type, data in events if event_type == "file_content"]
+
+    assert len(deltas) > 1
+    # Raw content of both parts, the second (NoMoreParts) one is just a newline
+    assert "".join(deltas) == "\n" + "line\n" * 1000 + "\n" + "\n"
+    assert [event_type for event_type, _ in events if event_type != "file_content"] == [
+        "text", "file_metadata", "part_end", "text", "file_metadata", "part_end", "text"]
+
+def test_stream_parser_incomplete_file_part():
+    response = f"Intro\n{FILE_METADATA_START}\nPath: cut.py\nPart: 1\n{FILE_METADATA_END}\nline 1\nline 2\nline 3 is cut o"
+    stream_parser = parser.StreamParser()
+    events = stream_parser.feed(response[:40]) + stream_parser.feed(response[40:])
+    final_events = stream_parser.finish()
+
+    block_start = response.index(FILE_METADATA_START)
+    assert stream_parser.block_start == block_start
+    assert final_events == [("part_incomplete", (parser.parse_metadata("Path: cut.py\nPart: 1\n"), "line 1\nline 2\n"))]
+    # Same as the previous approach, which dropped the last line then ran find_files(incomplete=True)
+    assert parser.find_files("\n".join(response[block_start:].splitlines()[:-1]), incomplete=True)[0][2] == "line 1\nline 2\n"
+
+def test_stream_parser_incomplete_metadata_and_snippet():
+    stream_parser = parser.StreamParser()
+    stream_parser.feed(f"{FILE_METADATA_START}\nPath: cut")
+    assert stream_parser.finish() == [("block_incomplete", f"{FILE_METADATA_START}\nPath: cut")]
+
+    stream_parser = parser.StreamParser()
+    snippet = f"{SNIPPET_METADATA_START}\nLanguage: python\n{SNIPPET_METADATA_END}\nprint("
+    assert stream_parser.feed(snippet) == []
+    assert stream_parser.finish() == [("text", snippet)]
+
+def test_scan_blocks():
+    file_blocks = parser.file_block("a.py", "x = 1", language="python")
+    snippet = parser.snippet_block("ls", "sh")
+    terminal_log = parser.terminal_log_block("$ ls\nREADME.md", "shell")
+    content = f"Intro\n{file_blocks}Between {snippet}{terminal_log}{SNIPPET_METADATA_START} never closed"
+
+    blocks = parser.scan_blocks(content)
+
+    assert [(kind, metadata, block_content) for kind, _, _, metadata, block_content in blocks] == [
+        ("file", "\nPath: a.py\nLanguage: python\nVersion: 1\nPart: 1\n", "x = 1\n"),
+        ("file", "\nPath: a.py\nLanguage: python\nVersion: 1\nNoMoreParts: True\n", ""),
+        ("snippet", "\nLanguage: sh\n", "ls\n"),
+        ("terminal", "\nName: shell\n", "$ ls\nREADME.md\n"),
+    ]
+    spans = [content[start:end] for _, start, end, _, _ in blocks]
+    assert spans[0] == file_blocks.strip().split("\n\n")[0]
+    assert spans[2] == snippet.strip()
+    assert spans[3] == terminal_log.strip()
+
+def test_language_table_matches_pygments(tmp_path, monkeypatch):
+    monkeypatch.setattr(parser, 'LANGUAGE_TABLE', None)
+    cache_file = tmp_path / "cache" / "languages.json"
+    parser.load_language_table(cache_file=str(cache_file))
+
+    with open(cache_file, 'r', encoding='utf-8') as f:
+        table = json.load(f)
+    # Extensions claimed by more than one lexer (.h, .m, .pl, .inc) use the same tie break as pygments
+    for filename in ["a.py", "a.h", "a.m", "a.pl", "a.inc", "a.txt", "CMakeLists.txt", "page.html.j2", "Makefile.am"]:
+        expected = parser.get_lexer_for_filename(filename).name.lower()
+        assert parser.language_for_filename(os.path.join("some", "dir", filename)) == expected
+    assert parser.language_for_filename("unknown.foobar") == "text"
+
+    # Loaded from the cache file next time, unless pygments was upgraded
+    monkeypatch.setattr(parser, 'LANGUAGE_TABLE', None)
+    with open(cache_file, 'w', encoding='utf-8') as f:
+        json.dump(dict(table, special_patterns=[], extensions={'.py': 'cached python'}), f)
+    assert parser.load_language_table(cache_file=str(cache_file))['extensions'] == {'.py': 'cached python'}
+
+    monkeypatch.setattr(parser, 'LANGUAGE_TABLE', None)
+    with open(cache_file, 'w', encoding='utf-8') as f:
+        json.dump(dict(table, pygments="0.0", extensions={}), f)
+    assert parser.load_language_table(cache_file=str(cache_file))['extensions']['.py'] == "python"
+
+def test_language_table_is_built_once_by_concurrent_readers(tmp_path, monkeypatch):
+    monkeypatch.setattr(parser, 'LANGUAGE_TABLE', None)
+    cache_file = tmp_path / "cache" / "languages.json"
+    barrier = threading.Barrier(8)
+
+    def load():
+        barrier.wait()
+        return parser.load_language_table(cache_file=str(cache_file))
+
+    with patch('src.parser.build_language_table', wraps=parser.build_language_table) as build:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            tables = list(executor.map(lambda _: load(), range(8)))
+
+    assert build.call_count == 1
+    assert all(table is tables[0] for table in tables)
+    # Written through a temp file, which is renamed into place
+    assert os.listdir(cache_file.parent) == ["languages.json"]
+    with open(cache_file, 'r', encoding='utf-8') as f:
+        assert json.load(f)['extensions']['.py'] == "python"
+
+def test_language_from_shebang_is_memoized_by_mtime(tmp_path):
+    script = tmp_path / "run"
+    script.write_text("#!/usr/bin/env python\nprint('hi')\n", encoding='utf-8')
+    os.utime(script, ns=(1_000_000_000, 1_000_000_000))
+
+    assert parser.get_language_from_extension(str(script)) == "python"
+    hits = parser.language_for_file_contents.cache_info().hits
+    assert parser.get_language_from_extension(str(script)) == "python"
+    assert parser.language_for_file_contents.cache_info().hits == hits + 1
+
+    script.write_text("#!/bin/bash\necho hi\n", encoding='utf-8')
+    os.utime(script, ns=(2_000_000_000, 2_000_000_000))
+    assert parser.get_language_from_extension(str(script)) == "bash"
+
+def test_file_part_buffer_assembles_parts_in_order():
+    buffer = parser.FilePartBuffer()
+    buffer.add("a.py", "second ✓\n", 2, False, 1)
+    buffer.add("a.py", "first\n", 1, False, 1)
+    buffer.add("b.py", "other\n", 1, False, 1)
+
+    assert not buffer.is_complete("a.py", 1)
+    assert buffer.pop("a.py", 1) is None
+    assert buffer.in_progress() == [("a.py", 1, [1, 2]), ("b.py", 1, [1])]
+
+    buffer.add("a.py", "", 0, True, 1)
+    assert buffer.in_progress() == [("b.py", 1, [1])]
+    assert buffer.missing_parts("a.py", 1) == []
+    assert buffer.pop("a.py", 1).read() == "first\nsecond ✓\n"
+    assert list(buffer.buffer) == [("b.py", 1)]
+
+def test_file_part_buffer_reports_missing_parts():
+    buffer = parser.FilePartBuffer()
+    buffer.add("a.py", "one\n", 1, False, 2)
+    buffer.add("a.py", "four\n", 4, False, 2)
+    buffer.add("a.py", "", 0, True, 2)
+
+    assert buffer.missing_parts("a.py", 2) == [2, 3]
+    assert buffer.pop("a.py", 2).read() == "one\nfour\n"
+
+def test_file_part_buffer_spills_to_disk_and_writes_the_file(tmp_path):
+    buffer = parser.FilePartBuffer(spill_size=1024)
+    buffer.add("big.txt", "a" * 1000, 1, False, 1)
+    assert not buffer.buffer[("big.txt", 1)].on_disk
+    buffer.add("big.txt", "b" * 1000, 2, False, 1)
+    assert buffer.buffer[("big.txt", 1)].on_disk
+    buffer.add("big.txt", "", 0, True, 1)
+
+    write_file_atomically(str(tmp_path / "big.txt"), buffer.pop("big.txt", 1))
+    assert (tmp_path / "big.txt").read_text(encoding='utf-8') == "a" * 1000 + "b" * 1000
+
+PEAK_RSS_SCRIPT = """
+import resource, sys
+sys.path.insert(0, sys.argv[1])
+from src.parser import FilePartBuffer
+from src.file_writer import write_file_atomically
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # KB on Linux
+
+baseline = peak_rss_mb()
+buffer = FilePartBuffer()
+for part in range(1, 65):
+    buffer.add("generated.js", chr(ord("a") + part % 26) * (1024 * 1024), part, False, 1)
+buffer.add("generated.js", "", 0, True, 1)
+write_file_atomically(sys.argv[2], buffer.pop("generated.js", 1))
+print(peak_rss_mb() - baseline)
+"""
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="ru_maxrss is in KB on Linux only")
+def test_file_part_buffer_peak_rss(tmp_path):
+    # Run in a fresh process, since peak RSS only ever goes up
+    result = subprocess.run(
+        [sys.executable, "-c", PEAK_RSS_SCRIPT, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')),
+         str(tmp_path / "generated.js")],
+        capture_output=True, text=True, check=True)
+
+    assert os.path.getsize(tmp_path / "generated.js") == 64 * 1024 * 1024
+    # 64MB of parts, but only about one part (plus the in memory spool) is held at a time
+    assert float(result.stdout) < 16
@@ -0,0 +1,57 @@
+import pytest
+import os
+import sys
+from types import SimpleNamespace
+from unittest.mock import patch
+
+# Make sure the src directory is in the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src import parser
+from src.planner import rank_files, mentioned_files, plan_file_blocks, estimate_tokens, SKIPPED_FILES_NOTE
+
+FILES = ["src/a.py", "src/b.py", "src/c.py", "README.md"]
+
+def test_rank_files_signals():
+    """Tests that @ references beat recent mentions, which beat older mentions and dirty files."""
+    scores = rank_files(
+        FILES,
+        message="Can you look at @src/c.py?",
+        history=["I changed src/b.py", "older message about src/a.py"],
+        dirty_files={"README.md"})
+
+    assert scores["src/c.py"] > scores["src/b.py"] > scores["src/a.py"] > 0
+    assert scores["src/b.py"] > scores["README.md"] > 0
+
+def test_mentioned_files_matches_whole_paths():
+    """Tests that mentions are matched by whole path (not as a substring of another path), newest first."""
+    file_paths = ["a.py", "data.py", "src/chat.py"]
+    history = [
+        "Updated data.py and src/chat.pyc.",
+        f"{parser.placeholder('START FILE METADATA')}\nPath: src/chat.py\nVersion: 1\n",
+        "See @a.py, and src/chat.py.",
+    ]
+
+    assert mentioned_files(history, file_paths) == {"data.py": 0, "src/chat.py": 1, "a.py": 2}
+
+def test_plan_file_blocks_keeps_everything_under_budget(tmp_path):
+    """Tests that nothing is left out when all files fit."""
+    scan = SimpleNamespace(files=FILES, cwd=str(tmp_path))
+    blocks = [f"block for {file_path}\n" for file_path in FILES]
+
+    assert plan_file_blocks(scan, blocks, token_budget=10000) == (blocks, [])
+
+@patch('src.planner.git_dirty_files', return_value={"README.md"})
+@patch('src.planner.recent_messages', return_value=["we talked about src/b.py"])
+def test_plan_file_blocks_fills_budget_greedily(_mock_messages, _mock_dirty, tmp_path):
+    """Tests that the highest ranked files that fit are picked, in their original order."""
+    scan = SimpleNamespace(files=FILES, cwd=str(tmp_path))
+    blocks = ["a" * 400, "b" * 400, "c" * 4000, "r" * 400]
+    # The note about the files left out counts against the budget too
+    budget = estimate_tokens(blocks[1]) + estimate_tokens(blocks[3]) + estimate_tokens(SKIPPED_FILES_NOTE)
+
+    selected, skipped = plan_file_blocks(scan, blocks, budget, message="what about @src/c.py")
+
+    # src/c.py is referenced but too big, so the next best files fill the budget
+    assert selected == [blocks[1], blocks[3]]
+    assert skipped == ["src/a.py", "src/c.py"]
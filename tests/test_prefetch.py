@@ -0,0 +1,115 @@
+import pytest
+import os
+import sys
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+# Make sure the src directory is in the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src import chat, database
+from src.prefetch import ContextPrefetcher
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+def test_context_prefetcher():
+    builds = []
+    prefetcher = ContextPrefetcher(lambda: builds.append(threading.current_thread().name) or len(builds), interval=60)
+
+    prefetcher.start()
+    wait_for(lambda: prefetcher.latest)
+    assert prefetcher.latest[0] == 1
+    prefetcher.refresh()
+    wait_for(lambda: prefetcher.latest[0] == 2)
+
+    context, build_seconds, waited = prefetcher.take()
+    assert context == 2
+    assert build_seconds >= 0 and waited >= 0
+    assert prefetcher.thread is None
+    assert builds == ["linus-prefetch", "linus-prefetch"]
+    # Nothing to take until it is started again
+    assert prefetcher.take()[0] is None
+
+def test_context_prefetcher_skips_stale_context():
+    """Tests that a context is not used if what it was built from changed since."""
+    version = [1]
+    prefetcher = ContextPrefetcher(lambda: "context", interval=60, fingerprint=lambda: version[0])
+
+    prefetcher.start()
+    wait_for(lambda: prefetcher.latest)
+    assert prefetcher.take()[0] == "context"
+
+    prefetcher.start()
+    wait_for(lambda: prefetcher.latest)
+    version[0] = 2
+    assert prefetcher.take()[0] is None
+
+def test_context_prefetcher_build_error():
+    prefetcher = ContextPrefetcher(MagicMock(side_effect=ValueError("no database")), interval=60)
+    prefetcher.start()
+    wait_for(lambda: prefetcher.build.call_count)
+    assert prefetcher.take()[0] is None
+
+@pytest.fixture
+def project(tmp_path):
+    (tmp_path / "main.py").write_text("print('hello')\n", encoding='utf-8')
+    db = database.initialize_database(str(tmp_path))
+    yield tmp_path
+    db.close()
+
+def test_prefetch_needs_the_watcher_for_files(project):
+    state = chat.create_session_state(cwd=str(project), include_patterns=["."], prefetch=True, async_stream=False)
+    assert state['prefetcher'] is None
+    state = chat.create_session_state(cwd=str(project), prefetch=True, async_stream=False)
+    assert state['prefetcher'] is not None
+
+def test_repl_sends_prefetched_context(project):
+    state = chat.create_session_state(cwd=str(project), include_patterns=["."], watch=True, request_layout="stable", prefetch=True, async_stream=False)
+    state['prefetcher'].interval = 60
+    state['watcher'].start()
+    client = MagicMock()
+    requests = []
+
+    def generate_content_stream(model, contents, config):
+        requests.append(contents)
+        return iter([MagicMock(text="Ok.", usage_metadata=None)])
+    client.models.generate_content_stream.side_effect = generate_content_stream
+
+    def type_message(_):
+        prefetcher = state['prefetcher']
+        wait_for(lambda: prefetcher.latest)
+        # A change while typing is picked up on the next rebuild
+        (project / "main.py").write_text("print('hello world')\n", encoding='utf-8')
+        # The watcher refreshes the prefetcher once it has the change (a build started before that is stale)
+        wait_for(lambda: prefetcher.latest and "print('hello world')" in prefetcher.latest[0]['context_prompt']
+                 and prefetcher.latest[2] == chat.prefetch_fingerprint(state))
+        return "Hello"
+
+    answers = iter([type_message, lambda _: "$exit"])
+    session = MagicMock()
+    session.prompt.side_effect = lambda prompt: next(answers)(prompt)
+
+    build_threads = []
+    def request_context(*args):
+        build_threads.append(threading.current_thread().name)
+        return original_request_context(*args)
+    original_request_context = chat.request_context
+
+    try:
+        with patch('src.chat.request_context', side_effect=request_context), \
+             patch('src.chat.get_tmux_logs', return_value=""):
+            chat.repl_loop(session, client, state)
+    finally:
+        state['watcher'].stop()
+
+    # The context was only built in the background, and the request used the latest one
+    assert set(build_threads) == {"linus-prefetch"}
+    assert "print('hello world')" in requests[0][0].parts[0].text
+    assert requests[0][-1].parts[-1].text.endswith("Hello")
+    assert state['prefetch_saved_ms'] is not None
+    assert state['prefetcher'].thread is None
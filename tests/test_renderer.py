@@ -0,0 +1,77 @@
+import pytest
+import os
+import sys
+from unittest.mock import patch
+
+# Make sure the src directory is in the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.renderer import StreamRenderer
+
+RESPONSE = (
+    "First paragraph,\nover two lines.\n\n"
+    "```python\ndef hello():\n\n    return 'world'\n```\n\n"
+    "- one\n- two\n\n"
+    "Last paragraph, still streaming"
+)
+
+@patch('src.renderer.console')
+@patch('src.renderer.print_markdown')
+def test_renders_completed_blocks(mock_print_markdown, mock_console):
+    renderer = StreamRenderer("Thinking...", fps=1_000_000, quiet=False)
+    for char in RESPONSE:
+        renderer.text(char)
+
+    sections = [call.args[0] for call in mock_print_markdown.call_args_list]
+    # Each block is rendered once it is complete, a blank line in a code block doesn't end it
+    assert sections == [
+        "First paragraph,\nover two lines.",
+        "```python\ndef hello():\n\n    return 'world'\n```",
+        "- one\n- two",
+    ]
+    # A blank line between sections, except before a list (rich adds one)
+    assert mock_console.print.call_count == 1
+
+    renderer.flush()
+    assert mock_print_markdown.call_args.args[0] == "Last paragraph, still streaming"
+    assert renderer.cpu_seconds > 0
+
+@patch('src.renderer.console')
+@patch('src.renderer.print_markdown')
+def test_coalesces_frames(mock_print_markdown, mock_console):
+    renderer = StreamRenderer("Thinking...", fps=0.001, quiet=False)
+    for char in RESPONSE:
+        renderer.text(char)
+
+    # The first frame renders right away, the rest waits for the next frame (or the end)
+    assert [call.args[0] for call in mock_print_markdown.call_args_list] == ["First paragraph,\nover two lines."]
+    renderer.flush()
+    assert mock_print_markdown.call_args.args[0] == RESPONSE[RESPONSE.index("```"):]
+
+    renderer.markdown("```sh\nls\n```")
+    assert mock_print_markdown.call_count == 3
+
+@patch('src.renderer.console')
+def test_status_updates_on_change(mock_console):
+    with StreamRenderer("Thinking...", quiet=False) as renderer:
+        status = mock_console.status.return_value.__enter__.return_value
+        for _ in range(10):
+            renderer.status("Typing...")
+        renderer.status("Writing main.py...")
+        renderer.status("Typing...")
+
+    assert [call.args[0] for call in status.update.call_args_list] == ["Typing...", "Writing main.py...", "Typing..."]
+
+@patch('src.renderer.console')
+@patch('src.renderer.print_markdown')
+def test_quiet_passthrough(mock_print_markdown, mock_console, capsys):
+    with StreamRenderer("Thinking...", fps=1_000_000, quiet=True) as renderer:
+        for char in RESPONSE:
+            renderer.text(char)
+        renderer.flush(end="\n")
+        renderer.markdown("```sh\nls\n```")
+        renderer.status("Typing...")
+
+    assert capsys.readouterr().out == RESPONSE + "\n```sh\nls\n```\n"
+    mock_print_markdown.assert_not_called()
+    mock_console.status.assert_not_called()
@@ -6,7 +6,9 @@ from unittest.mock import MagicMock, patch
 # Make sure the src directory is in the Python path
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+from prompt_toolkit.document import Document
 from src.repl import FilePathCompleter, CommandCompleter
+from src.file_utils import ProjectScan
 
 # TODO: Create a fixture for a temporary directory with files to test completion against.
 # For now, we'll mock the os.walk and other filesystem functions.
@@ -25,3 +27,20 @@ def test_file_path_completer_suggestions():
     """Tests that the file path completer provides correct file and directory suggestions."""
     # Test cases for FilePathCompleter suggestions
     pass
+
+def test_file_path_completer_reuses_scans(tmp_path):
+    """Tests that completions come from the session's latest scan, or one scan of the project reused between keystrokes."""
+    (tmp_path / "main.py").write_text("")
+    (tmp_path / "readme.md").write_text("")
+    latest = MagicMock(files=["src/main.py"])
+
+    completer = FilePathCompleter(str(tmp_path), latest_scan=lambda: latest)
+    completions = list(completer.get_completions(Document("Look at @"), None))
+    assert [completion.text for completion in completions] == ["src/main.py"]
+
+    completer = FilePathCompleter(str(tmp_path), latest_scan=lambda: None)
+    with patch('src.repl.ProjectScan', wraps=ProjectScan) as scans:
+        for text in ["@", "Look @", "Look at @"]:
+            completions = list(completer.get_completions(Document(text), None))
+    assert sorted(completion.text for completion in completions) == ["main.py", "readme.md"]
+    assert scans.call_count == 1
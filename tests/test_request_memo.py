@@ -0,0 +1,71 @@
+import pytest
+import os
+import sys
+from unittest.mock import MagicMock, patch
+
+# Make sure the src directory is in the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src import chat, database
+from src.request_memo import RequestMemo
+
+def test_request_memo():
+    memo = RequestMemo()
+    build = MagicMock(side_effect=["first", "second"])
+
+    assert memo.get('component', ('a', 1), build) == "first"
+    assert memo.get('component', ('a', 1), build) == "first"
+    memo.start_request()
+    assert memo.get('component', ('a', 2), build) == "second"
+
+    assert build.call_count == 2
+    assert (memo.hits, memo.misses) == (1, 2)
+    assert (memo.request_hits, memo.request_misses) == (0, 1)
+
+@pytest.fixture
+def project(tmp_path):
+    (tmp_path / "main.py").write_text("print('hello')\n", encoding='utf-8')
+    db = database.initialize_database(str(tmp_path))
+    yield tmp_path
+    db.close()
+
+@pytest.mark.parametrize("layout", ["default", "stable"])
+def test_unchanged_request_context_is_reused(project, layout):
+    state = chat.create_session_state(cwd=str(project), include_patterns=["."], request_layout=layout, async_stream=False)
+    client = MagicMock()
+    requests = []
+
+    def generate_content_stream(model, contents, config):
+        requests.append((config, contents))
+        return iter([MagicMock(text="Ok.", usage_metadata=None)])
+    client.models.generate_content_stream.side_effect = generate_content_stream
+
+    tmux = {'fingerprint': ("%1", "session", "%2 1700000000 10 0 5 zsh"), 'logs': "$ ls\n"}
+    with patch('src.chat.get_tmux_fingerprint', side_effect=lambda: tmux['fingerprint']), \
+         patch('src.chat.get_tmux_logs', side_effect=lambda: tmux['logs']) as get_tmux_logs, \
+         patch('src.chat.generate_project_file_blocks', wraps=chat.generate_project_file_blocks) as file_blocks:
+        chat.send_request_to_ai("First", state, client)
+        chat.send_request_to_ai("Second", state, client)
+
+        memo = state['request_memo']
+        assert file_blocks.call_count == 1
+        assert get_tmux_logs.call_count == 1
+        assert (memo.request_hits, memo.request_misses) == (5, 0)
+        if layout == "stable":
+            assert requests[1][1][0].parts[0] is requests[0][1][0].parts[0]
+        assert requests[1][0].system_instruction is requests[0][0].system_instruction
+
+        (project / "main.py").write_text("print('hello world')\n", encoding='utf-8')
+        tmux['fingerprint'] = ("%1", "session", "%2 1700000009 11 0 6 zsh")
+        tmux['logs'] = "$ python main.py\n"
+        chat.send_request_to_ai("Third", state, client)
+
+        assert file_blocks.call_count == 2
+        assert get_tmux_logs.call_count == 2
+        assert (memo.request_hits, memo.request_misses) == (1, 4) # Only the system prompt
+        latest = requests[2][1][-1].parts[0].text
+        assert "$ python main.py" in latest
+        if layout == "default":
+            assert "print('hello world')" in latest
+        else:
+            assert "print('hello world')" in requests[2][1][0].parts[0].text
@@ -0,0 +1,119 @@
+import pytest
+import asyncio
+import os
+import sys
+import time
+import threading
+from unittest.mock import MagicMock, patch
+
+# Make sure the src directory is in the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src import chat, parser, database
+from src.stream_pipeline import run_pipeline
+from src.journal import ResponseJournal
+
+async def fake_stream(chunks, received, delay=0):
+    for chunk in chunks:
+        if delay:
+            await asyncio.sleep(delay)
+        received.append(chunk)
+        yield chunk
+
+def test_pipeline_keeps_order_and_batches():
+    received = []
+    rendered = []
+    batches = []
+
+    def render(events):
+        batches.append(len(events))
+        time.sleep(0.01)
+        rendered.extend(events)
+
+    timings = asyncio.run(run_pipeline(fake_stream(range(100), received), lambda chunk: [chunk, -chunk], render, queue_size=4))
+
+    assert rendered == [event for chunk in range(100) for event in [chunk, -chunk]]
+    # Events that queue up while rendering are rendered together
+    assert len(batches) < 100
+    assert 0 < timings['first_render'] <= timings['total']
+
+def test_pipeline_backpressure():
+    received = []
+    ahead = []
+
+    def render(events):
+        # How far receiving got ahead of rendering
+        ahead.append(len(received) - events[-1])
+        time.sleep(0.005)
+
+    asyncio.run(run_pipeline(fake_stream(range(200), received), lambda chunk: [chunk], render, queue_size=4))
+    # Bounded by the two queues, one chunk in each stage and the batch being rendered
+    assert max(ahead) <= 4 + 4 + 3
+
+def test_pipeline_errors():
+    def render(events):
+        raise ValueError("bad markdown")
+
+    with pytest.raises(ValueError, match="bad markdown"):
+        asyncio.run(run_pipeline(fake_stream(range(1000), []), lambda chunk: [chunk], render, queue_size=4))
+
+class FakeAsyncClient:
+    """Streams the given chunks through client.aio, like the SDK's async client."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.aio = MagicMock()
+        self.aio.models.generate_content_stream = self.generate_content_stream
+
+    async def generate_content_stream(self, model, contents, config):
+        return fake_stream([MagicMock(text=text, usage_metadata=None) for text in self.chunks], [], delay=0.001)
+
+@pytest.fixture
+def project(tmp_path):
+    db = database.initialize_database(str(tmp_path))
+    yield tmp_path
+    db.close()
+
+def test_send_request_with_async_stream(project):
+    file_content = "def hello():\n    return 'world'\n" * 50
+    response = "Here you go.\n\n" + parser.file_block("src/hello.py", file_content, language="python") + "\nAll done."
+    chunks = [response[index:index + 37] for index in range(0, len(response), 37)]
+    state = chat.create_session_state(cwd=str(project), writeable=True, async_stream=True)
+
+    with patch('src.chat.get_tmux_logs', return_value=""):
+        try:
+            chat.send_request_to_ai("Write hello", state, FakeAsyncClient(chunks))
+            # The runner's event loop is reused for the next request
+            chat.send_request_to_ai("Again", state, FakeAsyncClient(chunks))
+        finally:
+            state['stream_runner'].close()
+
+    assert (project / "src" / "hello.py").read_text(encoding='utf-8') == file_content
+    assert not state['force_continue']
+    assert state['stream_timings']['total'] > 0
+    with database.db_proxy:
+        messages = [row.message for row in database.Chat.select().order_by(database.Chat.timestamp)]
+    assert messages[-1].startswith("Here you go.") and messages[-1].endswith("All done.")
+    assert "def hello" not in messages[-1]
+
+def test_async_stream_journals_off_the_event_loop(project):
+    chunks = [f"Chunk {index}. " for index in range(20)]
+    state = chat.create_session_state(cwd=str(project), async_stream=True)
+    flush = ResponseJournal.flush
+    flushed = []
+
+    def record_flush(journal):
+        flushed.append((threading.current_thread() is threading.main_thread(), len(journal.pending)))
+        flush(journal)
+
+    with patch('src.chat.get_tmux_logs', return_value=""), \
+         patch('src.chat.ResponseJournal', lambda: ResponseJournal(batch_size=5, batch_interval=60)), \
+         patch.object(ResponseJournal, 'flush', record_flush):
+        try:
+            chat.send_request_to_ai("Count", state, FakeAsyncClient(chunks))
+        finally:
+            state['stream_runner'].close()
+
+    # Full batches are committed in worker threads while streaming, the (empty) final flush runs on the main thread
+    assert flushed[:-1] == [(False, 5)] * 4
+    assert flushed[-1] == (True, 0)
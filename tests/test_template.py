@@ -0,0 +1,48 @@
+import pytest
+import os
+import sys
+
+# Make sure the src directory is in the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src import parser
+from src.template import Template, load_template, read_cached_file, render_template
+
+def test_template_render():
+    template = Template(f"Tree:\n{parser.FILE_TREE_PLACEHOLDER}\nFiles:\n{parser.FILES_PLACEHOLDER}\n{{{{{{END OF FILE}}}}}}\n")
+    assert template.placeholders == [parser.FILE_TREE_PLACEHOLDER, parser.FILES_PLACEHOLDER]
+
+    rendered = template.render({parser.FILE_TREE_PLACEHOLDER: '[]', parser.FILES_PLACEHOLDER: f"a {parser.FILES_PLACEHOLDER} b"})
+    # Values are not rendered again, other markers are kept and missing values are left empty
+    assert rendered == f"Tree:\n[]\nFiles:\na {parser.FILES_PLACEHOLDER} b\n{{{{{{END OF FILE}}}}}}\n"
+    assert template.render({}) == "Tree:\n\nFiles:\n\n{{{END OF FILE}}}\n"
+
+    # Same as the chained replaces it stands in for
+    values = {parser.FILE_TREE_PLACEHOLDER: '["x"]', parser.FILES_PLACEHOLDER: "y"}
+    text = template.render({name: name for name in template.placeholders})
+    for name, value in values.items():
+        text = text.replace(name, value)
+    assert template.render(values) == text
+
+def test_template_cache(tmp_path):
+    path = tmp_path / "prompt.md"
+    path.write_text(f"Logs: {parser.TERMINAL_LOGS_PLACEHOLDER}", encoding='utf-8')
+
+    template = load_template(str(path))
+    assert load_template(str(path)) is template
+    assert render_template(str(path), {parser.TERMINAL_LOGS_PLACEHOLDER: "$ ls"}) == "Logs: $ ls"
+
+    # A new mtime or size means the file is read again
+    path.write_text(f"Terminal logs: {parser.TERMINAL_LOGS_PLACEHOLDER}", encoding='utf-8')
+    assert load_template(str(path)) is not template
+    assert render_template(str(path), {parser.TERMINAL_LOGS_PLACEHOLDER: "$ ls"}) == "Terminal logs: $ ls"
+
+    stat = os.stat(path)
+    path.write_text(f"Terminal Logs: {parser.TERMINAL_LOGS_PLACEHOLDER}", encoding='utf-8')
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+    assert read_cached_file(str(path)).startswith("Terminal Logs:")
+
+    os.remove(path)
+    assert read_cached_file(str(path)) is None
+    with pytest.raises(FileNotFoundError):
+        load_template(str(path))
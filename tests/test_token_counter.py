@@ -0,0 +1,84 @@
+import pytest
+import os
+import sys
+from types import SimpleNamespace
+
+# Make sure the src directory is in the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src import cli, database
+from src.token_counter import count_file_tokens, directory_totals
+
+class FakeModels:
+    def __init__(self):
+        self.calls = []
+
+    def count_tokens(self, model, contents):
+        self.calls.append((model, contents))
+        return SimpleNamespace(total_tokens=len(contents))
+
+class FakeClient:
+    def __init__(self):
+        self.models = FakeModels()
+
+@pytest.fixture
+def project(tmp_path):
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "big.py").write_text("x" * 30)
+    (tmp_path / "src" / "copy.py").write_text("x" * 30)
+    (tmp_path / "small.py").write_text("y" * 5)
+    db = database.initialize_database(str(tmp_path))
+    yield tmp_path
+    db.close()
+
+def test_count_file_tokens_caches_by_content_and_model(project):
+    """Tests that a second run only counts changed files, and duplicates are counted once."""
+    client = FakeClient()
+    files = ["src/big.py", "src/copy.py", "small.py"]
+
+    counts, errors = count_file_tokens(client, "model-a", str(project), files)
+    assert counts == {"src/big.py": 30, "src/copy.py": 30, "small.py": 5}
+    assert errors == {}
+    assert len(client.models.calls) == 2
+
+    (project / "small.py").write_text("y" * 7)
+    client = FakeClient()
+    counts, _ = count_file_tokens(client, "model-a", str(project), files)
+    assert counts["small.py"] == 7
+    assert [contents for _, contents in client.models.calls] == ["y" * 7]
+
+    # A different model has its own counts
+    client = FakeClient()
+    count_file_tokens(client, "model-b", str(project), files)
+    assert len(client.models.calls) == 2
+
+def test_count_file_tokens_reports_errors(project):
+    """Tests that unreadable files are reported instead of counted."""
+    counts, errors = count_file_tokens(FakeClient(), "model-a", str(project), ["missing.py", "small.py"])
+    assert counts == {"small.py": 5}
+    assert isinstance(errors["missing.py"], FileNotFoundError)
+
+def test_directory_totals():
+    assert directory_totals({"a/b/c.py": 3, "a/d.py": 2, "e.py": 1}) == {"a/b": 3, "a": 5}
+
+def test_handle_tokens_report(project, capsys):
+    """Tests the -t report with per file and per directory totals, largest first."""
+    args = SimpleNamespace(directory=str(project), ignore=None, files=".")
+    cli.handle_tokens(args, client=FakeClient())
+
+    output = capsys.readouterr().out
+    assert "Files\n" in output
+    assert "Directories\n" in output
+    assert output.index("src/big.py") < output.index("small.py")
+    assert "60.0  src\n" in output
+    assert output.strip().endswith("Total tokens: 65")
+
+def test_handle_tokens_estimate_offline(project, capsys):
+    """Tests that -t with --estimate reports estimated counts without a client."""
+    args = SimpleNamespace(directory=str(project), ignore=None, files=".", estimate=True)
+    cli.handle_tokens(args, client=None)
+
+    output = capsys.readouterr().out
+    assert "src/big.py" in output
+    assert "Estimated" in output
+    assert "Total tokens: " in output
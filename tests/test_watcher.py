@@ -0,0 +1,110 @@
+import pytest
+import os
+import sys
+import time
+from unittest.mock import patch
+
+# Make sure the src directory is in the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.watcher import ProjectWatcher, ProjectEventHandler
+
+@pytest.fixture
+def project_dir(tmp_path):
+    (tmp_path / "a.py").write_text("print('a')\n")
+    (tmp_path / "notes.txt").write_text("not included\n")
+    return tmp_path
+
+def wait_for_snapshot(watcher, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        snapshot = watcher.snapshot()
+        if snapshot:
+            return snapshot
+        time.sleep(0.05)
+    return None
+
+def test_snapshot_is_none_until_refreshed(project_dir):
+    """Tests that a watcher has nothing to offer before its first refresh."""
+    watcher = ProjectWatcher(include_patterns=["*.py"], cwd=str(project_dir))
+    assert watcher.snapshot() is None
+
+    watcher.refresh()
+    scan, blocks = watcher.snapshot()
+    assert scan.files == ["a.py"]
+    assert "print('a')" in blocks[0]
+
+def test_mark_dirty_invalidates_snapshot(project_dir):
+    """Tests that change events invalidate the snapshot until the next refresh."""
+    watcher = ProjectWatcher(include_patterns=["*.py"], cwd=str(project_dir))
+    watcher.refresh()
+
+    watcher.mark_dirty()
+    assert watcher.snapshot() is None
+
+    watcher.refresh()
+    assert watcher.snapshot() is not None
+
+def test_on_refresh_is_called_when_published(project_dir):
+    """Tests that listeners (i.e. the context prefetcher) hear about new snapshots, but not discarded ones."""
+    watcher = ProjectWatcher(include_patterns=["*.py"], cwd=str(project_dir))
+    refreshes = []
+    watcher.on_refresh = lambda: refreshes.append(watcher.snapshot())
+
+    watcher.refresh()
+    assert len(refreshes) == 1 and refreshes[0] is not None
+
+    with patch('src.watcher.generate_project_file_blocks', side_effect=lambda scan: watcher.mark_dirty() or []):
+        watcher.refresh()
+    assert len(refreshes) == 1
+
+def test_ignored_paths_are_not_relevant(project_dir):
+    """Tests that events for ignored files (like our own database) are skipped."""
+    watcher = ProjectWatcher(include_patterns=["*.py"], cwd=str(project_dir))
+    watcher.refresh()
+
+    assert not watcher.is_relevant(str(project_dir / ".lin.db"))
+    assert not watcher.is_relevant(str(project_dir / ".git" / "index"))
+    assert watcher.is_relevant(str(project_dir / "a.py"))
+
+def test_own_database_writes_are_not_relevant(project_dir):
+    """Tests that writing .lin.db (before the first scan too) and the directory events that come with it are skipped."""
+    events = pytest.importorskip("watchdog.events")
+    watcher = ProjectWatcher(include_patterns=["*.py"], cwd=str(project_dir))
+    handler = ProjectEventHandler(watcher)
+
+    assert not watcher.is_relevant(str(project_dir / ".lin.db-journal"))
+    handler.on_any_event(events.DirModifiedEvent(str(project_dir)))
+    handler.on_any_event(events.FileCreatedEvent(str(project_dir / ".lin.db-journal")))
+    assert not watcher.dirty.is_set()
+
+    handler.on_any_event(events.FileModifiedEvent(str(project_dir / "a.py")))
+    assert watcher.dirty.is_set()
+
+@patch('src.watcher.Observer', None)
+def test_polling_watcher_picks_up_changes(project_dir):
+    """Tests the polling fallback keeps the snapshot current in the background."""
+    watcher = ProjectWatcher(include_patterns=["*.py"], cwd=str(project_dir), poll_interval=0.05)
+    watcher.start()
+
+    try:
+        assert watcher.polling
+        scan, _ = wait_for_snapshot(watcher)
+        assert scan.files == ["a.py"]
+
+        (project_dir / "a.py").write_text("print('a changed')\n")
+        (project_dir / "b.py").write_text("print('b')\n")
+
+        deadline = time.time() + 5
+        snapshot = None
+        while time.time() < deadline:
+            snapshot = watcher.snapshot()
+            if snapshot and "b.py" in snapshot[0].files:
+                break
+            time.sleep(0.05)
+
+        scan, blocks = snapshot
+        assert sorted(scan.files) == ["a.py", "b.py"]
+        assert "print('a changed')" in "".join(blocks)
+    finally:
+        watcher.stop()